@@ -67,12 +67,16 @@ def discover_on_port(port, iface, handler):
         read_values=False,
         max_queued=20000,
         max_message_size=2000,
-        debug=False)
+        debug=False,
+        ring_blocks=4)  # one sniffer per port, so a smaller ring each
 
     return MessageSniffer(options, handler)
 
 
 class MsgHandler(object):
+
+    header_only = True  # only msg.method is looked at
+
     def __init__(self, port):
         self._methods = set()
         self._port = port
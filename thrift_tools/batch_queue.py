@@ -0,0 +1,185 @@
+""" A blocking queue that hands everything that's pending to its consumer """
+
+from collections import deque
+from threading import Condition, Lock
+
+
+# what to do when appending to a full queue
+BLOCK = 'block'                # wait until the consumer makes room
+DROP_NEWEST = 'drop-newest'    # discard the new item
+DROP_OLDEST = 'drop-oldest'    # discard the oldest item to make room
+SAMPLE = 'sample'              # keep 1 out of SAMPLE_EVERY new items
+
+QUEUE_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST, SAMPLE)
+
+
+class BatchQueue(object):
+    """
+    A thread-safe FIFO for a single consumer. Instead of polling, the
+    consumer blocks in get_batch() until something is appended and then
+    takes all the pending items at once.
+
+    Like with Queue.Queue, the consumer calls task_done() once it's done
+    with the items so others can join() until everything is processed.
+
+    To see how busy the consumer is, ``wakeups`` counts the batches that
+    were handed over and ``idle`` counts the times it had to wait because
+    there was nothing to do. When bounded, ``dropped`` counts the items
+    that were discarded and ``blocked`` the times a producer had to wait.
+    """
+
+    SAMPLE_EVERY = 10
+
+    def __init__(self, maxlen=None, policy=DROP_OLDEST):
+        """
+        Params:
+            ``maxlen``          Max number of pending items, unbounded if
+                                None (or 0)
+            ``policy``          What to do when full, one of QUEUE_POLICIES
+        """
+        if policy not in QUEUE_POLICIES:
+            raise ValueError('Unknown queue policy: %s' % policy)
+
+        self._items = deque()
+        self._maxlen = maxlen or None
+        self._policy = policy
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._all_done = Condition(self._lock)
+        self._unfinished = 0
+        self._overflowed = 0
+        self._woken = False
+        self._closed = False
+        self.wakeups = 0
+        self.idle = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def unfinished(self):
+        """ items that were appended but not yet marked as done """
+        return self._unfinished
+
+    def append(self, item):
+        with self._lock:
+            self._append(item)
+            self._not_empty.notify()
+
+    def extend(self, items):
+        with self._lock:
+            for item in items:
+                self._append(item)
+            self._not_empty.notify()
+
+    def append_control(self, item):
+        """
+        Appends item regardless of maxlen and policy, for the sentinels
+        that tell the consumer to flush or stop: losing one of those (or
+        having it push out real data) isn't an option.
+        """
+        with self._lock:
+            self._items.append(item)
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def _append(self, item):
+        items = self._items
+        if self._maxlen is not None and len(items) >= self._maxlen:
+            if self._policy == BLOCK:
+                self.blocked += 1
+                # make sure the consumer isn't waiting for what we have so far
+                self._not_empty.notify()
+                while len(items) >= self._maxlen and not self._closed:
+                    self._not_full.wait()
+                if self._closed:
+                    # nobody will make room anymore
+                    self.dropped += 1
+                    return
+            elif self._policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            else:
+                if self._policy == SAMPLE:
+                    self._overflowed += 1
+                    if self._overflowed % self.SAMPLE_EVERY != 0:
+                        self.dropped += 1
+                        return
+                items.popleft()
+                self.dropped += 1
+                self._unfinished -= 1
+
+        items.append(item)
+        self._unfinished += 1
+
+    def close(self):
+        """
+        The consumer is gone: producers waiting for room (and those that
+        would) drop their items instead.
+        """
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+
+    def popleft(self):
+        """ non-blocking, raises IndexError when empty (like a deque) """
+        with self._lock:
+            item = self._items.popleft()
+            if self._policy == BLOCK:
+                self._not_full.notify_all()
+            return item
+
+    def get_batch(self, max_items=None, timeout=None):
+        """
+        Blocks until there's something pending (or timeout secs went by)
+        and returns a list with up to max_items items, possibly empty.
+        """
+        with self._lock:
+            if not self._items:
+                self.idle += 1
+                self._not_empty.wait_for(
+                    lambda: self._items or self._woken, timeout)
+                self._woken = False
+                if not self._items:
+                    return []
+
+            self.wakeups += 1
+            items = self._items
+            if max_items is None or len(items) <= max_items:
+                batch = list(items)
+                items.clear()
+            else:
+                batch = [items.popleft() for _ in range(max_items)]
+
+            if self._policy == BLOCK:
+                self._not_full.notify_all()
+
+            return batch
+
+    def wake_up(self):
+        """ get_batch() returns now, even if it's empty-handed """
+        with self._lock:
+            self._woken = True
+            self._not_empty.notify()
+
+    def task_done(self, count=1):
+        with self._lock:
+            self._unfinished = max(0, self._unfinished - count)
+            if self._unfinished == 0:
+                self._all_done.notify_all()
+
+    def join(self, timeout=None):
+        """ blocks until all the items have been processed """
+        with self._lock:
+            return self._all_done.wait_for(lambda: self._unfinished == 0, timeout)
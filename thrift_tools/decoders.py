@@ -0,0 +1,950 @@
+""" Decoders that read messages out of a buffer, for ThriftMessage.read """
+
+from struct import Struct, unpack_from
+
+from six.moves import range as xrange
+from thrift.Thrift import TType
+from thrift.protocol.TBinaryProtocol import (
+    TBinaryProtocol,
+    TBinaryProtocolAccelerated,
+)
+from thrift.protocol.TCompactProtocol import (
+    TCompactProtocol,
+    TCompactProtocolAccelerated,
+)
+from thrift.transport import TTransport
+
+from .thrift_struct import (
+    _BINARY_WIDTHS,
+    ObjectTooBig,
+    ThriftField,
+    ThriftStruct,
+)
+
+
+_I16 = Struct('!h')
+_I32 = Struct('!i')
+_I64 = Struct('!q')
+_LIST_HEADER = Struct('!bi')  # element type & size
+_MAP_HEADER = Struct('!bbi')  # key & value types, size
+
+_BINARY_VERSION_MASK = -65536  # 0xffff0000
+_BINARY_VERSION_1 = -2147418112  # 0x80010000
+
+_COMPACT_PROTOCOL_ID = 0x82
+_COMPACT_VERSION = 1
+
+# the types' nibble in compact to TType (true & false are bools)
+_COMPACT_TYPES = (
+    TType.STOP, TType.BOOL, TType.BOOL, TType.BYTE, TType.I16, TType.I32,
+    TType.I64, TType.DOUBLE, TType.STRING, TType.LIST, TType.SET, TType.MAP,
+    TType.STRUCT, None, None, None,
+)
+
+# what skip() goes over without looking, ints are varints in compact
+_COMPACT_WIDTHS = {
+    TType.BOOL: 1,  # in containers, fields have theirs in the field header
+    TType.BYTE: 1,
+    TType.DOUBLE: 8,
+}
+
+_VARINTS = (TType.I16, TType.I32, TType.I64)
+_VARINT_CONTINUATIONS = bytes(bytearray(range(0x80, 0x100)))
+
+# what's decoded by the C extension as is, but for these
+_NESTED = (TType.STRUCT, TType.LIST, TType.SET, TType.MAP)
+
+# how much of the buffer _fast_decode() tries first
+_FAST_DECODE_CHUNK = 4096
+
+
+def decoder_for(protocol, data, max_fields, max_list_size, max_map_size,
+                max_set_size):
+    """ the fastest decoder we have for protocol """
+    if issubclass(protocol, TBinaryProtocol):
+        return BinaryDecoder(
+            data, max_fields, max_list_size, max_map_size, max_set_size)
+
+    if issubclass(protocol, TCompactProtocol):
+        return CompactDecoder(
+            data, max_fields, max_list_size, max_map_size, max_set_size)
+
+    return ProtocolDecoder(
+        protocol, data, max_fields, max_list_size, max_map_size, max_set_size)
+
+
+class ProtocolDecoder(object):
+    """
+    Goes through a TMemoryBuffer & the given TProtocol, for the protocols
+    we don't have a decoder of our own for (i.e.: JSON).
+    """
+
+    def __init__(self, protocol, data, max_fields, max_list_size, max_map_size,
+                 max_set_size):
+        self._protocol = protocol
+        self._data = data
+        self._limits = (max_fields, max_list_size, max_map_size, max_set_size)
+        self.reset()
+
+    @property
+    def position(self):
+        return self._trans._buffer.tell()
+
+    def reset(self):
+        """ back to the start of data """
+        self._trans = TTransport.TMemoryBuffer(self._data)
+        self._proto = self._protocol(self._trans)
+
+    def read_message_begin(self):
+        return self._proto.readMessageBegin()
+
+    def read_struct(self, read_values=False, lazy=False):
+        """ always decoded right away, lazy is only for binary & compact """
+        return ThriftStruct.read(
+            self._proto, *self._limits, read_values=read_values)
+
+    def read_spec(self, spec):
+        """ there's no C extension for these """
+        return None
+
+    def read_message_end(self):
+        self._proto.readMessageEnd()
+
+
+class BinaryDecoder(object):
+    """
+    Reads the binary protocol straight out of data (bytes or a memoryview),
+    keeping an offset into it: there's no transport, no method call for
+    each value and nothing gets copied but the strings that are read.
+
+    It returns what ThriftStruct.read does over a TBinaryProtocol, and runs
+    out of bytes with an EOFError just like it. Strings that aren't read
+    are skipped without being decoded.
+    """
+
+    def __init__(self, data, max_fields, max_list_size, max_map_size,
+                 max_set_size):
+        self._data = data
+        self._end = len(data)
+        self._pos = 0
+        self._max_fields = max_fields
+        self._max_list_size = max_list_size
+        self._max_map_size = max_map_size
+        self._max_set_size = max_set_size
+
+    @property
+    def position(self):
+        return self._pos
+
+    def reset(self):
+        """ back to the start of data """
+        self._pos = 0
+
+    def seek(self, position):
+        self._pos = position
+
+    def _lazy_struct(self, start, entries, read_values):
+        limits = (self._max_fields, self._max_list_size, self._max_map_size,
+                  self._max_set_size)
+        data = bytes(self._data[start:self._pos])
+        return LazyThriftStruct(type(self), data, entries, limits, read_values)
+
+    def read_message_begin(self):
+        """ (method, type, seqid), for strict & old style messages """
+        size = self._read_i32()
+        if size < 0:
+            if size & _BINARY_VERSION_MASK != _BINARY_VERSION_1:
+                raise ValueError('bad version: %d' % size)
+            mtype = size & 0xff
+            method = self._read_string(self._read_i32())
+            return method, mtype, self._read_i32()
+
+        method = self._read_string(size)
+        self._need(1)
+        mtype = self._data[self._pos]
+        self._pos += 1
+        return method, mtype, self._read_i32()
+
+    def read_message_end(self):
+        pass
+
+    def read_spec(self, spec):
+        """
+        Reads a struct with thrift's C extension, given its (class,
+        thrift_spec), None if it can't (then read_struct() should be used).
+        """
+        struct = _fast_decode(TBinaryProtocolAccelerated, self._data[self._pos:], spec,
+                              self._max_container_size())
+        if struct is not None:
+            self._pos += struct.bytes_length
+        return struct
+
+    def _max_container_size(self):
+        return max(self._max_list_size, self._max_map_size, self._max_set_size)
+
+    def read_struct(self, read_values=False, lazy=False):
+        """
+        With lazy, the values are walked through (and checked) but only
+        decoded once the returned LazyThriftStruct's fields are accessed.
+        """
+        data = self._data
+        fields = []
+        nfields = 0
+        start = self._pos
+
+        while True:
+            nfields += 1
+            if nfields >= self._max_fields:
+                raise ObjectTooBig('too many fields: %d' % nfields)
+
+            pos = self._pos
+            if pos >= self._end:
+                raise EOFError('no field header')
+            ftype = data[pos]
+            if ftype == TType.STOP:
+                self._pos = pos + 1
+                break
+
+            if pos + 3 > self._end:
+                raise EOFError('no field id')
+            fid, = _I16.unpack_from(data, pos + 1)
+            self._pos = pos + 3
+
+            offset = self._pos - start
+            if lazy:
+                self._skip_field(ftype)
+                fields.append((ftype, fid, offset))
+            else:
+                value = self.read_value(ftype, read_values)
+                field_type = ThriftStruct.field_type_to_str(ftype)
+                fields.append(ThriftField(field_type, fid, value))
+
+        if lazy:
+            return self._lazy_struct(start, fields, read_values)
+        return ThriftStruct(fields, self._pos - start)
+
+    def _skip_field(self, ftype):
+        """
+        Walks a value with the checks read_value(ftype, False) does, but
+        without building the ThriftStructs of struct values.
+        """
+        if ftype == TType.STRUCT:
+            self._skip_struct()
+        elif ftype == TType.LIST or ftype == TType.SET or ftype == TType.MAP:
+            # the container's size is still checked
+            self._read_container(ftype, False)
+        else:
+            self._skip(ftype)
+
+    def _skip_struct(self):
+        """ like read_struct, checking the number of fields """
+        data = self._data
+        nfields = 0
+        while True:
+            nfields += 1
+            if nfields >= self._max_fields:
+                raise ObjectTooBig('too many fields: %d' % nfields)
+
+            pos = self._pos
+            if pos >= self._end:
+                raise EOFError('no field header')
+            ftype = data[pos]
+            if ftype == TType.STOP:
+                self._pos = pos + 1
+                return
+
+            if pos + 3 > self._end:
+                raise EOFError('no field id')
+            self._pos = pos + 3
+            self._skip_field(ftype)
+
+    def _need(self, nbytes):
+        if self._pos + nbytes > self._end:
+            raise EOFError('need %d bytes' % nbytes)
+
+    def _read_i32(self):
+        self._need(4)
+        value, = _I32.unpack_from(self._data, self._pos)
+        self._pos += 4
+        return value
+
+    def _read_string(self, size):
+        if size < 0:
+            raise ValueError('negative string length: %d' % size)
+        self._need(size)
+        pos = self._pos
+        self._pos = pos + size
+        return bytes(self._data[pos:pos + size]).decode('utf-8')
+
+    def read_value(self, ttype, read_values):
+        """ like ThriftStruct.read_field_value """
+        if ttype == TType.STRUCT:
+            return self.read_struct(read_values)
+
+        if not read_values:
+            if ttype == TType.LIST or ttype == TType.SET or ttype == TType.MAP:
+                # the container's size is still checked
+                return self._read_container(ttype, False)
+            self._skip(ttype)
+            return None
+
+        data = self._data
+        pos = self._pos
+        if ttype == TType.I32:
+            self._need(4)
+            self._pos = pos + 4
+            return _I32.unpack_from(data, pos)[0]
+        elif ttype == TType.I64:
+            self._need(8)
+            self._pos = pos + 8
+            return _I64.unpack_from(data, pos)[0]
+        elif ttype == TType.STRING:
+            try:
+                return self._read_string(self._read_i32())
+            except UnicodeDecodeError:
+                return ''
+        elif ttype == TType.LIST or ttype == TType.SET or ttype == TType.MAP:
+            return self._read_container(ttype, True)
+
+        # for now, we ignore all other values
+        self._skip(ttype)
+        return None
+
+    def _read_container(self, ttype, read_values):
+        data = self._data
+        pos = self._pos
+        if ttype == TType.MAP:
+            self._need(6)
+            ktype, vtype, size = _MAP_HEADER.unpack_from(data, pos)
+            self._pos = pos + 6
+            if size < 0:
+                raise ValueError('negative map size: %d' % size)
+            if size > self._max_map_size:
+                raise ObjectTooBig('map too big: %d' % size)
+            if not read_values:
+                self._skip_pairs(ktype, vtype, size)
+                return {}
+            value = {}
+            for _ in xrange(size):
+                key = self.read_value(ktype, True)
+                value[key] = self.read_value(vtype, True)
+            return value
+
+        self._need(5)
+        etype, size = _LIST_HEADER.unpack_from(data, pos)
+        self._pos = pos + 5
+        if size < 0:
+            raise ValueError('negative container size: %d' % size)
+
+        if ttype == TType.LIST:
+            if size > self._max_list_size:
+                raise ObjectTooBig('list too long: %d' % size)
+        elif size > self._max_set_size:
+            raise ObjectTooBig('set too big: %d' % size)
+
+        if not read_values:
+            self._skip_items(etype, size)
+            return [] if ttype == TType.LIST else set()
+
+        width = _BINARY_WIDTHS.get(etype)
+        if width is not None:
+            # these are read in one go, or not at all
+            self._need(size * width)
+            if etype == TType.I32 or etype == TType.I64:
+                fmt = '!%d%s' % (size, 'i' if etype == TType.I32 else 'q')
+                values = list(unpack_from(fmt, data, self._pos))
+            else:
+                values = [None] * size
+            self._pos += size * width
+        else:
+            values = [self.read_value(etype, True) for _ in xrange(size)]
+        return values if ttype == TType.LIST else set(values)
+
+    def _skip_items(self, etype, count):
+        """ the fixed width ones in one go, strings without a value each """
+        width = _BINARY_WIDTHS.get(etype)
+        if width is not None:
+            self._need(count * width)
+            self._pos += count * width
+        elif etype == TType.STRING:
+            data = self._data
+            pos = self._pos
+            end = self._end
+            for _ in xrange(count):
+                if pos + 4 > end:
+                    raise EOFError('no string length')
+                size, = _I32.unpack_from(data, pos)
+                if size < 0:
+                    raise ValueError('negative string length: %d' % size)
+                pos += 4 + size
+                if pos > end:
+                    raise EOFError('truncated string')
+            self._pos = pos
+        else:
+            for _ in xrange(count):
+                self._skip(etype)
+
+    def _skip_pairs(self, ktype, vtype, count):
+        """ the items of a map """
+        kwidth = _BINARY_WIDTHS.get(ktype)
+        vwidth = _BINARY_WIDTHS.get(vtype)
+        if kwidth is not None and vwidth is not None:
+            self._need(count * (kwidth + vwidth))
+            self._pos += count * (kwidth + vwidth)
+            return
+
+        for _ in xrange(count):
+            self._skip(ktype)
+            self._skip(vtype)
+
+    def _skip(self, ttype):
+        """ like TProtocolBase.skip, which also ignores unknown types """
+        width = _BINARY_WIDTHS.get(ttype)
+        if width is not None:
+            self._need(width)
+            self._pos += width
+        elif ttype == TType.STRING:
+            size = self._read_i32()
+            if size < 0:
+                raise ValueError('negative string length: %d' % size)
+            self._need(size)
+            self._pos += size
+        elif ttype == TType.STRUCT:
+            while True:
+                self._need(1)
+                ftype = self._data[self._pos]
+                if ftype == TType.STOP:
+                    self._pos += 1
+                    break
+                self._need(3)
+                self._pos += 3
+                self._skip(ftype)
+        elif ttype == TType.MAP:
+            self._need(6)
+            ktype, vtype, size = _MAP_HEADER.unpack_from(self._data, self._pos)
+            self._pos += 6
+            if size < 0:
+                raise ValueError('negative map size: %d' % size)
+            self._skip_pairs(ktype, vtype, size)
+        elif ttype == TType.LIST or ttype == TType.SET:
+            self._need(5)
+            etype, size = _LIST_HEADER.unpack_from(self._data, self._pos)
+            self._pos += 5
+            if size < 0:
+                raise ValueError('negative container size: %d' % size)
+            self._skip_items(etype, size)
+
+
+class CompactDecoder(object):
+    """
+    Like BinaryDecoder, for the compact protocol: varints are decoded from
+    the buffer as they are (with a path for the single byte ones, and whole
+    containers of ints at a time) and field ids from their deltas.
+
+    It returns what ThriftStruct.read does over a TCompactProtocol.
+    """
+
+    def __init__(self, data, max_fields, max_list_size, max_map_size,
+                 max_set_size):
+        self._data = data
+        self._end = len(data)
+        self._pos = 0
+        self._max_fields = max_fields
+        self._max_list_size = max_list_size
+        self._max_map_size = max_map_size
+        self._max_set_size = max_set_size
+
+    @property
+    def position(self):
+        return self._pos
+
+    def reset(self):
+        """ back to the start of data """
+        self._pos = 0
+
+    def seek(self, position):
+        self._pos = position
+
+    def _lazy_struct(self, start, entries, read_values):
+        limits = (self._max_fields, self._max_list_size, self._max_map_size,
+                  self._max_set_size)
+        data = bytes(self._data[start:self._pos])
+        return LazyThriftStruct(type(self), data, entries, limits, read_values)
+
+    def read_message_begin(self):
+        """ (method, type, seqid) """
+        self._need(2)
+        proto_id = self._data[self._pos]
+        ver_type = self._data[self._pos + 1]
+        if proto_id != _COMPACT_PROTOCOL_ID:
+            raise ValueError('bad protocol id: %d' % proto_id)
+        if ver_type & 0x1f != _COMPACT_VERSION:
+            raise ValueError('bad version: %d' % (ver_type & 0x1f))
+        self._pos += 2
+
+        seqid = self._read_varint()
+        method = self._read_string(self._read_varint())
+        return method, (ver_type >> 5) & 0x07, seqid
+
+    def read_message_end(self):
+        pass
+
+    def read_spec(self, spec):
+        """
+        Reads a struct with thrift's C extension, given its (class,
+        thrift_spec), None if it can't (then read_struct() should be used).
+        """
+        struct = _fast_decode(TCompactProtocolAccelerated, self._data[self._pos:], spec,
+                              self._max_container_size())
+        if struct is not None:
+            self._pos += struct.bytes_length
+        return struct
+
+    def _max_container_size(self):
+        return max(self._max_list_size, self._max_map_size, self._max_set_size)
+
+    def read_struct(self, read_values=False, lazy=False):
+        """ see BinaryDecoder.read_struct() """
+        data = self._data
+        fields = []
+        nfields = 0
+        start = self._pos
+        last_fid = 0
+
+        while True:
+            nfields += 1
+            if nfields >= self._max_fields:
+                raise ObjectTooBig('too many fields: %d' % nfields)
+
+            pos = self._pos
+            if pos >= self._end:
+                raise EOFError('no field header')
+            header = data[pos]
+            self._pos = pos + 1
+            if header & 0x0f == TType.STOP:
+                break
+
+            delta = header >> 4
+            if delta == 0:
+                fid = _from_zigzag(self._read_varint())
+            else:
+                fid = last_fid + delta
+            last_fid = fid
+
+            ftype = _compact_type(header)
+            offset = self._pos - start
+            if lazy:
+                if ftype != TType.BOOL:
+                    self._skip_field(ftype)
+                fields.append((ftype, fid, offset))
+                continue
+
+            if ftype == TType.BOOL:
+                # its value was in the header
+                value = None
+            else:
+                value = self.read_value(ftype, read_values)
+            field_type = ThriftStruct.field_type_to_str(ftype)
+            fields.append(ThriftField(field_type, fid, value))
+
+        if lazy:
+            return self._lazy_struct(start, fields, read_values)
+        return ThriftStruct(fields, self._pos - start)
+
+    def _skip_field(self, ftype):
+        """
+        Walks a value with the checks read_value(ftype, False) does, but
+        without building the ThriftStructs of struct values.
+        """
+        if ftype == TType.STRUCT:
+            self._skip_struct()
+        elif ftype == TType.LIST or ftype == TType.SET or ftype == TType.MAP:
+            # the container's size is still checked
+            self._read_container(ftype, False)
+        else:
+            self._skip(ftype)
+
+    def _skip_struct(self):
+        """ like read_struct, checking the number of fields """
+        data = self._data
+        nfields = 0
+        while True:
+            nfields += 1
+            if nfields >= self._max_fields:
+                raise ObjectTooBig('too many fields: %d' % nfields)
+
+            pos = self._pos
+            if pos >= self._end:
+                raise EOFError('no field header')
+            header = data[pos]
+            self._pos = pos + 1
+            if header & 0x0f == TType.STOP:
+                return
+
+            if header >> 4 == 0:
+                self._skip_varint()
+            ftype = _compact_type(header)
+            if ftype != TType.BOOL:
+                self._skip_field(ftype)
+
+    def _need(self, nbytes):
+        if self._pos + nbytes > self._end:
+            raise EOFError('need %d bytes' % nbytes)
+
+    def _read_varint(self):
+        data = self._data
+        pos = self._pos
+        if pos >= self._end:
+            raise EOFError('no varint')
+        byte = data[pos]
+        if byte < 0x80:
+            self._pos = pos + 1
+            return byte
+
+        return self._read_varints(1)[0]
+
+    def _read_varints(self, count):
+        """ count varints, in one go """
+        data = self._data
+        pos = self._pos
+        end = self._end
+        values = []
+        for _ in xrange(count):
+            result = 0
+            shift = 0
+            while True:
+                if pos >= end:
+                    raise EOFError('truncated varint')
+                byte = data[pos]
+                pos += 1
+                result |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            values.append(result)
+        self._pos = pos
+        return values
+
+    def _skip_varint(self):
+        data = self._data
+        pos = self._pos
+        end = self._end
+        while True:
+            if pos >= end:
+                raise EOFError('truncated varint')
+            pos += 1
+            if data[pos - 1] < 0x80:
+                break
+        self._pos = pos
+
+    def _skip_varints(self, count):
+        """
+        Each varint ends in a byte < 0x80 and takes at least one, so count
+        bytes hold at most count of them: those are skipped, and so on with
+        what's left.
+        """
+        data = self._data
+        pos = self._pos
+        while count > 0:
+            chunk = bytes(data[pos:pos + count])
+            if len(chunk) < count:
+                raise EOFError('truncated varints')
+            pos += count
+            count -= len(chunk.translate(None, _VARINT_CONTINUATIONS))
+        self._pos = pos
+
+    def _read_string(self, size):
+        self._need(size)
+        pos = self._pos
+        self._pos = pos + size
+        return bytes(self._data[pos:pos + size]).decode('utf-8')
+
+    def read_value(self, ttype, read_values):
+        """ like ThriftStruct.read_field_value """
+        if ttype == TType.STRUCT:
+            return self.read_struct(read_values)
+
+        if not read_values:
+            if ttype == TType.LIST or ttype == TType.SET or ttype == TType.MAP:
+                # the container's size is still checked
+                return self._read_container(ttype, False)
+            self._skip(ttype)
+            return None
+
+        if ttype == TType.I32 or ttype == TType.I64:
+            return _from_zigzag(self._read_varint())
+        elif ttype == TType.STRING:
+            try:
+                return self._read_string(self._read_varint())
+            except UnicodeDecodeError:
+                return ''
+        elif ttype == TType.LIST or ttype == TType.SET or ttype == TType.MAP:
+            return self._read_container(ttype, True)
+
+        # for now, we ignore all other values
+        self._skip(ttype)
+        return None
+
+    def _read_container(self, ttype, read_values):
+        if ttype == TType.MAP:
+            ktype, vtype, size = self._read_map_header()
+            if size > self._max_map_size:
+                raise ObjectTooBig('map too big: %d' % size)
+            if not read_values:
+                self._skip_pairs(ktype, vtype, size)
+                return {}
+            value = {}
+            for _ in xrange(size):
+                key = self.read_value(ktype, True)
+                value[key] = self.read_value(vtype, True)
+            return value
+
+        etype, size = self._read_list_header()
+        if ttype == TType.LIST:
+            if size > self._max_list_size:
+                raise ObjectTooBig('list too long: %d' % size)
+        elif size > self._max_set_size:
+            raise ObjectTooBig('set too big: %d' % size)
+
+        if not read_values:
+            self._skip_items(etype, size)
+            return [] if ttype == TType.LIST else set()
+
+        if etype == TType.I32 or etype == TType.I64:
+            values = [_from_zigzag(value) for value in self._read_varints(size)]
+        elif etype in _COMPACT_WIDTHS or etype == TType.I16:
+            # their values aren't read
+            self._skip_items(etype, size)
+            values = [None] * size
+        else:
+            values = [self.read_value(etype, True) for _ in xrange(size)]
+        return values if ttype == TType.LIST else set(values)
+
+    def _read_list_header(self):
+        """ for sets too """
+        self._need(1)
+        size_type = self._data[self._pos]
+        self._pos += 1
+        etype = _compact_type(size_type)
+        size = size_type >> 4
+        if size == 15:
+            size = self._read_varint()
+        return etype, size
+
+    def _read_map_header(self):
+        size = self._read_varint()
+        types = 0
+        if size > 0:
+            self._need(1)
+            types = self._data[self._pos]
+            self._pos += 1
+        return _compact_type(types >> 4), _compact_type(types), size
+
+    def _skip_items(self, etype, count):
+        """ the fixed width ones in one go, strings without a value each """
+        width = _COMPACT_WIDTHS.get(etype)
+        if width is not None:
+            self._need(count * width)
+            self._pos += count * width
+        elif etype in _VARINTS:
+            self._skip_varints(count)
+        elif etype == TType.STRING:
+            for _ in xrange(count):
+                size = self._read_varint()
+                self._need(size)
+                self._pos += size
+        else:
+            for _ in xrange(count):
+                self._skip(etype)
+
+    def _skip_pairs(self, ktype, vtype, count):
+        """ the items of a map """
+        kwidth = _COMPACT_WIDTHS.get(ktype)
+        vwidth = _COMPACT_WIDTHS.get(vtype)
+        if kwidth is not None and vwidth is not None:
+            self._need(count * (kwidth + vwidth))
+            self._pos += count * (kwidth + vwidth)
+            return
+
+        if ((kwidth is not None or ktype in _VARINTS) and
+                (vwidth is not None or vtype in _VARINTS)):
+            # fixed widths & varints (0 is a varint), in one loop
+            data = self._data
+            pos = self._pos
+            end = self._end
+            widths = (kwidth or 0, vwidth or 0)
+            for _ in xrange(count):
+                for width in widths:
+                    if width:
+                        pos += width
+                        continue
+                    while True:
+                        if pos >= end:
+                            raise EOFError('truncated varint')
+                        pos += 1
+                        if data[pos - 1] < 0x80:
+                            break
+            if pos > end:
+                raise EOFError('truncated map')
+            self._pos = pos
+            return
+
+        for _ in xrange(count):
+            self._skip(ktype)
+            self._skip(vtype)
+
+    def _skip(self, ttype):
+        """ like TProtocolBase.skip, for values in containers """
+        width = _COMPACT_WIDTHS.get(ttype)
+        if width is not None:
+            self._need(width)
+            self._pos += width
+        elif ttype in _VARINTS:
+            self._skip_varint()
+        elif ttype == TType.STRING:
+            size = self._read_varint()
+            self._need(size)
+            self._pos += size
+        elif ttype == TType.STRUCT:
+            while True:
+                self._need(1)
+                header = self._data[self._pos]
+                self._pos += 1
+                if header & 0x0f == TType.STOP:
+                    break
+                if header >> 4 == 0:
+                    self._skip_varint()
+                ftype = _compact_type(header)
+                if ftype != TType.BOOL:
+                    self._skip(ftype)
+        elif ttype == TType.MAP:
+            ktype, vtype, size = self._read_map_header()
+            self._skip_pairs(ktype, vtype, size)
+        elif ttype == TType.LIST or ttype == TType.SET:
+            etype, size = self._read_list_header()
+            self._skip_items(etype, size)
+
+
+class LazyThriftStruct(ThriftStruct):
+    """
+    A struct whose fields are decoded when they are first needed (fields,
+    iterating, [] or as_dict), not when it's read. Until then it keeps its
+    bytes and the type, id & offset of each field in them. The values of
+    struct fields are lazy too.
+
+    It was checked when read, so what's left to fail is what's only read
+    with values (i.e.: the limits on nested containers).
+    """
+
+    def __init__(self, decoder_cls, data, entries, limits, read_values):
+        super(LazyThriftStruct, self).__init__(None, len(data))
+        self._decoder_cls = decoder_cls
+        self._data = data
+        self._entries = entries  # (type, id, offset) of each field
+        self._limits = limits
+        self._read_values = read_values
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self._decode()
+        return self._fields
+
+    def __len__(self):
+        """ number of fields, which doesn't need them decoded """
+        return len(self._entries)
+
+    def _decode(self):
+        decoder = self._decoder_cls(self._data, *self._limits)
+        fields = []
+        for ftype, fid, offset in self._entries:
+            decoder.seek(offset)
+            if ftype == TType.STRUCT:
+                value = decoder.read_struct(self._read_values, lazy=True)
+            elif ftype == TType.BOOL:
+                value = None  # not read, and compact has it in the header
+            else:
+                value = decoder.read_value(ftype, self._read_values)
+            fields.append(ThriftField(ThriftStruct.field_type_to_str(ftype), fid, value))
+        return fields
+
+
+def _fast_decode(accelerated, data, spec, max_container_size):
+    """
+    The struct at the start of data, decoded by the C extension. Like with
+    any generated code, fields that aren't in the spec (i.e.: the IDL is
+    out of date) are skipped, so they're missing from the ThriftStruct.
+
+    Rather than copying all of data (i.e.: the rest of the stream), it's
+    tried on a chunk that gets bigger until the struct fits. The C
+    extension could ask for more itself, but its refill doesn't work on
+    python >= 3.10 (as of thrift 0.11).
+    """
+    cls, thrift_spec = spec
+    size = min(_FAST_DECODE_CHUNK, len(data))
+    while True:
+        trans = TTransport.TMemoryBuffer(bytes(data[:size]))
+        proto = accelerated(trans, container_length_limit=max_container_size)
+        if proto._fast_decode is None:
+            return None  # no C extension
+
+        decoded = cls()
+        try:
+            proto._fast_decode(decoded, proto, [cls, thrift_spec])
+            return _from_spec(decoded, thrift_spec, trans._buffer.tell())
+        except Exception:
+            # i.e.: it's truncated, which only read_struct() tells apart
+            if size == len(data):
+                return None
+            size = min(4 * size, len(data))
+
+
+def _from_spec(decoded, thrift_spec, length=0):
+    """ the ThriftStruct for what was decoded with thrift_spec """
+    fields = []
+    for entry in thrift_spec:
+        if entry is None:
+            continue
+        fid, ftype, name, type_args, _ = entry
+        value = getattr(decoded, name, None)
+        if value is None:
+            continue
+        value = _from_spec_value(value, ftype, type_args)
+        fields.append(ThriftField(ThriftStruct.field_type_to_str(ftype), fid, value))
+
+    return ThriftStruct(fields, length)
+
+
+def _from_spec_value(value, ttype, type_args):
+    if ttype == TType.STRUCT:
+        return _from_spec(value, type_args[1])
+    elif ttype == TType.LIST:
+        etype, eargs, _ = type_args
+        if etype not in _NESTED:
+            return value
+        return [_from_spec_value(item, etype, eargs) for item in value]
+    elif ttype == TType.SET:
+        etype, eargs, _ = type_args
+        if etype not in _NESTED:
+            return value
+        return set(_from_spec_value(item, etype, eargs) for item in value)
+    elif ttype == TType.MAP:
+        ktype, kargs, vtype, vargs, _ = type_args
+        if ktype not in _NESTED and vtype not in _NESTED:
+            return value
+        return dict(
+            (_from_spec_value(key, ktype, kargs),
+             _from_spec_value(item, vtype, vargs))
+            for key, item in value.items())
+    return value
+
+
+def _compact_type(byte):
+    ttype = _COMPACT_TYPES[byte & 0x0f]
+    if ttype is None:
+        raise ValueError('unknown compact type: %d' % (byte & 0x0f))
+    return ttype
+
+
+def _from_zigzag(value):
+    return (value >> 1) ^ -(value & 1)
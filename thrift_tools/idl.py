@@ -2,6 +2,20 @@ import os
 
 from ptsd import ast
 from ptsd.parser import Parser
+from thrift.Thrift import TType
+
+
+# the base types, as resolved by IdlParser
+_TTYPES = {
+    ast.Bool: TType.BOOL,
+    ast.Byte: TType.BYTE,
+    ast.I16: TType.I16,
+    ast.I32: TType.I32,
+    ast.I64: TType.I64,
+    ast.Double: TType.DOUBLE,
+    ast.String: TType.STRING,
+    ast.Binary: TType.STRING,
+}
 
 
 class IdlNode(object):
@@ -177,15 +191,117 @@ class Function(IdlNode):
 
         return msg.args
 
+    @property
+    def result_fields(self):
+        """ the fields of a reply's struct: the return value & the throws """
+        fields = list(self.throws)
+        if not isinstance(self.type, Void):
+            fields.insert(0, Field(
+                tag=0, name="success", is_required=False, type=self.type))
+        return fields
+
+
+class SpecStruct(object):
+    """ What thrift's C extension decodes structs to, given a thrift_spec """
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def compile_thrift_spec(fields, structs=None):
+    """
+    Returns the thrift_spec tuple (like generated code has, indexed by tag)
+    for fields, so they can be decoded by thrift's C extension. Structs are
+    decoded to SpecStruct, structs maps the ones compiled so far (by id)
+    to their type args so recursive ones work.
+    """
+    if structs is None:
+        structs = {}
+
+    tags = [field.tag for field in fields if field.tag >= 0]
+    spec = [None] * (max(tags) + 1 if tags else 1)
+    for field in fields:
+        if field.tag < 0:
+            continue  # the C extension skips those anyway
+        ttype, type_args = _type_spec(field.type, structs)
+        spec[field.tag] = (field.tag, ttype, field.name, type_args, None)
+
+    return tuple(spec)
+
+
+def _type_spec(idl_type, structs):
+    """ (ttype, type args) of a field of type idl_type """
+    if isinstance(idl_type, TypeDef):
+        return _type_spec(idl_type.type, structs)
+
+    if isinstance(idl_type, Struct):
+        type_args = structs.get(id(idl_type))
+        if type_args is None:
+            # filled in once compiled, it might refer to itself
+            type_args = structs[id(idl_type)] = [SpecStruct, None]
+            type_args[1] = compile_thrift_spec(idl_type.fields, structs)
+        return TType.STRUCT, type_args
+
+    if isinstance(idl_type, Enum):
+        return TType.I32, None
+
+    if isinstance(idl_type, (List, Set)):
+        etype, eargs = _type_spec(idl_type.type, structs)
+        ttype = TType.LIST if isinstance(idl_type, List) else TType.SET
+        return ttype, (etype, eargs, False)
+
+    if isinstance(idl_type, Map):
+        ktype, kargs = _type_spec(idl_type.key_type, structs)
+        vtype, vargs = _type_spec(idl_type.value_type, structs)
+        return TType.MAP, (ktype, kargs, vtype, vargs, False)
+
+    if isinstance(idl_type, type) and idl_type in _TTYPES:
+        if idl_type is ast.String:
+            return TType.STRING, "UTF8"
+        if idl_type is ast.Binary:
+            return TType.STRING, "BINARY"
+        return _TTYPES[idl_type], None
+
+    raise ValueError("no thrift_spec for %s" % (idl_type,))
+
 
 class Idl(object):
     def __init__(self, functions):
         self.functions = functions
         self.functions_by_name = dict((x.name, x) for x in self.functions)
+        self._thrift_specs = {}  # by (method, message type)
 
     def get_function(self, name):
         return self.functions_by_name.get(name, None)
 
+    def thrift_spec(self, name, mtype):
+        """
+        Returns (SpecStruct, thrift_spec) for the args of a call (or oneway)
+        or the result of a reply to the given method, None if the method is
+        unknown or its types can't be compiled.
+        """
+        key = (name, mtype)
+        if key not in self._thrift_specs:
+            self._thrift_specs[key] = self._compile(name, mtype)
+        return self._thrift_specs[key]
+
+    def _compile(self, name, mtype):
+        function = self.get_function(name)
+        if function is None:
+            return None
+
+        if mtype in ("call", "oneway"):
+            fields = function.arguments
+        elif mtype == "reply":
+            fields = function.result_fields
+        else:
+            return None  # exceptions are TApplicationException
+
+        try:
+            return SpecStruct, compile_thrift_spec(fields)
+        except ValueError:
+            return None
+
 
 class IdlParser(object):
     def __init__(self):
@@ -0,0 +1,474 @@
+""" Finds where a message ends, as its bytes come in """
+
+from struct import unpack_from
+
+from thrift.Thrift import TType
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+
+from .thrift_struct import _BINARY_WIDTHS
+
+
+# what's left to do, kept in a stack of lists: [what, args...]
+_MESSAGE = 0  # the message header
+_STRUCT = 1   # the fields of a struct, until STOP
+_VALUE = 2    # a value of a given type: [_VALUE, type]
+_ITEMS = 3    # the items of a container: [_ITEMS, how many left, types]
+_SKIP = 4     # the rest of a string: [_SKIP, how many bytes left]
+
+_BINARY_TYPES = frozenset(_BINARY_WIDTHS) | frozenset((
+    TType.STRING, TType.STRUCT, TType.MAP, TType.SET, TType.LIST))
+
+# compact protocol type ids
+_CT_BOOLEAN_TRUE = 1
+_CT_BOOLEAN_FALSE = 2
+_CT_BYTE = 3
+_CT_I16 = 4
+_CT_I32 = 5
+_CT_I64 = 6
+_CT_DOUBLE = 7
+_CT_BINARY = 8
+_CT_LIST = 9
+_CT_SET = 10
+_CT_MAP = 11
+_CT_STRUCT = 12
+
+_COMPACT_WIDTHS = {
+    _CT_BOOLEAN_TRUE: 1,  # bools take a byte in containers
+    _CT_BOOLEAN_FALSE: 1,
+    _CT_BYTE: 1,
+    _CT_DOUBLE: 8,
+}
+_COMPACT_VARINTS = frozenset((_CT_I16, _CT_I32, _CT_I64))
+
+_BINARY_VERSION_MASK = 0xffff0000
+_BINARY_VERSION_1 = 0x80010000
+_COMPACT_PROTOCOL_ID = 0x82
+_COMPACT_VERSION = 1
+
+
+class MessageScanner(object):
+    """
+    Walks a binary or compact message the way a decoder would, but without
+    decoding anything, to find out where it ends.
+
+    It keeps its position and the stack of structs & containers it's in, so
+    when it runs out of bytes it can carry on from there once more arrive
+    instead of starting over. Once the message is complete it can be read
+    in one go. Anything a decoder would choke on raises MessageScanner.Error.
+
+    Nothing before its position is looked at again, so those bytes can be
+    discard()ed (i.e.: to go through a message too big to be kept around).
+
+    Ex:
+    >> scanner = MessageScanner(TBinaryProtocol)
+    >> length = scanner.scan(data)  # None until the message is complete
+    >> ...
+    >> length = scanner.scan(data + more_data)
+    """
+
+    class Error(ValueError):
+        pass
+
+    MAX_DEPTH = 64
+    MAX_METHOD_LENGTH = 70
+    MAX_ITEMS = 1000000
+
+    @classmethod
+    def supports(cls, protocol):
+        return issubclass(protocol, (TBinaryProtocol, TCompactProtocol))
+
+    def __init__(self, protocol, finagle_thrift=False, max_size=1024*1000):
+        """
+        Params:
+            ``protocol``        TBinaryProtocol or TCompactProtocol
+            ``finagle_thrift``  Expect a request header before the message
+                                (like ThriftMessage.read, a message without
+                                one is fine too)
+            ``max_size``        Strings can't be longer than this
+        """
+        self._protocol = protocol
+        self._compact = issubclass(protocol, TCompactProtocol)
+        self._max_size = max_size
+        self._discarded = 0
+        self._reset(finagle_thrift)
+
+    def _reset(self, with_header):
+        self._pos = 0
+        self._stack = [[_MESSAGE]]
+        if with_header:
+            self._stack.append([_STRUCT])
+        self._in_header = with_header
+
+    def scan(self, data):
+        """
+        data must start where the message does (or where the discarded bytes
+        end) and include the bytes seen in previous calls, returns the
+        message's length or None if it isn't complete yet
+        """
+        try:
+            length = self._scan(data)
+        except MessageScanner.Error:
+            if not self._in_header:
+                raise
+            # not a header, maybe it's just the message
+            self._reset(False)
+            length = self._scan(data)
+
+        if length is None:
+            return None
+        return self._discarded + length
+
+    def discard(self, nbytes):
+        """ the first nbytes of data won't be passed to scan() anymore """
+        if self._in_header:
+            raise ValueError('the header might have to be scanned again')
+        if nbytes > self._pos:
+            raise ValueError('those bytes were not scanned yet')
+        self._pos -= nbytes
+        self._discarded += nbytes
+
+    @property
+    def protocol(self):
+        return self._protocol
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def position(self):
+        """ how far we've got, within the data passed to scan() """
+        return self._pos
+
+    @property
+    def discarded(self):
+        return self._discarded
+
+    @property
+    def in_header(self):
+        """ still in finagle-thrift's header, which might not be one """
+        return self._in_header
+
+    def _scan(self, data):
+        stack = self._stack
+        end = len(data)
+        if self._compact:
+            value, struct, message = self._compact_value, self._compact_struct, self._compact_message
+        else:
+            value, struct, message = self._binary_value, self._binary_struct, self._binary_message
+
+        while stack:
+            task = stack[-1]
+            what = task[0]
+            if what == _VALUE:
+                done = value(data, end, task)
+            elif what == _STRUCT:
+                done = struct(data, end)
+            elif what == _ITEMS:
+                done = self._items(end, task)
+            elif what == _SKIP:
+                done = self._skip(end, task)
+            else:
+                self._in_header = False
+                done = message(data, end)
+
+            if not done:
+                return None
+
+            if len(stack) > self.MAX_DEPTH:
+                raise MessageScanner.Error('too deep')
+
+        return self._pos
+
+    def _items(self, end, task):
+        _, left, types = task
+        if left == 0:
+            self._stack.pop()
+            return True
+
+        # fixed width items are skipped in bulk
+        widths = _COMPACT_WIDTHS if self._compact else _BINARY_WIDTHS
+        width = sum(widths.get(ttype, 0) for ttype in types)
+        if all(ttype in widths for ttype in types):
+            available = min(left, (end - self._pos) // width)
+            if available == 0:
+                return False
+            self._pos += available * width
+            task[1] -= available
+            return True
+
+        task[1] -= 1
+        for ttype in reversed(types):
+            self._stack.append([_VALUE, ttype])
+        return True
+
+    def _skip(self, end, task):
+        available = min(task[1], end - self._pos)
+        self._pos += available
+        task[1] -= available
+        if task[1] > 0:
+            return False
+        self._stack.pop()
+        return True
+
+    def _check_size(self, size, limit, what):
+        if size < 0 or size > limit:
+            raise MessageScanner.Error('bad %s size: %d' % (what, size))
+
+    def _check_method(self, data, start, length, end):
+        """ checks the name's length, and as much of it as we have """
+        self._check_size(length, self.MAX_METHOD_LENGTH, 'method name')
+        if length == 0:
+            raise MessageScanner.Error('no method name')
+        name = bytearray(data[start:min(start + length, end)])
+        if any(char < 33 or char > 126 for char in name):
+            raise MessageScanner.Error('invalid method name')
+
+    def _check_message_type(self, mtype):
+        if mtype < 1 or mtype > 4:
+            raise MessageScanner.Error('bad message type: %d' % mtype)
+
+    # binary protocol
+
+    def _binary_message(self, data, end):
+        pos = self._pos
+        if end - pos < 4:
+            return False
+
+        size, = unpack_from('!i', data, pos)
+        if size < 0:
+            if size & _BINARY_VERSION_MASK != _BINARY_VERSION_1:
+                raise MessageScanner.Error('bad version: %d' % size)
+            self._check_message_type(size & 0xff)
+            if end - pos < 8:
+                return False
+            name_len, = unpack_from('!i', data, pos + 4)
+            self._check_method(data, pos + 8, name_len, end)
+            header_len = 8 + name_len + 4
+        else:
+            name_len = size
+            self._check_method(data, pos + 4, name_len, end)
+            header_len = 4 + name_len + 1 + 4
+            if end - pos > 4 + name_len:
+                self._check_message_type(data[pos + 4 + name_len])
+
+        if end - pos < header_len:
+            return False
+
+        self._pos = pos + header_len
+        self._stack[-1] = [_STRUCT]
+        return True
+
+    def _binary_struct(self, data, end):
+        pos = self._pos
+        if pos >= end:
+            return False
+
+        ftype = data[pos]
+        if ftype == TType.STOP:
+            self._pos = pos + 1
+            self._stack.pop()
+            return True
+
+        if ftype not in _BINARY_TYPES:
+            raise MessageScanner.Error('bad field type: %d' % ftype)
+
+        if end - pos < 3:
+            return False
+
+        self._pos = pos + 3
+        self._stack.append([_VALUE, ftype])
+        return True
+
+    def _binary_value(self, data, end, task):
+        ttype = task[1]
+        pos = self._pos
+        width = _BINARY_WIDTHS.get(ttype)
+        if width is not None:
+            if end - pos < width:
+                return False
+            self._pos = pos + width
+            self._stack.pop()
+        elif ttype == TType.STRING:
+            if end - pos < 4:
+                return False
+            size, = unpack_from('!i', data, pos)
+            self._check_size(size, self._max_size, 'string')
+            if end - pos >= 4 + size:
+                self._pos = pos + 4 + size
+                self._stack.pop()
+            else:
+                # go through what we have of it
+                self._pos = pos + 4
+                self._stack[-1] = [_SKIP, size]
+        elif ttype == TType.STRUCT:
+            self._stack[-1] = [_STRUCT]
+        elif ttype == TType.LIST or ttype == TType.SET:
+            if end - pos < 5:
+                return False
+            etype = data[pos]
+            size, = unpack_from('!i', data, pos + 1)
+            self._check_types((etype,), _BINARY_TYPES)
+            self._check_size(size, self.MAX_ITEMS, 'container')
+            self._pos = pos + 5
+            self._stack[-1] = [_ITEMS, size, (etype,)]
+        elif ttype == TType.MAP:
+            if end - pos < 6:
+                return False
+            ktype, vtype = data[pos], data[pos + 1]
+            size, = unpack_from('!i', data, pos + 2)
+            self._check_types((ktype, vtype), _BINARY_TYPES)
+            self._check_size(size, self.MAX_ITEMS, 'container')
+            self._pos = pos + 6
+            self._stack[-1] = [_ITEMS, size, (ktype, vtype)]
+        else:
+            raise MessageScanner.Error('bad type: %d' % ttype)
+
+        return True
+
+    def _check_types(self, types, valid):
+        for ttype in types:
+            if ttype not in valid:
+                raise MessageScanner.Error('bad type: %d' % ttype)
+
+    # compact protocol
+
+    def _varint(self, data, pos, end):
+        """ (value, position after it) or None if it isn't all there """
+        result = shift = 0
+        while pos < end:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return result, pos
+            shift += 7
+            if shift > 63:
+                raise MessageScanner.Error('varint too long')
+        return None
+
+    def _compact_message(self, data, end):
+        pos = self._pos
+        if end - pos < 2:
+            return False
+
+        if data[pos] != _COMPACT_PROTOCOL_ID:
+            raise MessageScanner.Error('bad protocol id: %d' % data[pos])
+        if data[pos + 1] & 0x1f != _COMPACT_VERSION:
+            raise MessageScanner.Error('bad version: %d' % (data[pos + 1] & 0x1f))
+        self._check_message_type(data[pos + 1] >> 5)
+
+        seqid = self._varint(data, pos + 2, end)
+        if seqid is None:
+            return False
+        name_len = self._varint(data, seqid[1], end)
+        if name_len is None:
+            return False
+
+        name_len, name_pos = name_len
+        self._check_method(data, name_pos, name_len, end)
+        if end - name_pos < name_len:
+            return False
+
+        self._pos = name_pos + name_len
+        self._stack[-1] = [_STRUCT]
+        return True
+
+    def _compact_struct(self, data, end):
+        pos = self._pos
+        if pos >= end:
+            return False
+
+        header = data[pos]
+        if header == 0:  # STOP
+            self._pos = pos + 1
+            self._stack.pop()
+            return True
+
+        ctype = header & 0x0f
+        if ctype < _CT_BOOLEAN_TRUE or ctype > _CT_STRUCT:
+            raise MessageScanner.Error('bad field type: %d' % ctype)
+
+        pos += 1
+        if header >> 4 == 0:  # no delta, the field id follows
+            fid = self._varint(data, pos, end)
+            if fid is None:
+                return False
+            pos = fid[1]
+
+        self._pos = pos
+        if ctype != _CT_BOOLEAN_TRUE and ctype != _CT_BOOLEAN_FALSE:
+            # bools are all in the field header
+            self._stack.append([_VALUE, ctype])
+        return True
+
+    def _compact_value(self, data, end, task):
+        ctype = task[1]
+        pos = self._pos
+        width = _COMPACT_WIDTHS.get(ctype)
+        if width is not None:
+            if end - pos < width:
+                return False
+            self._pos = pos + width
+            self._stack.pop()
+        elif ctype in _COMPACT_VARINTS:
+            value = self._varint(data, pos, end)
+            if value is None:
+                return False
+            self._pos = value[1]
+            self._stack.pop()
+        elif ctype == _CT_BINARY:
+            size = self._varint(data, pos, end)
+            if size is None:
+                return False
+            size, pos = size
+            self._check_size(size, self._max_size, 'string')
+            if end - pos >= size:
+                self._pos = pos + size
+                self._stack.pop()
+            else:
+                self._pos = pos
+                self._stack[-1] = [_SKIP, size]
+        elif ctype == _CT_STRUCT:
+            self._stack[-1] = [_STRUCT]
+        elif ctype == _CT_LIST or ctype == _CT_SET:
+            if pos >= end:
+                return False
+            header = data[pos]
+            size, etype = header >> 4, header & 0x0f
+            pos += 1
+            if size == 15:
+                size = self._varint(data, pos, end)
+                if size is None:
+                    return False
+                size, pos = size
+            self._check_compact_types((etype,))
+            self._check_size(size, self.MAX_ITEMS, 'container')
+            self._pos = pos
+            self._stack[-1] = [_ITEMS, size, (etype,)]
+        elif ctype == _CT_MAP:
+            size = self._varint(data, pos, end)
+            if size is None:
+                return False
+            size, pos = size
+            self._check_size(size, self.MAX_ITEMS, 'container')
+            if size == 0:
+                self._pos = pos
+                self._stack.pop()
+                return True
+            if pos >= end:
+                return False
+            types = (data[pos] >> 4, data[pos] & 0x0f)
+            self._check_compact_types(types)
+            self._pos = pos + 1
+            self._stack[-1] = [_ITEMS, size, types]
+        else:
+            raise MessageScanner.Error('bad type: %d' % ctype)
+
+        return True
+
+    def _check_compact_types(self, types):
+        for ctype in types:
+            if ctype < _CT_BOOLEAN_TRUE or ctype > _CT_STRUCT:
+                raise MessageScanner.Error('bad type: %d' % ctype)
@@ -1,11 +1,13 @@
 from __future__ import print_function
 
-from collections import deque, namedtuple
+from collections import namedtuple
 from threading import Thread
 
 import time
 
-from .sniffer import Sniffer
+from .batch_queue import BLOCK, DROP_OLDEST, BatchQueue
+from .sharding import ShardedDispatcher
+from .sniffer import Dispatcher, RingCapture, Sniffer
 from .stream_handler import StreamHandler
 
 
@@ -21,9 +23,25 @@ MessageSnifferOptions = namedtuple('MessageSnifferOptions', [
     'max_message_size',
     'debug',
     'framed',
+    'capture_backend',
+    'workers',
+    'max_queued_packets',
+    'packet_queue_policy',
+    'queue_policy',
+    'trust_boundaries',
+    'quarantine_after',
+    'quarantine_timeout',
+    'header_only',
+    'max_skipped_size',
+    'lazy',
+    'ring_block_size',
+    'ring_blocks',
 ])
-# make framed optional for backward compatibility
-MessageSnifferOptions.__new__.__defaults__ = (False,)
+# make the options after max_message_size optional for backward compatibility
+MessageSnifferOptions.__new__.__defaults__ = (
+    False, 'auto', 0, 0, BLOCK, DROP_OLDEST, False, None,
+    Dispatcher.QUARANTINE_TIMEOUT, False, 64*1024*1024, False,
+    RingCapture.BLOCK_SIZE, RingCapture.BLOCK_NR)
 
 
 STOP_MESSAGE = object()
@@ -31,25 +49,64 @@ DONE_TUPLE = (None, None, None, STOP_MESSAGE)
 
 
 class MessageSniffer(Thread):
+
+    IDLE_TIMEOUT = 0.1  # secs
+
     def __init__(self, options, handler=None):
         self._options = options
         self._handlers = []
-        self._queue = deque(maxlen=options.max_queued)
+        self._queue = BatchQueue(options.max_queued, options.queue_policy)
+
+        # handlers that only look at the method, type & seqid (i.e.: the
+        # LatencyPrinter) say so, and the args aren't even read
+        header_only = (options.header_only or
+                       getattr(handler, 'header_only', False))
 
-        self._handler = StreamHandler(
-            self._queue,
+        # and the ones with an idl (i.e.: the PairedPrinter with --idl-file)
+        # get the args of its methods decoded by thrift's C extension
+        idl = getattr(handler, 'idl', None)
+
+        handler_options = dict(
             protocol=options.protocol,
             finagle_thrift=options.finagle_thrift,
             max_message_size=options.max_message_size,
             read_values=options.read_values,
             debug=options.debug,
-            framed=options.framed)
+            framed=options.framed,
+            trust_boundaries=options.trust_boundaries,
+            quarantine_after=options.quarantine_after,
+            header_only=header_only,
+            max_skipped_size=options.max_skipped_size,
+            idl=idl,
+            lazy=options.lazy)
+
+        if options.workers > 0:
+            # streams are handled in the worker processes, which also
+            # keep the stats we report in status()
+            packets = BatchQueue(
+                options.max_queued_packets, options.packet_queue_policy)
+            self._handler = ShardedDispatcher(
+                packets, self._queue, options.workers, handler_options,
+                options.quarantine_timeout)
+            stream_handler = None
+            dispatcher = self._handler
+        else:
+            self._handler = StreamHandler(self._queue, **handler_options)
+            stream_handler = self._handler
+            dispatcher = None
 
         self._sniffer = Sniffer(
             options.iface, options.port,
-            stream_handler=self._handler,
+            stream_handler=stream_handler,
             ip=options.ip,
-            offline=options.pcap_file)
+            offline=options.pcap_file,
+            capture_backend=options.capture_backend,
+            dispatcher=dispatcher,
+            max_queued=options.max_queued_packets,
+            queue_policy=options.packet_queue_policy,
+            quarantine_timeout=options.quarantine_timeout,
+            ring_block_size=options.ring_block_size,
+            ring_blocks=options.ring_blocks)
 
         self.add_handler(handler)
 
@@ -58,6 +115,8 @@ class MessageSniffer(Thread):
         self.start()
 
     def status(self):
+        dispatcher = self._sniffer.dispatcher
+        packet_queue = dispatcher.queue
         values = (
             self.is_alive(),
             len(self._queue),
@@ -65,9 +124,25 @@ class MessageSniffer(Thread):
             self._handler.unrecognized_streams,
             self._handler.seen_thrift_msgs,
             self._handler.pending_thrift_msgs,
+            self._handler.skipped_bytes,
+            self._handler.resyncs,
+            self._handler.oversized_msgs,
+            self._handler.oversized_bytes,
             self._sniffer.is_alive(),
             self._sniffer.pending_ip_packets,
-            self._sniffer.dispatcher.is_alive()
+            dispatcher.is_alive(),
+            dispatcher.active_streams,
+            dispatcher.closed_streams,
+            dispatcher.evicted_streams,
+            dispatcher.ignored_streams,
+            dispatcher.ignored_packets,
+            dispatcher.errors,
+            self._sniffer.dropped_ip_packets,
+            self._queue.dropped,
+            packet_queue.wakeups,
+            packet_queue.idle,
+            self._queue.wakeups,
+            self._queue.idle,
         )
         return """
 alive:                  %s
@@ -76,12 +151,39 @@ seen streams:           %d
 unrecognized streams:   %d
 seen thrift msgs:       %d
 pending thrift msgs:    %d
+skipped bytes:          %d
+resyncs:                %d
+oversized msgs:         %d
+oversized bytes:        %d
 sniffer alive:          %s
 pending ip packets:     %d
 dispatcher alive:       %s
+active streams:         %d
+closed streams:         %d
+evicted streams:        %d
+ignored streams:        %d
+ignored packets:        %d
+dispatch errors:        %d
+dropped ip packets:     %d
+dropped thrift msgs:    %d
+dispatcher wakeups:     %d
+dispatcher idle:        %d
+handlers wakeups:       %d
+handlers idle:          %d
 """ % values
 
     def add_handler(self, handler):
+        """
+        A handler is called with (timestamp, src, dst, msg) for each message,
+        and it should return False when it wants the sniffer to stop. If it
+        has a handle_batch() method, that's called instead with a list of
+        those tuples (again, returning False to stop).
+
+        A handler passed to the constructor with a true header_only
+        attribute gets messages with just their method, type & seqid. If
+        it has an idl attribute instead, the args of the methods in it are
+        decoded by thrift's C extension.
+        """
         if handler is None:
             return
 
@@ -91,8 +193,6 @@ dispatcher alive:       %s
         self._handlers.append(handler)
 
     def run(self):
-        opts = self._options
-        handler = self._handler
         sniffer = self._sniffer
 
         # main loop
@@ -103,34 +203,60 @@ dispatcher alive:       %s
             if not sniffer.is_alive() and len(self._queue) == 0:
                 break
 
-            try:
-                timestamp, src, dst, msg = self._queue.popleft()
-            except IndexError:
-                time.sleep(0.001)
-                continue
+            # wake up once in a while to check on the sniffer
+            msgs = self._queue.get_batch(timeout=self.IDLE_TIMEOUT)
 
-            if msg == STOP_MESSAGE:
-                break
+            for idx, (_, _, _, msg) in enumerate(msgs):
+                if msg is STOP_MESSAGE:
+                    msgs = msgs[:idx]
+                    running = False
+                    break
 
             # dispatch thrift messages to handlers
-            for handler in self._handlers:
+            if msgs and not self._dispatch(msgs):
+                running = False
+
+        # leaving... and whoever is blocked on a full queue gives up
+        self._queue.close()
+        if isinstance(self._handler, ShardedDispatcher):
+            self._handler.close()
+        else:
+            sniffer.dispatcher.stop(wait_for_stopped=True)
+
+        if len(self._queue):
+            print('%d messages left in the queue' % len(self._queue))
+
+        dropped_packets = self._sniffer.dropped_ip_packets
+        if dropped_packets or self._queue.dropped:
+            print('dropped %d ip packets and %d thrift messages' % (
+                dropped_packets, self._queue.dropped))
+
+    def _dispatch(self, msgs):
+        """ returns False if any of the handlers asked to stop """
+        for handler in self._handlers:
+            handle_batch = getattr(handler, 'handle_batch', None)
+            if handle_batch is not None:
                 try:
-                    rv = handler(timestamp, src, dst, msg)
-                    if not rv:
-                        running = False
-                        break
+                    if not handle_batch(msgs):
+                        return False
                 except Exception as ex:
                     print('handler exception: %s' % ex)
+                continue
 
-        # leaving...
-        if len(self._queue):
-            print('%d messages left in the queue' % len(self._queue))
+            for timestamp, src, dst, msg in msgs:
+                try:
+                    if not handler(timestamp, src, dst, msg):
+                        return False
+                except Exception as ex:
+                    print('handler exception: %s' % ex)
+
+        return True
 
     def stop(self, wait_for_stopped=False):
         if not self.is_alive():
             return
 
-        self._queue.append(DONE_TUPLE)
+        self._queue.append_control(DONE_TUPLE)
 
         if wait_for_stopped:
             while self.is_alive():
@@ -0,0 +1,207 @@
+"""
+A minimal pcap/pcapng reader for offline mode
+
+Walks the record headers of a (memory-mapped) capture file and yields the
+raw link layer frames, so they can be handed straight to the header
+decoder without going through scapy.
+
+See:
+
+https://wiki.wireshark.org/Development/LibpcapFileFormat
+https://www.ietf.org/archive/id/draft-tuexen-opsawg-pcapng-03.html
+"""
+
+import struct
+
+from scapy.utils import EDecimal
+
+try:
+    import mmap
+    HAS_MMAP = True
+except ImportError:
+    HAS_MMAP = False
+
+
+# link types we know how to decode
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# pcap magic numbers (as read in little endian)
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_MAGIC_USEC_SWAPPED = 0xd4c3b2a1
+PCAP_MAGIC_NSEC_SWAPPED = 0x4d3cb2a1
+
+# pcapng block types
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+
+
+class PcapFile(object):
+    """
+    A pcap or pcapng file. Allows iteration via standard iterator protocol,
+    yielding (timestamp, linktype, frame) tuples.
+
+    Ex:
+    >> for timestamp, linktype, frame in PcapFile(path):
+        print timestamp, len(frame)
+    """
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, file_name):
+        try:
+            fh = open(file_name, 'rb')
+        except IOError as ex:
+            raise PcapFile.Error('Could not open %s: %s' % (file_name, ex))
+
+        with fh:
+            try:
+                if HAS_MMAP:
+                    self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._data = fh.read()
+            except ValueError:
+                # mmap() refuses empty files
+                self._data = b''
+
+        if len(self._data) < 4:
+            raise PcapFile.Error('Not a pcap capture file (too short)')
+
+        magic, = struct.unpack_from('<I', self._data, 0)
+        if magic == PCAPNG_SHB:
+            self._records = self._read_pcapng
+        elif magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC,
+                       PCAP_MAGIC_USEC_SWAPPED, PCAP_MAGIC_NSEC_SWAPPED):
+            self._records = self._read_pcap
+        else:
+            raise PcapFile.Error('Not a pcap capture file (bad magic: %#x)' % magic)
+
+    def __iter__(self):
+        return self._records()
+
+    def close(self):
+        if HAS_MMAP and isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def _read_pcap(self):
+        data = self._data
+        size = len(data)
+
+        if size < 24:
+            raise PcapFile.Error('Not a pcap capture file (truncated header)')
+
+        magic, = struct.unpack_from('<I', data, 0)
+        endian = '<' if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC) else '>'
+        nsec = magic in (PCAP_MAGIC_NSEC, PCAP_MAGIC_NSEC_SWAPPED)
+        units = 1000000000 if nsec else 1000000
+
+        network, = struct.unpack_from(endian + 'I', data, 20)
+        linktype = network & 0x0fffffff  # the upper bits carry FCS info
+
+        record = struct.Struct(endian + 'IIII')
+        offset = 24
+        while offset + 16 <= size:
+            ts_sec, ts_frac, incl_len, _ = record.unpack_from(data, offset)
+            offset += 16
+            end = offset + incl_len
+            if end > size:
+                break  # truncated capture
+            yield self._timestamp(ts_sec * units + ts_frac, units), linktype, data[offset:end]
+            offset = end
+
+    def _read_pcapng(self):
+        data = self._data
+        size = len(data)
+
+        endian = '<'
+        block_header = struct.Struct(endian + 'II')
+        interfaces = []  # (linktype, units per second), reset on each section
+
+        offset = 0
+        while offset + 12 <= size:
+            btype, = struct.unpack_from('<I', data, offset)
+
+            if btype == PCAPNG_SHB:
+                # the byte order magic tells us the endianness of the section
+                bom, = struct.unpack_from('<I', data, offset + 8)
+                endian = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                block_header = struct.Struct(endian + 'II')
+                interfaces = []
+
+            btype, blen = block_header.unpack_from(data, offset)
+            if blen < 12 or offset + blen > size:
+                break  # truncated or corrupt capture
+
+            body = offset + 8
+            end = offset + blen - 4
+
+            if btype == PCAPNG_IDB:
+                linktype, = struct.unpack_from(endian + 'H', data, body)
+                units = self._if_tsresol(data, body + 8, end, endian)
+                interfaces.append((linktype, units))
+            elif btype == PCAPNG_EPB:
+                if_id, ts_high, ts_low, caplen, _ = struct.unpack_from(
+                    endian + 'IIIII', data, body)
+                if if_id < len(interfaces):
+                    linktype, units = interfaces[if_id]
+                    start = body + 20
+                    timestamp = self._timestamp((ts_high << 32) | ts_low, units)
+                    yield timestamp, linktype, data[start:start + caplen]
+            elif btype == PCAPNG_SPB:
+                # no timestamp and always from the first interface
+                if interfaces:
+                    origlen, = struct.unpack_from(endian + 'I', data, body)
+                    start = body + 4
+                    caplen = min(origlen, end - start)
+                    yield EDecimal(0), interfaces[0][0], data[start:start + caplen]
+            elif btype == PCAPNG_PB:
+                if_id, _, ts_high, ts_low, caplen, _ = struct.unpack_from(
+                    endian + 'HHIIII', data, body)
+                if if_id < len(interfaces):
+                    linktype, units = interfaces[if_id]
+                    start = body + 20
+                    timestamp = self._timestamp((ts_high << 32) | ts_low, units)
+                    yield timestamp, linktype, data[start:start + caplen]
+
+            offset += blen
+
+    @staticmethod
+    def _if_tsresol(data, offset, end, endian):
+        """ returns the if_tsresol (as units per second) of an IDB, defaults to usecs """
+        option = struct.Struct(endian + 'HH')
+        while offset + 4 <= end:
+            code, length = option.unpack_from(data, offset)
+            if code == PCAPNG_OPT_ENDOFOPT:
+                break
+            if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+                value = ord(data[offset + 4:offset + 5])
+                if value & 0x80:
+                    return 2 ** (value & 0x7f)
+                return 10 ** value
+            # options are padded to 32 bits
+            offset += 4 + ((length + 3) & ~3)
+
+        return 1000000
+
+    @staticmethod
+    def _timestamp(ticks, units):
+        """
+        Same timestamp type scapy's reader hands out, so that the deltas between
+        timestamps (i.e.: latencies) stay exact.
+        """
+        return EDecimal(ticks) / units
@@ -39,7 +39,7 @@ def print_color(s, color_id, output=sys.stdout):
 def print_msg(timestamp, src, dst, msg, format_opts,
               prefix='', indent=0, output=sys.stdout,
               idl_function=None):
-    timestr = fromtimestamp(timestamp).strftime('%H:%M:%S:%f')
+    timestr = fromtimestamp(float(timestamp)).strftime('%H:%M:%S:%f')
 
     def pretty(part):
         if format_opts.pretty_printer:
@@ -181,6 +181,9 @@ class PairedPrinter(object):
 
 class LatencyPrinter(object):
     """ Reports latencies for the seen (req, rep) pairs """
+
+    header_only = True  # the args aren't needed, so they aren't read
+
     def __init__(self, expected_calls, output=sys.stdout):
         # msgs by [src][dst][method_name][seqid]
         self._requests = defaultdict(
@@ -0,0 +1,317 @@
+""" Reassembles & decodes streams in worker processes, sharded by flow """
+
+from __future__ import print_function
+
+from collections import deque, namedtuple
+from multiprocessing import Process, Queue
+from six.moves.queue import Empty, Full
+from threading import Thread
+
+import sys
+
+from .batch_queue import BLOCK
+from .sniffer import Dispatcher
+from .stream_handler import StreamHandler
+
+
+WorkerStats = namedtuple('WorkerStats', [
+    'packets',
+    'closes',  # how many times all streams were closed
+    'seen_streams',
+    'recognized_streams',
+    'seen_thrift_msgs',
+    'active_streams',
+    'closed_streams',
+    'evicted_streams',
+    'skipped_bytes',
+    'resyncs',
+    'ignored_streams',
+    'ignored_packets',
+    'oversized_msgs',
+    'oversized_bytes',
+    'errors',  # packets (or closes) that blew up
+])
+
+EMPTY_STATS = WorkerStats(*[0] * len(WorkerStats._fields))
+
+
+def run_worker(worker_id, packets, results, handler_options,
+               quarantine_timeout=Dispatcher.QUARANTINE_TIMEOUT):
+    """
+    The worker process: owns the streams (and their StreamHandler contexts)
+    for its shard. Reads batches of (timestamp, TcpPacket) and replies with
+    (worker_id, [(timestamp, src, dst, msg), ...], stats) for each one.
+    An item with no packet means all the streams should be closed.
+    """
+    msgs = deque()
+    handler = StreamHandler(msgs, **handler_options)
+    dispatcher = Dispatcher(
+        None, start=False, quarantine_timeout=quarantine_timeout)
+    dispatcher.add_handler(handler)
+    debug = handler_options.get('debug', False)
+    npackets = 0
+    ncloses = 0
+    nerrors = 0
+
+    while True:
+        try:
+            batch = packets.get(timeout=Dispatcher.IDLE_TICK)
+        except Empty:
+            dispatcher.tick()
+            if not msgs:
+                continue
+            batch = []
+
+        if batch is None:
+            break
+
+        for timestamp, packet in batch:
+            try:
+                if packet is None:
+                    dispatcher.close_streams()
+                else:
+                    dispatcher.dispatch(timestamp, packet)
+            except Exception as ex:
+                nerrors += 1
+                if debug:
+                    print('dispatch exception: %s' % ex, file=sys.stderr)
+
+            # counted no matter what, the parent is join()ing on them
+            if packet is None:
+                ncloses += 1
+            else:
+                npackets += 1
+
+        stats = WorkerStats(
+            npackets,
+            ncloses,
+            handler.seen_streams,
+            handler.recognized_streams,
+            handler.seen_thrift_msgs,
+            dispatcher.active_streams,
+            dispatcher.closed_streams,
+            dispatcher.evicted_streams,
+            handler.skipped_bytes,
+            handler.resyncs,
+            dispatcher.ignored_streams,
+            dispatcher.ignored_packets,
+            handler.oversized_msgs,
+            handler.oversized_bytes,
+            nerrors)
+        results.put((worker_id, list(msgs), stats))
+        msgs.clear()
+
+
+class ShardedDispatcher(Thread):
+    """
+    Dispatches packets to worker processes
+
+    Each connection is hashed to one of the workers (both directions go to
+    the same one), so the worker that owns a stream sees all of its packets
+    in order. Decoded messages are appended to outqueue, just like a
+    StreamHandler would.
+
+    Each worker has room for as many packets as packet_queue (in batches).
+    Past that, unless packet_queue's policy is to block, batches are dropped
+    and counted in ``dropped_packets``.
+    """
+
+    BATCH_SIZE = 256
+    MIN_QUEUED_BATCHES = 4
+
+    def __init__(self, packet_queue, outqueue, workers, handler_options,
+                 quarantine_timeout=Dispatcher.QUARANTINE_TIMEOUT):
+        """
+        Params:
+            ``packet_queue``    The (timestamp, ip packet) BatchQueue to consume
+            ``outqueue``        Where (timestamp, src, dst, msg) tuples go
+            ``workers``         The number of worker processes
+            ``handler_options`` kwargs for each worker's StreamHandler
+            ``quarantine_timeout`` For how long workers ignore a stream
+                                once its StreamHandler gave up on it
+        """
+        super(ShardedDispatcher, self).__init__()
+        self.setDaemon(True)
+
+        if workers < 1:
+            raise ValueError('need at least one worker')
+
+        self._queue = packet_queue
+        self._outqueue = outqueue
+        self._results = Queue()
+        maxsize = 0
+        if packet_queue.maxlen is not None:
+            maxsize = max(self.MIN_QUEUED_BATCHES,
+                          packet_queue.maxlen // self.BATCH_SIZE)
+        self._packets = [Queue(maxsize) for _ in range(workers)]
+        self._batches = [[] for _ in range(workers)]
+        self._stats = [EMPTY_STATS] * workers
+        self._closes = 0
+        self._dropped_packets = 0
+        self._wants_stop = False
+
+        self._workers = [
+            Process(target=run_worker,
+                    args=(worker_id, packets, self._results, handler_options,
+                          quarantine_timeout))
+            for worker_id, packets in enumerate(self._packets)
+        ]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+        self._collector = Thread(target=self._collect)
+        self._collector.setDaemon(True)
+        self._collector.start()
+
+        self.start()
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def empty(self):
+        """ true when every packet has been processed & its msgs collected """
+        return self._queue.unfinished == 0
+
+    @property
+    def seen_streams(self):
+        return sum(stats.seen_streams for stats in self._stats)
+
+    @property
+    def recognized_streams(self):
+        return sum(stats.recognized_streams for stats in self._stats)
+
+    @property
+    def unrecognized_streams(self):
+        return self.seen_streams - self.recognized_streams
+
+    @property
+    def pending_thrift_msgs(self):
+        return len(self._outqueue)
+
+    @property
+    def seen_thrift_msgs(self):
+        return sum(stats.seen_thrift_msgs for stats in self._stats)
+
+    @property
+    def skipped_bytes(self):
+        return sum(stats.skipped_bytes for stats in self._stats)
+
+    @property
+    def resyncs(self):
+        return sum(stats.resyncs for stats in self._stats)
+
+    @property
+    def oversized_msgs(self):
+        return sum(stats.oversized_msgs for stats in self._stats)
+
+    @property
+    def oversized_bytes(self):
+        return sum(stats.oversized_bytes for stats in self._stats)
+
+    @property
+    def ignored_streams(self):
+        return sum(stats.ignored_streams for stats in self._stats)
+
+    @property
+    def ignored_packets(self):
+        return sum(stats.ignored_packets for stats in self._stats)
+
+    @property
+    def active_streams(self):
+        return sum(stats.active_streams for stats in self._stats)
+
+    @property
+    def closed_streams(self):
+        return sum(stats.closed_streams for stats in self._stats)
+
+    @property
+    def evicted_streams(self):
+        return sum(stats.evicted_streams for stats in self._stats)
+
+    @property
+    def errors(self):
+        return sum(stats.errors for stats in self._stats)
+
+    @property
+    def dropped_packets(self):
+        """ the ones that didn't fit in a worker's queue """
+        return self._dropped_packets
+
+    def add_handler(self, stream_handler):
+        if stream_handler is None:
+            return
+
+        raise ValueError('stream handlers run in the worker processes')
+
+    def run(self):
+        nworkers = len(self._workers)
+        while not self._wants_stop:
+            batch = self._queue.get_batch(timeout=Dispatcher.IDLE_TICK)
+            for timestamp, packet in batch:
+                if packet is None:
+                    # every worker needs to close its streams
+                    for batch in self._batches:
+                        batch.append((timestamp, None))
+                    continue
+
+                src, dst = (packet.src, packet.sport), (packet.dst, packet.dport)
+                flow = (src, dst) if src < dst else (dst, src)
+                worker_id = hash(flow) % nworkers
+
+                # memoryviews can't be pickled
+                packet = packet._replace(data=bytes(packet.data))
+
+                batch = self._batches[worker_id]
+                batch.append((timestamp, packet))
+                if len(batch) >= self.BATCH_SIZE:
+                    self._flush(worker_id)
+
+            # nothing else pending, so ship what we have
+            self._flush()
+
+    def _flush(self, worker_id=None):
+        worker_ids = range(len(self._batches)) if worker_id is None else [worker_id]
+        for worker_id in worker_ids:
+            batch = self._batches[worker_id]
+            if not batch:
+                continue
+            self._batches[worker_id] = []
+
+            # closing the streams must get through, even if it has to wait
+            block = (self._queue.policy == BLOCK or
+                     any(packet is None for _, packet in batch))
+            try:
+                self._packets[worker_id].put(batch, block)
+            except Full:
+                self._dropped_packets += len(batch)
+                self._queue.task_done(len(batch))
+
+    def _collect(self):
+        while True:
+            worker_id, msgs, stats = self._results.get()
+            self._outqueue.extend(msgs)
+            processed = stats.packets - self._stats[worker_id].packets
+
+            # closing all streams is done once all the workers did it
+            self._closes += stats.closes - self._stats[worker_id].closes
+            while self._closes >= len(self._workers):
+                self._closes -= len(self._workers)
+                processed += 1
+
+            self._stats[worker_id] = stats
+            self._queue.task_done(processed)
+
+    def close(self):
+        """ stops dispatching, and the workers """
+        self._wants_stop = True
+        if self.is_alive():
+            self._queue.wake_up()
+            self.join()
+
+        for packets in self._packets:
+            packets.put(None)
+        for worker in self._workers:
+            worker.join(1)
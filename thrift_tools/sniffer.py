@@ -3,12 +3,23 @@ from __future__ import print_function
 from collections import deque
 from threading import Lock, Thread
 
+import ctypes
+import heapq
 import logging
+import mmap
+import select
+import socket
+import struct
 import sys
 import time
 import traceback
 
-from .util import get_ip, get_ip_packet, to_bytes
+from .batch_queue import BLOCK, BatchQueue
+from .pcap_file import LINKTYPE_ETHERNET, PcapFile
+from .timing_wheel import TimingWheel
+from .util import decode_frame, format_addr, pack_ip
+
+import dpkt
 
 from scapy.sendrecv import sniff
 from scapy.config import conf as scapy_conf
@@ -17,20 +28,256 @@ from six.moves import intern
 scapy_conf.logLevel = logging.ERROR  # shush scappy
 
 
+CAPTURE_BACKENDS = ('auto', 'tpacket', 'scapy')
+
+# from linux/if_ether.h, linux/if_packet.h & asm-generic/socket.h
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+SO_ATTACH_FILTER = 26
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+PACKET_OUTGOING = 4
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [
+        ('code', ctypes.c_uint16),
+        ('jt', ctypes.c_uint8),
+        ('jf', ctypes.c_uint8),
+        ('k', ctypes.c_uint32),
+    ]
+
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [
+        ('len', ctypes.c_uint16),
+        ('filter', ctypes.POINTER(_SockFilter)),
+    ]
+
+
+def tcp_port_filter(port):
+    """
+    The classic BPF program for 'tcp port <port>' on ethernet frames, as
+    given by tcpdump -d (so we don't need libpcap to compile it). Returns a
+    list of (code, jt, jf, k) tuples, with relative jump offsets.
+    """
+    # (code, absolute jt, absolute jf, k)
+    program = [
+        (0x28, None, None, 12),         # 00: ldh [12]
+        (0x15, 2, 8, 0x86dd),           # 01: jeq #0x86dd (ipv6)
+        (0x30, None, None, 20),         # 02: ldb [20]
+        (0x15, 4, 19, 6),               # 03: jeq #0x6 (tcp)
+        (0x28, None, None, 54),         # 04: ldh [54]
+        (0x15, 18, 6, port),            # 05: jeq #port
+        (0x28, None, None, 56),         # 06: ldh [56]
+        (0x15, 18, 19, port),           # 07: jeq #port
+        (0x15, 9, 19, 0x800),           # 08: jeq #0x800 (ipv4)
+        (0x30, None, None, 23),         # 09: ldb [23]
+        (0x15, 11, 19, 6),              # 10: jeq #0x6 (tcp)
+        (0x28, None, None, 20),         # 11: ldh [20]
+        (0x45, 19, 13, 0x1fff),         # 12: jset #0x1fff (fragment)
+        (0xb1, None, None, 14),         # 13: ldxb 4*([14]&0xf)
+        (0x48, None, None, 14),         # 14: ldh [x + 14]
+        (0x15, 18, 16, port),           # 15: jeq #port
+        (0x48, None, None, 16),         # 16: ldh [x + 16]
+        (0x15, 18, 19, port),           # 17: jeq #port
+        (0x06, None, None, 0x40000),    # 18: ret #262144
+        (0x06, None, None, 0),          # 19: ret #0
+    ]
+
+    def rel(pc, target):
+        return 0 if target is None else target - pc - 1
+
+    return [(code, rel(pc, jt), rel(pc, jf), k)
+            for pc, (code, jt, jf, k) in enumerate(program)]
+
+
+class RingCapture(object):
+    """
+    A live capture via an AF_PACKET socket with a TPACKET_V3 ring
+
+    The kernel fills whole blocks of frames in a ring that's shared with us,
+    and a BPF filter drops everything that's not for our port before it gets
+    there. So there's no syscall, copy or scapy object per packet. Linux only.
+    """
+
+    # 4MB per capture (it's pinned), with room for 64KB packets on lo
+    BLOCK_SIZE = 1 << 18
+    BLOCK_NR = 16
+    FRAME_SIZE = 1 << 11
+    RETIRE_BLK_TOV = 50  # msecs before a partially filled block is handed over
+
+    # struct tpacket_block_desc: block_status, num_pkts, offset_to_first_pkt
+    _BLOCK_HDR = struct.Struct('=III')
+    _BLOCK_HDR_OFFSET = 8
+
+    # struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen,
+    #                      tp_len, tp_status, tp_mac
+    _PACKET_HDR = struct.Struct('=IIIIIIH')
+
+    # struct sockaddr_ll (sll_ifindex & sll_pkttype), right after the
+    # (TPACKET_ALIGN'ed) tpacket3_hdr
+    _SOCKADDR_LL = struct.Struct('=4xi2xB')
+    _SOCKADDR_LL_OFFSET = 48
+
+    _STATUS = struct.Struct('=I')
+
+    def __init__(self, iface, port, block_size=BLOCK_SIZE, block_nr=BLOCK_NR):
+        self._block_size = block_size
+        self._block_nr = block_nr
+        self._block = 0
+        self._lo_ifindex = self._loopback_ifindex()
+
+        self._sock = socket.socket(
+            socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            self._attach_filter(tcp_port_filter(port))
+            self._sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+
+            # struct tpacket_req3
+            req = struct.pack(
+                '=7I',
+                block_size,
+                block_nr,
+                self.FRAME_SIZE,
+                (block_size * block_nr) // self.FRAME_SIZE,
+                self.RETIRE_BLK_TOV,
+                0,  # sizeof_priv
+                0)  # feature_req_word
+            self._sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+
+            if iface:
+                self._sock.bind((iface, ETH_P_ALL))
+
+            self._ring = mmap.mmap(
+                self._sock.fileno(),
+                block_size * block_nr,
+                mmap.MAP_SHARED,
+                mmap.PROT_READ | mmap.PROT_WRITE)
+        except Exception:
+            self._sock.close()
+            raise
+
+        self._poll = select.poll()
+        self._poll.register(self._sock.fileno(), select.POLLIN | select.POLLERR)
+
+    @staticmethod
+    def available():
+        return hasattr(socket, 'AF_PACKET') and hasattr(select, 'poll')
+
+    @staticmethod
+    def _loopback_ifindex():
+        try:
+            return socket.if_nametoindex('lo')
+        except (AttributeError, OSError):
+            return None
+
+    def _attach_filter(self, program):
+        insns = (_SockFilter * len(program))(*program)
+        fprog = _SockFprog(len(program), insns)
+        self._sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))
+
+    def read_block(self, timeout=0.1):
+        """
+        Returns the (timestamp, frame) tuples of the next block handed over
+        by the kernel, or an empty list if there's none after timeout secs.
+
+        Like libpcap, what we send on the loopback is left out: it's also
+        received, so we'd see every packet twice.
+        """
+        ring = self._ring
+        offset = self._block * self._block_size
+        status_offset = offset + self._BLOCK_HDR_OFFSET
+
+        status, num_pkts, first = self._BLOCK_HDR.unpack_from(ring, status_offset)
+        if not status & TP_STATUS_USER:
+            self._poll.poll(int(timeout * 1000))
+            status, num_pkts, first = self._BLOCK_HDR.unpack_from(ring, status_offset)
+            if not status & TP_STATUS_USER:
+                return []
+
+        frames = []
+        unpack_from = self._PACKET_HDR.unpack_from
+        unpack_ll = self._SOCKADDR_LL.unpack_from
+        lo_ifindex = self._lo_ifindex
+        pkt = offset + first
+        for _ in range(num_pkts):
+            next_offset, sec, nsec, snaplen, _, _, mac = unpack_from(ring, pkt)
+            ifindex, pkttype = unpack_ll(ring, pkt + self._SOCKADDR_LL_OFFSET)
+            if pkttype != PACKET_OUTGOING or ifindex != lo_ifindex:
+                start = pkt + mac
+                frames.append((sec + nsec * 1e-9, ring[start:start + snaplen]))
+            pkt += next_offset
+
+        # hand the block back to the kernel
+        self._STATUS.pack_into(ring, status_offset, TP_STATUS_KERNEL)
+        self._block = (self._block + 1) % self._block_nr
+
+        return frames
+
+    def close(self):
+        self._poll.unregister(self._sock.fileno())
+        self._ring.close()
+        self._sock.close()
+
+
 class Stream(object):
-    """ A representation of a TCP stream. """
-    def __init__(self, src, dst):
-        self._packets = []
+    """
+    A representation of a TCP stream.
+
+    The endpoints are either ip:port strings or (packed addr, port) tuples,
+    which are only formatted when the src or dst are asked for.
+
+    Only the payload of the segments (and when it arrived) is kept, in a
+    FIFO of (timestamp, bytes) that the handlers consume via pop_data().
+
+    The stream is closed once all the bytes up to its FIN have been seen, or
+    right away on a RST.
+
+    Segments that arrive ahead of time are held in a (seq ordered) reorder
+    buffer until the missing bytes show up. If they don't, either because
+    the buffer grew past max_reorder_bytes or because we waited more than
+    max_reorder_delay secs, the hole is skipped and counted as a gap.
+    """
+
+    MAX_REORDER_BYTES = 256 * 1024
+    MAX_REORDER_DELAY = 1.0  # secs
+
+    def __init__(self, src, dst,
+                 max_reorder_bytes=MAX_REORDER_BYTES,
+                 max_reorder_delay=MAX_REORDER_DELAY):
+        self._segments = deque()  # (timestamp, payload)
         self._src = src
         self._dst = dst
         self._length = 0
         self._remaining = 0
-        self._next_seq_id = -1
+        self._next_seq_id = -1  # unwrapped, so it never goes back to 0
         self._lock_packets = Lock()
+        self._fin_seq_id = None
+        self._closed = False
+        self.last_seen = 0  # timestamp of the last packet
+
+        self._max_reorder_bytes = max_reorder_bytes
+        self._max_reorder_delay = max_reorder_delay
+        self._reorder = []  # heap of (unwrapped seq, arrival, timestamp, payload)
+        self._reorder_bytes = 0
+        self._reorder_since = None
+        self._arrivals = 0
+
+        self._out_of_order = 0
+        self._retransmitted = 0
+        self._gaps = 0
+        self._skipped = 0
 
     def __str__(self):
-        return '%s<->%s (length: %d, remaining: %d, seq_id: %d)' % (
-            self.src, self.dst, self.length, self.remaining, self._next_seq_id)
+        return ('%s<->%s (length: %d, remaining: %d, seq_id: %d, gaps: %d, '
+                'out of order: %d, retransmitted: %d)') % (
+            self.src, self.dst, self.length, self.remaining,
+            self._next_seq_id & 0xffffffff, self.gaps, self.out_of_order,
+            self.retransmitted)
 
     @property
     def length(self):
@@ -41,78 +288,284 @@ class Stream(object):
     def remaining(self):
         return self._remaining
 
+    @property
+    def closed(self):
+        """ a FIN (and everything before it) or a RST has been seen """
+        return self._closed
+
+    @property
+    def gaps(self):
+        """ holes in the stream that were skipped """
+        return self._gaps
+
+    @property
+    def skipped(self):
+        """ bytes lost in those holes """
+        return self._skipped
+
+    @property
+    def out_of_order(self):
+        """ segments that had to wait in the reorder buffer """
+        return self._out_of_order
+
+    @property
+    def retransmitted(self):
+        """ segments (or parts of) that we had already seen """
+        return self._retransmitted
+
     @property
     def src(self):
+        if type(self._src) is tuple:
+            self._src = intern(format_addr(*self._src))
         return self._src
 
     @property
     def dst(self):
+        if type(self._dst) is tuple:
+            self._dst = intern(format_addr(*self._dst))
         return self._dst
 
     def pop(self, nbytes):
-        """ pops packets with _at least_ nbytes of payload """
+        """ pops (timestamp, payload) segments with _at least_ nbytes """
         size = 0
         popped = []
+        segments = self._segments
         with self._lock_packets:
-            while size < nbytes:
-                try:
-                    packet = self._packets.pop(0)
-                    size += len(packet.data.data)
-                    self._remaining -= len(packet.data.data)
-                    popped.append(packet)
-                except IndexError:
-                    break
+            while size < nbytes and segments:
+                segment = segments.popleft()
+                size += len(segment[1])
+                popped.append(segment)
+            self._remaining -= size
         return popped
 
     def pop_data(self, nbytes):
-        """ similar to pop, but returns payload + last timestamp """
-        last_timestamp = 0
-        data = []
-        for packet in self.pop(nbytes):
-            last_timestamp = packet.timestamp
-            data.append(to_bytes(packet.data.data))
+        """
+        similar to pop, but returns the payload along with the timestamps
+        of its first & last segments: (data, first_timestamp, last_timestamp)
+        """
+        popped = self.pop(nbytes)
+        if not popped:
+            return b'', 0, 0
 
-        return b''.join(data), last_timestamp
+        if len(popped) == 1:
+            data = bytes(popped[0][1])
+        else:
+            data = b''.join([payload for _, payload in popped])
 
-    def push(self, ip_packet):
-        """ push the packet into the queue """
+        return data, popped[0][0], popped[-1][0]
 
-        data_len = len(ip_packet.data.data)
-        seq_id = ip_packet.data.seq
+    def push(self, timestamp, tcp_packet):
+        """
+        push the segment (a TcpPacket, or anything with seq, flags & data)
+        into the queue, returns True if there are new (contiguous) bytes to
+        be consumed
+        """
+        tcp_p = tcp_packet
+        data_len = len(tcp_p.data)
+        flags = tcp_p.flags
 
-        if data_len == 0:
-            self._next_seq_id = seq_id
+        if flags & dpkt.tcp.TH_RST:
+            self._closed = True
             return False
 
-        # have we seen this packet?
-        if self._next_seq_id != -1 and seq_id != self._next_seq_id:
+        if data_len == 0:
+            if flags & dpkt.tcp.TH_SYN:
+                # a new connection (maybe reusing the ports), start over
+                self._next_seq_id = tcp_p.seq + 1
+                self._fin_seq_id = None
+                self._closed = False
+                self._reset_reorder()
+            elif self._next_seq_id == -1:
+                self._next_seq_id = tcp_p.seq
+
+            if flags & dpkt.tcp.TH_FIN:
+                self._fin_seq_id = self._unwrap(tcp_p.seq)
+                self._check_fin()
             return False
 
-        self._next_seq_id = seq_id + data_len
+        if self._next_seq_id == -1:
+            self._next_seq_id = tcp_p.seq
+
+        seq_id = self._unwrap(tcp_p.seq)
+        if flags & dpkt.tcp.TH_FIN:
+            self._fin_seq_id = seq_id + data_len
+
+        payload = tcp_p.data
+        if seq_id > self._next_seq_id:
+            self._hold(seq_id, timestamp, payload)
+            appended = False
+        else:
+            appended = self._append(seq_id, timestamp, payload)
+            if appended:
+                self._drain_reorder()
+
+        appended = self._check_reorder_limits(timestamp) or appended
+        self._check_fin()
+
+        return appended
+
+    def _check_fin(self):
+        if self._fin_seq_id is not None and self._next_seq_id >= self._fin_seq_id:
+            self._closed = True
+
+    def _unwrap(self, seq):
+        """ maps a 32 bits seq number to the closest one to _next_seq_id """
+        delta = (seq - self._next_seq_id) & 0xffffffff
+        if delta >= 0x80000000:
+            delta -= 0x100000000
+        return self._next_seq_id + delta
+
+    def _append(self, seq_id, timestamp, payload):
+        """ appends the bytes that we haven't seen yet, if any """
+        seen = self._next_seq_id - seq_id
+        if seen > 0:
+            self._retransmitted += 1
+            if seen >= len(payload):
+                return False
+            payload = payload[seen:]
+
+        data_len = len(payload)
+        self._next_seq_id += data_len
 
         with self._lock_packets:
-            # Note: we only account for payload (i.e.: tcp data)
-            self._length += len(ip_packet.data.data)
-            self._remaining += len(ip_packet.data.data)
+            self._length += data_len
+            self._remaining += data_len
 
-            self._packets.append(ip_packet)
+            self._segments.append((timestamp, payload))
 
         return True
 
+    def _hold(self, seq_id, timestamp, payload):
+        if not self._reorder:
+            self._reorder_since = timestamp
+        self._out_of_order += 1
+        self._reorder_bytes += len(payload)
+        self._arrivals += 1
+        heapq.heappush(
+            self._reorder, (seq_id, self._arrivals, timestamp, payload))
+
+    def _drain_reorder(self):
+        """ moves the segments that are now contiguous out of the buffer """
+        reorder = self._reorder
+        appended = False
+        while reorder and reorder[0][0] <= self._next_seq_id:
+            seq_id, _, timestamp, payload = heapq.heappop(reorder)
+            self._reorder_bytes -= len(payload)
+            appended = self._append(seq_id, timestamp, payload) or appended
+
+        if not reorder:
+            self._reorder_since = None
+
+        return appended
+
+    def _check_reorder_limits(self, timestamp):
+        """ skips the hole at the head of the buffer, if we waited enough """
+        if not self._reorder:
+            return False
+
+        too_big = self._reorder_bytes > self._max_reorder_bytes
+        too_late = timestamp - self._reorder_since > self._max_reorder_delay
+        if not too_big and not too_late:
+            return False
+
+        seq_id = self._reorder[0][0]
+        self._gaps += 1
+        self._skipped += seq_id - self._next_seq_id
+        self._next_seq_id = seq_id
+        appended = self._drain_reorder()
+        if self._reorder:
+            # the clock starts again for the next hole
+            self._reorder_since = timestamp
+
+        return appended
+
+    def _reset_reorder(self):
+        self._reorder = []
+        self._reorder_bytes = 0
+        self._reorder_since = None
+
 
 class Dispatcher(Thread):
-    """Dispatches streams to handlers """
-    def __init__(self, packet_queue):
+    """
+    Dispatches streams to handlers
+
+    Handlers are called with the stream each time it has new bytes. If they
+    have a close_stream() method, that gets called too when the stream is
+    closed (FIN/RST) or evicted because it's been idle for idle_timeout
+    secs, and after that the stream is forgotten.
+
+    If all the handlers have an ignore_stream() method and it returns True
+    for a stream (i.e.: it's not Thrift), the stream is closed and its
+    packets are discarded from then on, until it's closed on the other end
+    or quarantine_timeout secs go by.
+    """
+
+    IDLE_TIMEOUT = 120  # secs
+    IDLE_TICK = 1.0  # secs
+    QUARANTINE_TIMEOUT = 600  # secs
+
+    # appended to the packet queue to close all the streams (i.e.: at the
+    # end of a pcap file)
+    CLOSE_STREAMS = (None, None)
+
+    def __init__(self, packet_queue, start=True, idle_timeout=IDLE_TIMEOUT,
+                 quarantine_timeout=QUARANTINE_TIMEOUT):
         super(Dispatcher, self).__init__()
         self.setDaemon(True)
         self._queue = packet_queue
         self._streams = {}
+        self._ignored = {}  # quarantined stream keys -> until when
         self._handlers = []
-        self.start()
+        self._idle_timeout = idle_timeout
+        self._quarantine_timeout = quarantine_timeout
+        self._wheel = TimingWheel(tick=self.IDLE_TICK)
+        self._last_timestamp = None
+        self._last_walltime = None
+        self._closed_streams = 0
+        self._evicted_streams = 0
+        self._ignored_packets = 0
+        self._errors = 0
+        self._wants_stop = False
+        if start:
+            self.start()
+
+    @property
+    def queue(self):
+        return self._queue
 
     @property
     def empty(self):
-        return len(self._queue) == 0
+        """ true when all the queued packets have been dispatched """
+        return self._queue.unfinished == 0
+
+    @property
+    def active_streams(self):
+        return len(self._streams)
+
+    @property
+    def closed_streams(self):
+        """ streams closed via FIN/RST (or at the end of the capture) """
+        return self._closed_streams
+
+    @property
+    def evicted_streams(self):
+        """ streams forgotten after being idle for too long """
+        return self._evicted_streams
+
+    @property
+    def ignored_streams(self):
+        """ streams currently in quarantine """
+        return len(self._ignored)
+
+    @property
+    def ignored_packets(self):
+        """ packets discarded because their stream was in quarantine """
+        return self._ignored_packets
+
+    @property
+    def errors(self):
+        """ packets (or closes) the handlers blew up on """
+        return self._errors
 
     def add_handler(self, stream_handler):
         if stream_handler is None:
@@ -125,43 +578,156 @@ class Dispatcher(Thread):
 
     def run(self, *args, **kwargs):
         """ Deal with the incoming packets """
-        while True:
-            try:
-                timestamp, ip_p = self._queue.popleft()
+        while not self._wants_stop:
+            batch = self._queue.get_batch(timeout=self.IDLE_TICK)
+
+            if not batch:
+                self.tick()
+                continue
+
+            for timestamp, packet in batch:
+                try:
+                    if packet is None:
+                        self.close_streams()
+                    else:
+                        self.dispatch(timestamp, packet)
+                except Exception:
+                    self._errors += 1
+            self._queue.task_done(len(batch))
+
+    def stop(self, wait_for_stopped=False):
+        """ the thread exits once it's done with the batch at hand """
+        if not self.is_alive():
+            return
+
+        self._wants_stop = True
+        self._queue.wake_up()
 
-                src_ip = get_ip(ip_p, ip_p.src)
-                dst_ip = get_ip(ip_p, ip_p.dst)
+        if wait_for_stopped:
+            while self.is_alive():
+                time.sleep(0.01)
 
-                src = intern('%s:%s' % (src_ip, ip_p.data.sport))
-                dst = intern('%s:%s' % (dst_ip, ip_p.data.dport))
-                key = intern('%s<->%s' % (src, dst))
+    def dispatch(self, timestamp, tcp_p):
+        """ push the TcpPacket into its stream, and let the handlers know """
+        key = (tcp_p.src, tcp_p.sport, tcp_p.dst, tcp_p.dport)
+
+        now = float(timestamp)
+        self._last_timestamp = now
+        self._last_walltime = time.time()
+        self.expire(now)
+
+        if key in self._ignored:
+            if self._ignored[key] > now:
+                self._ignored_packets += 1
+                if tcp_p.flags & (dpkt.tcp.TH_FIN | dpkt.tcp.TH_RST):
+                    del self._ignored[key]  # the next one gets a chance
+                return
+            del self._ignored[key]
+
+        stream = self._streams.get(key)
+        if stream is None:
+            if not tcp_p.data and not tcp_p.flags & dpkt.tcp.TH_SYN:
+                return  # i.e.: the trailing ACKs of a closed stream
+
+            stream = Stream(key[:2], key[2:])
+            self._streams[key] = stream
+            self._wheel.schedule((key, stream), now + self._idle_timeout)
+
+        stream.last_seen = now
+        pushed = stream.push(timestamp, tcp_p)
+
+        if pushed:
+            # let listeners know about the updated stream
+            for handler in self._handlers:
+                try:
+                    handler(stream)
+                except Exception as ex:
+                    print('handler exception: %s' % ex)
+
+            if self._ignores(stream):
+                self._close_stream(key, stream)
+                self._ignored[key] = now + self._quarantine_timeout
+                self._wheel.schedule((key, None), self._ignored[key])
+                return
 
-                stream = self._streams.get(key)
-                if stream is None:
-                    stream = Stream(src, dst)
-                    self._streams[key] = stream
+        if stream.closed:
+            self._close_stream(key, stream)
+            self._closed_streams += 1
+
+            # a RST tears down both directions
+            if tcp_p.flags & dpkt.tcp.TH_RST:
+                reverse_key = key[2:] + key[:2]
+                reverse = self._streams.get(reverse_key)
+                if reverse is not None:
+                    self._close_stream(reverse_key, reverse)
+                    self._closed_streams += 1
+
+    def tick(self):
+        """ no traffic, but idle streams still need to be evicted """
+        if self._last_timestamp is not None:
+            elapsed = time.time() - self._last_walltime
+            self.expire(self._last_timestamp + elapsed)
+
+    def expire(self, now):
+        """ evicts the streams that have been idle for too long """
+        for key, stream in self._wheel.advance(now):
+            if stream is None:
+                # out of quarantine, unless it was let out & put back in
+                until = self._ignored.get(key)
+                if until is not None and until <= now:
+                    del self._ignored[key]
+                continue
+
+            if self._streams.get(key) is not stream:
+                continue  # already closed
+
+            deadline = stream.last_seen + self._idle_timeout
+            if deadline > now:
+                self._wheel.schedule((key, stream), deadline)
+                continue
+
+            self._close_stream(key, stream)
+            self._evicted_streams += 1
+
+    def close_streams(self):
+        """ closes all the streams, flushing whatever they have left """
+        for key, stream in list(self._streams.items()):
+            self._close_stream(key, stream)
+            self._closed_streams += 1
+
+    def _ignores(self, stream):
+        """ True if every handler wants the stream ignored """
+        if not self._handlers:
+            return False
 
-                # HACK: save the timestamp
-                setattr(ip_p, 'timestamp', timestamp)
-                pushed = stream.push(ip_p)
+        for handler in self._handlers:
+            ignore_stream = getattr(handler, 'ignore_stream', None)
+            if ignore_stream is None or not ignore_stream(stream):
+                return False
+        return True
 
-                if not pushed:
-                    continue
+    def _close_stream(self, key, stream):
+        del self._streams[key]
 
-                # let listeners know about the updated stream
-                for handler in self._handlers:
-                    try:
-                        handler(stream)
-                    except Exception as ex:
-                        print('handler exception: %s' % ex)
+        for handler in self._handlers:
+            close_stream = getattr(handler, 'close_stream', None)
+            if close_stream is None:
+                continue
+            try:
+                close_stream(stream)
             except Exception as ex:
-                time.sleep(0.00001)
+                print('handler exception: %s' % ex)
 
 
 class Sniffer(Thread):
     """ A generic & simple packet sniffer """
 
-    def __init__(self, iface, port, stream_handler=None, offline=None, ip=None):
+    def __init__(self, iface, port, stream_handler=None, offline=None, ip=None,
+                 capture_backend='auto', dispatcher=None, max_queued=None,
+                 queue_policy=BLOCK,
+                 quarantine_timeout=Dispatcher.QUARANTINE_TIMEOUT,
+                 ring_block_size=RingCapture.BLOCK_SIZE,
+                 ring_blocks=RingCapture.BLOCK_NR):
         """A Sniffer that merges packets into a stream
 
         Params:
@@ -170,16 +736,47 @@ class Sniffer(Thread):
             ``stream_handler``  The callback for each stream
             ``offline``         Path to a pcap file
             ``ip``              A list of IPs that we care about
+            ``capture_backend`` For live sniffing: tpacket, scapy or auto
+                                (tpacket if available, scapy otherwise)
+            ``dispatcher``      The (running) thread that consumes the
+                                packets from its queue, a Dispatcher if None
+            ``max_queued``      Max number of pending packets for the
+                                Dispatcher, unbounded if None
+            ``queue_policy``    What to do with new packets once that's
+                                reached (see batch_queue.QUEUE_POLICIES)
+            ``quarantine_timeout`` For how long the Dispatcher ignores a
+                                stream once its handlers gave up on it
+            ``ring_block_size`` The size of the blocks of the TPACKET_V3
+                                ring, a multiple of the page size
+            ``ring_blocks``     How many blocks the ring has
         """
         super(Sniffer, self).__init__()
         self.setDaemon(True)
 
+        if capture_backend not in CAPTURE_BACKENDS:
+            raise ValueError('Unknown capture backend: %s' % capture_backend)
+
+        if ring_block_size <= 0 or ring_block_size % mmap.PAGESIZE:
+            raise ValueError('Ring block size must be a multiple of %d: %d' % (
+                mmap.PAGESIZE, ring_block_size))
+
+        if ring_blocks <= 0:
+            raise ValueError('Invalid number of ring blocks: %d' % ring_blocks)
+
         self._iface = iface
         self._port = port
         self._offline = offline
-        self._ip = ip if ip else []
-        self._queue = deque()  # TODO: maxlen?
-        self._dispatcher = Dispatcher(self._queue)
+        # compared against the packets' addresses, so no need to format them
+        self._ip = frozenset(pack_ip(addr) for addr in ip) if ip else None
+        self._capture_backend = capture_backend
+        self._ring_block_size = ring_block_size
+        self._ring_blocks = ring_blocks
+        if dispatcher is None:
+            dispatcher = Dispatcher(
+                BatchQueue(max_queued, queue_policy),
+                quarantine_timeout=quarantine_timeout)
+        self._dispatcher = dispatcher
+        self._queue = dispatcher.queue
 
         self._dispatcher.add_handler(stream_handler)
 
@@ -195,24 +792,24 @@ class Sniffer(Thread):
     def pending_ip_packets(self):
         return len(self._queue)
 
+    @property
+    def dropped_ip_packets(self):
+        # plus those that didn't fit in a ShardedDispatcher's workers
+        return (self._queue.dropped +
+                getattr(self._dispatcher, 'dropped_packets', 0))
+
     def add_handler(self, stream_handler):
         self._dispatcher.add_handler(stream_handler)
 
     def run(self):
-        pfilter = 'port %d' % self._port
         try:
-            kwargs = {
-                'filter': pfilter,
-                'store': 0,
-                'prn': self._handle_packet,
-                'iface': self._iface,
-                'stop_filter': lambda p: self._wants_stop,
-                }
-
             if self._offline:
-                kwargs['offline'] = self._offline
-
-            sniff(**kwargs)
+                self._read_offline()
+            else:
+                self._sniff()
+        except PcapFile.Error as ex:
+            print('%s is not a valid pcap file: %s' % (self._offline, ex))
+            return
         except Exception as ex:
             if 'Not a pcap capture file' in str(ex):
                 print('%s is not a valid pcap file' % self._offline)
@@ -220,9 +817,61 @@ class Sniffer(Thread):
             print('Error: %s: %s (device: %s)' % (ex, traceback.format_exc(), self._iface))
         finally:
             if self._offline:
-                # drain dispatcher
-                while not self._dispatcher.empty:
-                    time.sleep(0.1)
+                # flush what's left in the streams & drain dispatcher,
+                # unless it was stopped already
+                self._queue.append_control(Dispatcher.CLOSE_STREAMS)
+                while not self._queue.join(Dispatcher.IDLE_TICK):
+                    if not self._dispatcher.is_alive():
+                        break
+
+    def _sniff(self):
+        capture = None
+        if self._capture_backend != 'scapy':
+            try:
+                if not RingCapture.available():
+                    raise OSError('AF_PACKET sockets are not available')
+                capture = RingCapture(
+                    self._iface, self._port,
+                    self._ring_block_size, self._ring_blocks)
+            except (OSError, socket.error) as ex:
+                if self._capture_backend == 'tpacket':
+                    raise
+                print('TPACKET_V3 capture not available (%s), using scapy' % ex,
+                      file=sys.stderr)
+
+        if capture is not None:
+            self._read_ring(capture)
+            return
+
+        kwargs = {
+            'filter': 'port %d' % self._port,
+            'store': 0,
+            'prn': self._handle_packet,
+            'iface': self._iface,
+            'stop_filter': lambda p: self._wants_stop,
+            }
+
+        sniff(**kwargs)
+
+    def _read_ring(self, capture):
+        try:
+            while not self._wants_stop:
+                for timestamp, frame in capture.read_block():
+                    self._handle_frame(timestamp, frame)
+        finally:
+            capture.close()
+
+    def _read_offline(self):
+        """ reads the frames straight from the pcap file, no scapy involved """
+        pcap_file = PcapFile(self._offline)
+        try:
+            for timestamp, linktype, frame in pcap_file:
+                if self._wants_stop:
+                    break
+
+                self._handle_frame(timestamp, frame, linktype)
+        finally:
+            pcap_file.close()
 
     def stop(self, wait_for_stopped=False):
         if not self.is_alive():
@@ -235,23 +884,18 @@ class Sniffer(Thread):
                 time.sleep(0.01)
 
     def _handle_packet(self, packet):
-        try:
-            ip_p = get_ip_packet(packet.load, 0, self._port)
-        except ValueError:
-            return
+        self._handle_frame(packet.time, packet.load)
 
-        ip_data = getattr(ip_p, 'data', None)
-        if ip_data is None:
+    def _handle_frame(self, timestamp, frame, linktype=LINKTYPE_ETHERNET):
+        tcp_p = decode_frame(frame, linktype)
+        if tcp_p is None:
             return
 
-        if ip_data.sport != self._port and ip_data.dport != self._port:
+        if tcp_p.sport != self._port and tcp_p.dport != self._port:
             return
 
-        if self._ip:
-            src_ip = get_ip(ip_p, ip_p.src)
-            dst_ip = get_ip(ip_p, ip_p.dst)
-
-            if src_ip not in self._ip and dst_ip not in self._ip:
+        if self._ip is not None:
+            if tcp_p.src not in self._ip and tcp_p.dst not in self._ip:
                 return
 
-        self._queue.append((packet.time, ip_p))
+        self._queue.append((timestamp, tcp_p))
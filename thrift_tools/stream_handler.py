@@ -2,21 +2,120 @@
 
 from __future__ import print_function
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import sys
 import traceback
-from struct import unpack
+from struct import unpack_from
 
+from .message_scanner import MessageScanner
 from .thrift_message import ThriftMessage
 
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+
 
 class StreamContext(object):
+    """
+    The bytes of a stream that haven't been consumed yet, along with the
+    timestamps of the segments they came in.
+
+    They live in a bytearray with an offset to where the unconsumed part
+    starts, and the consumed part is only dropped once it's at least as big
+    as what's left. So appending & consuming are linear, instead of copying
+    the whole buffer each time.
+
+    Decoders get a memoryview via view(), which mustn't outlive the handler
+    call (the bytearray can't be resized while there are views of it).
+
+    Once a message is read, it also keeps what the stream turned out to
+    carry (protocol, framing & finagle-thrift header) so the following
+    messages are read that way instead of detecting everything again.
+    """
+
+    FINAGLE_UPGRADE = '__can__finagle__trace__v3__'
+
     def __init__(self):
-        self.bytes = b''
+        self._buffer = bytearray()
+        self._offset = 0
+        self._appended = 0  # total bytes appended, to track segments
+        self._timestamps = deque()  # (end of segment, its timestamp)
+        self.timestamp = 0  # of the last segment
+        self.frame_checked = False  # the frame at the start of bytes looks ok
+        self.scanner = None  # for the incomplete message at the start of bytes
+        self.oversized = None  # a message too big to keep, being skipped
+        self.skip = 0  # bytes of it that are still to come, if we know
+
+        # learned from the messages read so far, None means we don't know yet
+        self.protocol = None
+        self.framed = None
+        self.finagle_header = None
+        self.failures = 0  # to read a message, since the last one
+        self.unrecognized = 0  # bytes since the last message
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def append(self, data, timestamp):
+        if self._offset and self._offset >= len(self._buffer) - self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+        self._appended += len(data)
+        self._timestamps.append((self._appended, timestamp))
+        self.timestamp = timestamp
+
+    def consume(self, nbytes):
+        self._offset = min(self._offset + nbytes, len(self._buffer))
+
+        consumed = self._appended - len(self)
+        timestamps = self._timestamps
+        while timestamps and timestamps[0][0] <= consumed:
+            timestamps.popleft()
+
+    def timestamp_at(self, nbytes):
+        """ the timestamp of the segment that brought the nbytes-th byte """
+        position = self._appended - len(self) + nbytes
+        for end, timestamp in self._timestamps:
+            if end >= position:
+                return timestamp
+        return self.timestamp
+
+    def clear(self):
+        self._buffer = bytearray()
+        self._offset = 0
+        self._timestamps.clear()
+        self.frame_checked = False
+        self.scanner = None
+        self.oversized = None
+        self.skip = 0
+
+    def view(self):
+        return memoryview(self._buffer)[self._offset:]
+
+    def learn(self, protocol, msg, framed=None):
+        """ a message was read, so this is what the stream looks like """
+        self.failures = 0
+        if msg.method == self.FINAGLE_UPGRADE:
+            # sent without a header, before the calls that have one
+            return
+        if self.protocol is None:
+            self.protocol = protocol
+            self.finagle_header = msg.header is not None
+        if self.framed is None:
+            self.framed = framed
+
+    def forget(self):
+        """ back to detecting what the stream carries """
+        self.protocol = None
+        self.framed = None
+        self.finagle_header = None
+        self.failures = 0
 
 
 class StreamHandler(object):
+
+    MAX_FAILURES = 3  # in a row, before a stream's protocol is detected again
+
     def __init__(self,
                  outqueue,
                  protocol=None,
@@ -24,9 +123,32 @@ class StreamHandler(object):
                  max_message_size=1024*1000,
                  read_values=False,
                  debug=False,
-                 framed=False):
+                 framed=False,
+                 trust_boundaries=False,
+                 quarantine_after=None,
+                 header_only=False,
+                 max_skipped_size=64*1024*1024,
+                 idl=None,
+                 lazy=False):
+        """
+        Params:
+            ``quarantine_after``  Bytes without a message after which the
+                                  stream is ignored, 4 * max_message_size
+                                  if None and never if 0
+            ``header_only``       Only read the messages' method, type &
+                                  seqid (i.e.: for stats), not their args
+            ``max_skipped_size``  Messages bigger than max_message_size (up
+                                  to this) are only read up to their seqid
+                                  and the rest is skipped, 0 to drop them
+            ``idl``               An Idl (from idl.parse_idl_file()), the
+                                  args of its methods are decoded by
+                                  thrift's C extension (with read_values)
+            ``lazy``              The args of binary & compact messages are
+                                  only decoded when they are first accessed
+                                  (see decoders.LazyThriftStruct)
+        """
         self._contexts_by_streams = defaultdict(StreamContext)
-        self._pop_size = 1024  # TODO: what's a good value here?
+        self._pop_size = 1024  # at least, we pop whatever is queued
         self._outqueue = outqueue
         self._protocol = protocol
         self._finagle_thrift = finagle_thrift
@@ -34,19 +156,39 @@ class StreamHandler(object):
         self._debug = debug
         self._framed = framed
         self._read_values = read_values
+        self._trust_boundaries = trust_boundaries
+        self._header_only = header_only
+        self._max_skipped_size = max_skipped_size
+        self._idl = idl
+        self._lazy = lazy
+        if quarantine_after is None:
+            quarantine_after = 4 * max_message_size
+        self._quarantine_after = quarantine_after
         self._seen_messages = 0
+        self._skipped_bytes = 0  # of recognized streams, between messages
+        self._resyncs = 0
+        self._oversized_msgs = 0
+        self._oversized_bytes = 0  # skipped instead of buffered
         self._recognized_streams = set()  # streams from which msgs have been read
 
+        # closed streams are forgotten, we only keep count of them
+        self._closed_streams = 0
+        self._closed_recognized_streams = 0
+
     def __call__(self, *args, **kwargs):
         self.handler(*args, **kwargs)
 
     @property
-    def seen_streams(self):
+    def active_streams(self):
         return len(self._contexts_by_streams)
 
+    @property
+    def seen_streams(self):
+        return self.active_streams + self._closed_streams
+
     @property
     def recognized_streams(self):
-        return len(self._recognized_streams)
+        return len(self._recognized_streams) + self._closed_recognized_streams
 
     @property
     def unrecognized_streams(self):
@@ -60,60 +202,541 @@ class StreamHandler(object):
     def seen_thrift_msgs(self):
         return self._seen_messages
 
+    @property
+    def skipped_bytes(self):
+        """ bytes of recognized streams that weren't part of any message """
+        return self._skipped_bytes
+
+    @property
+    def resyncs(self):
+        """ times a recognized stream had to be skipped ahead on """
+        return self._resyncs
+
+    @property
+    def oversized_msgs(self):
+        """ messages bigger than max_message_size, which were skipped """
+        return self._oversized_msgs
+
+    @property
+    def oversized_bytes(self):
+        """ bytes of oversized messages that were skipped """
+        return self._oversized_bytes
+
+    def close_stream(self, stream):
+        """ extracts the messages left in the stream, and forgets about it """
+        if stream not in self._contexts_by_streams:
+            if stream.remaining == 0:
+                return
+            self._contexts_by_streams[stream]  # so it gets counted
+
+        self.handler(stream)
+
+        del self._contexts_by_streams[stream]
+        self._closed_streams += 1
+
+        if stream in self._recognized_streams:
+            self._recognized_streams.remove(stream)
+            self._closed_recognized_streams += 1
+
+    def ignore_stream(self, stream):
+        """ True if it's been too long since the last message in stream """
+        context = self._contexts_by_streams.get(stream)
+        if context is None or not self._quarantine_after:
+            return False
+        return context.unrecognized >= self._quarantine_after
+
     def handler(self, stream):
+        """ reads all the complete messages out of what's queued in stream """
         context = self._contexts_by_streams[stream]
-        bytes, timestamp = stream.pop_data(self._pop_size)
-        context.bytes += bytes
+        while stream.remaining:
+            # take everything, as long as it fits in a message
+            room = max(self._pop_size, self._max_message_size - len(context))
+            for timestamp, payload in stream.pop(min(stream.remaining, room)):
+                if context.skip:
+                    payload = self._skip(stream, context, payload, timestamp)
+                context.append(payload, timestamp)
+                if context.oversized is None:
+                    context.unrecognized += len(payload)
+            seen_messages = self._seen_messages
 
-        # EMSGSIZE
-        if len(context.bytes) >= self._max_message_size:
-            if self._debug:
-                print('Dropping bytes, dropped size: %d' % len(context.bytes))
-            context.bytes = ''
-            return
+            # switch over right away when the stream turns out (not) to be
+            # framed, each switch comes after consuming something
+            framed = None
+            while framed is not self._is_framed(context):
+                framed = self._is_framed(context)
+                if framed:
+                    self._read_frames(stream, context)
+                else:
+                    self._read_messages(stream, context)
 
-        # FIXME: a bit of brute force to find the start of a message.
-        #        Is there a magic byte/string we can look for?
+            if self._seen_messages != seen_messages:
+                context.unrecognized = len(context)
 
-        start = 0
+            # EMSGSIZE
+            if context.oversized is not None or (
+                    len(context) >= self._max_message_size and
+                    self._start_skipping(context)):
+                self._skip_scanned(context)
+            elif len(context) >= self._max_message_size:
+                if self._debug:
+                    print('Dropping bytes, dropped size: %d' % len(context))
+                context.clear()
 
-        if self._framed:
-            if len(context.bytes) == 4: # just frame size, no frame
-                return
+    def _read_messages(self, stream, context):
+        """
+        Reads the messages in the buffer. A (binary or compact) message that
+        isn't complete yet is left to a MessageScanner, which carries on
+        from where it was when more bytes arrive instead of reading the
+        message (and trying everything after it) all over again.
 
-            frame_size = unpack('!i', context.bytes[:4])[0]
+        With trust_boundaries, the next message of a recognized stream is
+        only tried where the last one ended, we look for it elsewhere only
+        when that fails.
+        """
+        view = context.view()
+        offset = 0
+        boundary = 0  # where the last message ended
+        while offset < len(view):
+            scanner = context.scanner
+            if scanner is None:
+                found = None
+                protocol = self._protocol or context.protocol
+                if (self._trust_boundaries and offset == boundary and
+                        stream in self._recognized_streams and
+                        protocol is not None):
+                    data = view[offset:]
+                    if len(data) < ThriftMessage.MIN_MESSAGE_SIZE:
+                        break  # too short to be anything yet
+                    found = self._try_message(
+                        stream, context, data, protocol, trusted=True)
+                    if found is None:
+                        self._failed(context)
+                    elif found[0] is None:
+                        break  # wait for the rest of it
+                    else:
+                        idx = offset
+                        msg, msglen = found
 
-            if len(context.bytes) < frame_size + 4:
-                return
+                if found is None:
+                    trusted = (offset == boundary and
+                               stream in self._recognized_streams)
+                    idx, msg, msglen, protocol = self._next_message(
+                        stream, context, view, offset, trusted)
+                    if msg is None:
+                        # wait for more, keeping what might still be a message
+                        offset = idx
+                        break
+            else:
+                # the message we were waiting on starts right at offset
+                try:
+                    msglen = scanner.scan(view[offset:])
+                except MessageScanner.Error:
+                    # only now we go back to looking for messages
+                    context.scanner = None
+                    context.oversized = None
+                    self._failed(context)
+                    offset += 1
+                    continue
+
+                if msglen is None:
+                    break
+
+                context.scanner = None
+                if context.oversized is not None:
+                    # what's left of it is all we have
+                    end = msglen - scanner.discarded
+                    self._add_oversized(
+                        stream, context, context.timestamp_at(end), msglen)
+                    offset = boundary = end
+                    continue
+                idx = offset
+                protocol = scanner.protocol
+                msg = self._read_message(
+                    stream, context, view[idx:idx + msglen], protocol)
+                if msg is None:
+                    self._failed(context)
+                    offset += 1
+                    continue
+
+            # a framed stream has the message's length right before it
+            framed = None
+            if idx >= 4:
+                framed = unpack_from('!i', view, idx - 4)[0] == msglen
+            context.learn(protocol, msg, framed)
 
-            start = 4
+            self._skipped(stream, idx - boundary)
+            offset = boundary = idx + msglen
+            self._add_message(stream, context.timestamp_at(offset), msg)
+            if context.framed:
+                break
 
-        view = memoryview(context.bytes)
-        for idx in range(start, len(context.bytes)):
+        self._skipped(stream, offset - boundary)
+        context.consume(offset)
+
+    def _next_message(self, stream, context, view, offset, trusted=False):
+        """
+        Looks for a message from offset on, returns (idx, msg, msglen,
+        protocol) if there's a complete one. Otherwise (idx, None, None,
+        None), where the bytes before idx can't be (part of) a message. An
+        incomplete message is left in context.scanner.
+
+        Once the stream's protocol is known only that one is tried, until
+        it fails too many times. If offset is trusted to be where a message
+        starts, the one there might be bigger than max_message_size.
+        """
+        # the last few bytes might be the start of a message, once more come
+        keep = max(offset, len(view) - ThriftMessage.MAX_START_LENGTH)
+        learned = context.protocol is not None
+
+        # only try where a message might start
+        candidates = ThriftMessage.candidates(
+            view, offset,
+            protocol=self._protocol or context.protocol,
+            finagle_thrift=self._finagle_thrift_for(context))
+        for idx in candidates:
+            data = view[idx:]
+            protocol = self._protocol_for(context, data)
+            found = self._try_message(
+                stream, context, data, protocol, trusted and idx == offset)
+            if found is None:
+                if self._failed(context):
+                    return self._next_message(
+                        stream, context, view, offset, trusted)
+                continue
+
+            msg, msglen = found
+            if msg is not None:
+                return idx, msg, msglen, protocol
+
+            if context.scanner is not None:
+                return idx, None, None, None
+
+            # JSON, it might still be a message once more come
+            keep = min(keep, idx)
+
+        # nothing we'd skip could be read the way we knew the stream, so go
+        # back to detecting before dropping those bytes
+        if learned and keep > offset and context.protocol is not None:
+            context.forget()
+            return self._next_message(stream, context, view, offset, trusted)
+
+        return keep, None, None, None
+
+    def _try_message(self, stream, context, data, protocol, trusted=False):
+        """
+        Tries the message at the start of data, returns (msg, msglen) if
+        it's there, (None, None) if it might be once more bytes come (an
+        incomplete binary or compact one is left in context.scanner) or
+        None if there's no message there.
+
+        If it's trusted to start there, its strings may be as long as an
+        oversized message (so it can be skipped, if it's one).
+        """
+        finagle_thrift = self._finagle_thrift_for(context)
+        if not MessageScanner.supports(protocol):
+            # i.e.: JSON, which can only be read in one go
             try:
-                data_slice = view[idx:]
-                msg, msglen = ThriftMessage.read(
-                    data_slice,
-                    protocol=self._protocol,
-                    finagle_thrift=self._finagle_thrift,
-                    read_values=self._read_values)
+                return ThriftMessage.read(
+                    data,
+                    protocol=protocol,
+                    finagle_thrift=finagle_thrift,
+                    read_values=self._read_values,
+                    idl=self._idl,
+                    lazy=self._lazy)
             except EOFError:
+                return None, None
+            except Exception:
+                return None
+
+        max_size = self._max_message_size
+        if trusted:
+            max_size = max(max_size, self._max_skipped_size)
+        scanner = MessageScanner(protocol, finagle_thrift, max_size)
+        try:
+            msglen = scanner.scan(data)
+        except MessageScanner.Error:
+            return None
+
+        if msglen is None:
+            context.scanner = scanner
+            return None, None
+
+        msg = self._read_message(stream, context, data[:msglen], protocol)
+        if msg is None:
+            return None
+        return msg, msglen
+
+    def _read_message(self, stream, context, data, protocol):
+        """ reads a message we know is complete, None if it can't be read """
+        try:
+            if self._header_only:
+                msg, _ = ThriftMessage.read_header(
+                    data,
+                    protocol=protocol,
+                    finagle_thrift=self._finagle_thrift_for(context),
+                    length=len(data))
+            else:
+                msg, _ = ThriftMessage.read(
+                    data,
+                    protocol=protocol,
+                    finagle_thrift=self._finagle_thrift_for(context),
+                    read_values=self._read_values,
+                    idl=self._idl,
+                    lazy=self._lazy)
+            return msg
+        except Exception as ex:
+            if self._debug:
+                print('Bad message for stream %s: %s: %s\n(size=%d)' % (
+                        stream, ex, traceback.format_exc(), len(data)),
+                      file=sys.stderr)
+            return None
+
+    def _read_frames(self, stream, context):
+        """
+        Splits the bytes on frame lengths and reads each complete frame. Only
+        when a frame doesn't look right (bad size or it can't be read) we
+        move ahead one byte at a time to find the next one. If the stream
+        was only found to be framed, too many of those and we go back to
+        looking for messages.
+        """
+        view = context.view()
+        offset = 0
+        boundary = 0  # where the last frame ended
+        while len(view) - offset >= 4:
+            frame_size, = unpack_from('!i', view, offset)
+            if self._max_message_size < frame_size <= self._max_skipped_size:
+                taken = self._skip_frame(stream, context, view, offset, frame_size)
+                if taken is None:
+                    break  # can't tell yet
+                if taken:
+                    self._skipped(stream, offset - boundary)
+                    offset = boundary = offset + taken
+                    continue
+
+            if (frame_size < ThriftMessage.MIN_MESSAGE_SIZE or
+                    frame_size > self._max_message_size):
+                offset += 1
+                if self._failed(context) and not self._framed:
+                    break
                 continue
+
+            end = offset + 4 + frame_size
+            if end > len(view):
+                # before waiting for the rest, make sure it's worth it
+                if offset > 0 or not context.frame_checked:
+                    looks_ok = self._check_partial_frame(
+                        context, view[offset + 4:], frame_size)
+                    if looks_ok is False:
+                        offset += 1
+                        if self._failed(context) and not self._framed:
+                            break
+                        continue
+                    context.frame_checked = looks_ok is True
+                break
+
+            frame = view[offset + 4:end]
+            protocol = self._protocol_for(context, frame)
+            try:
+                if self._header_only:
+                    # the frame tells where the message ends
+                    msg, _ = ThriftMessage.read_header(
+                        frame,
+                        protocol=protocol,
+                        finagle_thrift=self._finagle_thrift_for(context),
+                        length=frame_size)
+                else:
+                    msg, _ = ThriftMessage.read(
+                        frame,
+                        protocol=protocol,
+                        finagle_thrift=self._finagle_thrift_for(context),
+                        read_values=self._read_values,
+                        idl=self._idl,
+                        lazy=self._lazy)
             except Exception as ex:
                 if self._debug:
-                    print('Bad message for stream %s: %s: %s\n(idx=%d) '
-                          '(context size=%d)' % (
-                            stream,
-                            ex,
-                            traceback.format_exc(),
-                            idx,
-                            len(context.bytes)),
-                          file=sys.stderr
-                          )
+                    print('Bad frame for stream %s: %s\n(offset=%d) '
+                          '(frame size=%d)' % (stream, ex, offset, frame_size),
+                          file=sys.stderr)
+                if offset == boundary and context.framed is True:
+                    # right after another frame, so its size can be trusted
+                    # and the frame is skipped as a whole
+                    offset = end
+                else:
+                    offset += 1
+                if self._failed(context) and not self._framed:
+                    break
                 continue
 
-            self._recognized_streams.add(stream)
-            self._seen_messages += 1
-            self._outqueue.append((timestamp, stream.src, stream.dst, msg))
-            context.bytes = context.bytes[idx + msglen:]
-            break
+            context.learn(protocol, msg, framed=True)
+            self._skipped(stream, offset - boundary)
+            self._add_message(stream, context.timestamp_at(end), msg)
+            offset = boundary = end
+            context.frame_checked = False
+
+        self._skipped(stream, offset - boundary)
+        context.consume(offset)
+
+    def _skip_frame(self, stream, context, view, offset, frame_size):
+        """
+        Reads the method, type & seqid of a frame that's too big to keep,
+        the rest of it is skipped. Returns how many bytes of view (from
+        offset) it took, 0 if there's no message there and None if we
+        can't tell yet.
+        """
+        frame = view[offset + 4:offset + 4 + frame_size]
+        if len(frame) < ThriftMessage.MIN_MESSAGE_SIZE:
+            return None
+
+        try:
+            msg, _ = ThriftMessage.read_header(
+                frame,
+                protocol=self._protocol_for(context, frame),
+                finagle_thrift=self._finagle_thrift_for(context),
+                length=len(frame))
+        except EOFError:
+            # the start of the message (or finagle's header) might be cut
+            if (len(frame) < min(frame_size, self._pop_size) and
+                    self._check_partial_frame(
+                        context, frame, frame_size) is not False):
+                return None
+            return 0
+        except Exception:
+            # garbage that happens to start with a plausible frame size
+            return 0
+
+        taken = 4 + len(frame)
+        self._oversized_bytes += taken
+        context.oversized = ThriftMessage(
+            msg.method, msg.type, msg.seqid, msg.args, msg.header, frame_size)
+        context.skip = 4 + frame_size - taken
+        if context.skip == 0:
+            self._add_oversized(
+                stream, context, context.timestamp_at(offset + taken))
+        return taken
+
+    def _start_skipping(self, context):
+        """
+        The buffer is full with a message that's still incomplete, if it was
+        allowed to be that big its method, type & seqid are read and the
+        rest is skipped while it's scanned. False if it can't be skipped.
+        """
+        scanner = context.scanner
+        if (scanner is None or scanner.in_header or
+                scanner.max_size <= self._max_message_size):
+            return False
+
+        view = context.view()
+        try:
+            msg, _ = ThriftMessage.read_header(
+                view,
+                protocol=scanner.protocol,
+                finagle_thrift=self._finagle_thrift_for(context),
+                length=len(view))
+        except Exception:
+            return False
+
+        context.oversized = msg
+        return True
+
+    def _skip_scanned(self, context):
+        """ drops the bytes of the oversized message we already went through """
+        scanner = context.scanner
+        if scanner is None:
+            return
+        nbytes = scanner.position
+        context.consume(nbytes)
+        scanner.discard(nbytes)
+        self._oversized_bytes += nbytes
+
+    def _skip(self, stream, context, payload, timestamp):
+        """ drops what's left of an oversized frame from payload """
+        nbytes = min(context.skip, len(payload))
+        context.skip -= nbytes
+        self._oversized_bytes += nbytes
+        if context.skip == 0:
+            self._add_oversized(stream, context, timestamp)
+        return memoryview(payload)[nbytes:]
+
+    def _add_oversized(self, stream, context, timestamp, length=None):
+        """ the oversized message is over, length is its own if not given """
+        msg = context.oversized
+        context.oversized = None
+        if length is not None:
+            msg = ThriftMessage(
+                msg.method, msg.type, msg.seqid, msg.args, msg.header, length)
+        self._oversized_msgs += 1
+        self._add_message(stream, timestamp, msg)
+
+    def _check_partial_frame(self, context, partial, frame_size):
+        """
+        False if what we have of a frame already fails to read as a message
+        (and not just because it's incomplete), i.e.: a bogus frame size in
+        the middle of a stream we joined late. True if it reads fine so far,
+        None if we can't tell yet.
+
+        Binary & compact frames go through a MessageScanner, which checks
+        the method name and sizes against what's there instead of asking
+        for (i.e.) a 16MB name. Without a given protocol, the frame has to
+        start like one we can detect.
+        """
+        if len(partial) < ThriftMessage.MIN_MESSAGE_SIZE:
+            return None
+
+        finagle_thrift = self._finagle_thrift_for(context)
+        try:
+            protocol = (self._protocol or context.protocol or
+                        ThriftMessage.detect_protocol(partial))
+            if not MessageScanner.supports(protocol):
+                if finagle_thrift:
+                    return None  # its header doesn't fail cleanly
+                ThriftMessage.read(partial, protocol=protocol)
+                return True
+
+            scanner = MessageScanner(protocol, finagle_thrift, max_size=frame_size)
+            if scanner.scan(partial) is not None:
+                return False  # it ends before the frame does
+        except EOFError:
+            pass
+        except Exception:
+            return False
+
+        return True
+
+    def _is_framed(self, context):
+        return self._framed or context.framed is True
+
+    def _protocol_for(self, context, data):
+        """ the given protocol, else the stream's, else the one data looks like """
+        return (self._protocol or context.protocol or
+                ThriftMessage.detect_protocol(data, default=TBinaryProtocol))
+
+    def _finagle_thrift_for(self, context):
+        """ only look for the header if the stream had it, once we know """
+        if context.finagle_header is None:
+            return self._finagle_thrift
+        return context.finagle_header
+
+    def _failed(self, context):
+        """
+        counts a failure to read a message where the stream's protocol said
+        there'd be one, True if that was one too many and it was forgotten
+        """
+        if context.protocol is None:
+            return False
+
+        context.failures += 1
+        if context.failures < self.MAX_FAILURES:
+            return False
+
+        context.forget()
+        return True
+
+    def _skipped(self, stream, nbytes):
+        if nbytes > 0 and stream in self._recognized_streams:
+            self._skipped_bytes += nbytes
+            self._resyncs += 1
+
+    def _add_message(self, stream, timestamp, msg):
+        self._recognized_streams.add(stream)
+        self._seen_messages += 1
+        self._outqueue.append((timestamp, stream.src, stream.dst, msg))
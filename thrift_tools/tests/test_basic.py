@@ -1,7 +1,10 @@
 from collections import deque
+from six.moves.queue import Queue
 
 import unittest
 
+from thrift_tools.batch_queue import DROP_NEWEST, BatchQueue
+from thrift_tools.sharding import ShardedDispatcher, run_worker
 from thrift_tools.sniffer import Sniffer
 from thrift_tools.stream_handler import StreamHandler
 from thrift_tools.thrift_struct import ThriftField, ThriftStruct
@@ -71,6 +74,57 @@ class BasicTestCase(unittest.TestCase):
         self.assertEquals(msg.type, 'reply')
         self.assertEquals(msg.args, ThriftStruct([ThriftField('list', 0, ['one', 'two', 'three'])]))
 
+    def test_workers(self):
+        queue = deque()
+        pcap_file = get_pcap_path('calc-service-binary')
+        dispatcher = ShardedDispatcher(BatchQueue(), queue, 2, {'read_values': True})
+
+        sniffer = Sniffer(None, 9090, offline=pcap_file, dispatcher=dispatcher)
+        sniffer.join()
+        dispatcher.close()
+
+        self.assertEquals(len(queue), 10)
+        self.assertEquals(dispatcher.seen_thrift_msgs, 10)
+        self.assertEquals(dispatcher.seen_streams, 2)
+
+        # a single connection, so ordering is preserved
+        methods = [(msg.method, msg.type) for _, _, _, msg in queue]
+        self.assertEquals(methods[:4], [
+            ('ping', 'call'), ('ping', 'reply'), ('add', 'call'), ('add', 'reply')])
+
+        _, src, dst, msg = queue[2]
+        self.assertEquals(src, '127.0.0.1:51112')
+        self.assertEquals(dst, '127.0.0.1:9090')
+        self.assertEquals(msg.args[0], ThriftField('i32', 1, 1))
+
+    def test_worker_survives_bad_packets(self):
+        packets, results = Queue(), Queue()
+        packets.put([(0, object()), (0, None)])
+        packets.put(None)
+
+        # it would have died on the first one, and the parent hung joining
+        run_worker(0, packets, results, {})
+        _, msgs, stats = results.get(timeout=5)
+        self.assertEqual(msgs, [])
+        self.assertEqual(stats.packets, 1)
+        self.assertEqual(stats.closes, 1)
+        self.assertEqual(stats.errors, 1)
+
+    def test_workers_dropped_packets(self):
+        packet_queue = BatchQueue(maxlen=1, policy=DROP_NEWEST)
+        dispatcher = ShardedDispatcher(packet_queue, deque(), 1, {})
+        dispatcher.close()  # so nothing drains its queue
+
+        for _ in range(ShardedDispatcher.MIN_QUEUED_BATCHES):
+            dispatcher._batches[0].append((0, 'packet'))
+            dispatcher._flush(0)
+        self.assertEqual(dispatcher.dropped_packets, 0)
+
+        # once the worker's queue is full
+        dispatcher._batches[0].extend([(0, 'packet'), (0, 'packet')])
+        dispatcher._flush(0)
+        self.assertEqual(dispatcher.dropped_packets, 2)
+
     def _test_protocol(self, protoname):
         queue = deque()
         pcap_file = get_pcap_path('calc-service-%s' % protoname)
@@ -0,0 +1,182 @@
+from threading import Thread
+
+import unittest
+
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift_tools.batch_queue import (
+    BLOCK, DROP_NEWEST, QUEUE_POLICIES, SAMPLE, BatchQueue)
+from thrift_tools.message_sniffer import MessageSnifferOptions, MessageSniffer
+
+from .util import get_pcap_path
+
+
+class BatchHandler(object):
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, timestamp, src, dst, msg):
+        raise AssertionError('handle_batch() should be used')
+
+    def handle_batch(self, msgs):
+        self.batches.append(msgs)
+        return True
+
+
+class BatchQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_batch(self):
+        queue = BatchQueue()
+        queue.extend([1, 2, 3])
+        queue.append(4)
+
+        self.assertEqual(queue.get_batch(max_items=3), [1, 2, 3])
+        self.assertEqual(queue.get_batch(), [4])
+        self.assertEqual(queue.wakeups, 2)
+        self.assertEqual(queue.idle, 0)
+
+        # nothing left
+        self.assertEqual(queue.get_batch(timeout=0.01), [])
+        self.assertEqual(queue.idle, 1)
+
+    def test_blocks_until_appended(self):
+        queue = BatchQueue()
+        batches = []
+
+        consumer = Thread(target=lambda: batches.append(queue.get_batch()))
+        consumer.start()
+        queue.append('x')
+        consumer.join(5)
+
+        self.assertEqual(batches, [['x']])
+
+    def test_wake_up(self):
+        queue = BatchQueue()
+        batches = []
+
+        consumer = Thread(
+            target=lambda: batches.append(queue.get_batch(timeout=5)))
+        consumer.start()
+        queue.wake_up()
+        consumer.join(1)
+
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual(batches, [[]])
+
+    def test_maxlen(self):
+        queue = BatchQueue(maxlen=2)
+        queue.extend([1, 2, 3])
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.unfinished, 2)
+        self.assertEqual(queue.get_batch(), [2, 3])
+
+    def test_drop_newest(self):
+        queue = BatchQueue(maxlen=2, policy=DROP_NEWEST)
+        queue.extend([1, 2, 3])
+
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.get_batch(), [1, 2])
+
+    def test_sample(self):
+        queue = BatchQueue(maxlen=2, policy=SAMPLE)
+        queue.extend(range(2 + 2 * BatchQueue.SAMPLE_EVERY))
+
+        # each sampled item pushes out the oldest one
+        self.assertEqual(queue.dropped, 2 * BatchQueue.SAMPLE_EVERY)
+        self.assertEqual(queue.get_batch(), [11, 21])
+
+    def test_block(self):
+        queue = BatchQueue(maxlen=2, policy=BLOCK)
+        producer = Thread(target=lambda: queue.extend(range(5)))
+        producer.start()
+
+        items = []
+        while len(items) < 5:
+            items.extend(queue.get_batch(timeout=5))
+        producer.join(5)
+
+        self.assertEqual(items, [0, 1, 2, 3, 4])
+        self.assertEqual(queue.dropped, 0)
+        self.assertTrue(queue.blocked > 0)
+
+    def test_append_control(self):
+        for policy in QUEUE_POLICIES:
+            queue = BatchQueue(maxlen=2, policy=policy)
+            queue.extend([1, 2])
+            queue.append_control(None)
+
+            # neither dropped nor pushing anything else out, nor blocking
+            self.assertEqual(queue.dropped, 0)
+            self.assertEqual(queue.unfinished, 3)
+            self.assertEqual(queue.get_batch(), [1, 2, None])
+
+    def test_close(self):
+        queue = BatchQueue(maxlen=1, policy=BLOCK)
+        queue.append(1)
+        producer = Thread(target=lambda: queue.extend([2, 3]))
+        producer.start()
+
+        # the blocked producer drops what it had instead of waiting forever
+        queue.close()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.get_batch(), [1])
+
+    def test_join(self):
+        queue = BatchQueue()
+        queue.extend([1, 2])
+
+        self.assertFalse(queue.join(timeout=0.01))
+        queue.task_done(len(queue.get_batch()))
+        self.assertTrue(queue.join(timeout=0.01))
+
+    def test_batch_handler(self):
+        options = MessageSnifferOptions(
+            iface=None,
+            port=9090,
+            ip=None,
+            pcap_file=get_pcap_path('calc-service-binary'),
+            protocol=TBinaryProtocol,
+            finagle_thrift=False,
+            read_values=False,
+            max_queued=2000,
+            max_message_size=2000,
+            debug=False)
+        handler = BatchHandler()
+
+        message_sniffer = MessageSniffer(options, handler)
+        message_sniffer.join()
+
+        msgs = [msg for batch in handler.batches for msg in batch]
+        self.assertEqual(len(msgs), 10)
+        self.assertEqual(msgs[0][3].method, 'ping')
+        status = message_sniffer.status()
+        self.assertIn('handlers wakeups:', status)
+
+        # nothing's left running once it's done
+        self.assertIn('dispatcher alive:       False', status)
+
+    def test_stop_blocked(self):
+        options = MessageSnifferOptions(
+            iface=None,
+            port=9090,
+            ip=None,
+            pcap_file=get_pcap_path('calc-service-binary'),
+            protocol=TBinaryProtocol,
+            finagle_thrift=False,
+            read_values=False,
+            max_queued=1,
+            max_message_size=2000,
+            debug=False,
+            queue_policy=BLOCK)
+
+        # the dispatcher is blocked on the full queue when the handler quits
+        message_sniffer = MessageSniffer(options, lambda *args: False)
+        message_sniffer.join(5)
+        self.assertFalse(message_sniffer.is_alive())
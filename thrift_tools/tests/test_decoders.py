@@ -0,0 +1,356 @@
+import pickle
+import unittest
+
+from thrift.Thrift import TMessageType, TType
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+from thrift.transport import TTransport
+
+from thrift_tools import decoders
+from thrift_tools.decoders import (
+    BinaryDecoder,
+    CompactDecoder,
+    LazyThriftStruct,
+    ProtocolDecoder,
+    _FAST_DECODE_CHUNK,
+    decoder_for,
+)
+from thrift_tools.idl import parse_idl_file
+from thrift_tools.thrift_message import ThriftMessage
+from thrift_tools.thrift_struct import ObjectTooBig, ThriftStruct
+
+from .test_message_scanner import message
+from .util import get_thrift_path
+
+
+LIMITS = (
+    ThriftMessage.MAX_FIELDS,
+    ThriftMessage.MAX_LIST_SIZE,
+    ThriftMessage.MAX_MAP_SIZE,
+    ThriftMessage.MAX_SET_SIZE,
+)
+
+
+def calculate(protocol, comment=None):
+    """ a call to the tutorial's calculate() """
+    trans = TTransport.TMemoryBuffer()
+    proto = protocol(trans)
+    proto.writeMessageBegin('calculate', TMessageType.CALL, 3)
+    proto.writeStructBegin('calculate_args')
+    proto.writeFieldBegin('logid', TType.I32, 1)
+    proto.writeI32(7)
+    proto.writeFieldEnd()
+    proto.writeFieldBegin('w', TType.STRUCT, 2)
+    proto.writeStructBegin('Work')
+    proto.writeFieldBegin('num1', TType.I32, 1)
+    proto.writeI32(1)
+    proto.writeFieldEnd()
+    proto.writeFieldBegin('num2', TType.I32, 2)
+    proto.writeI32(2)
+    proto.writeFieldEnd()
+    proto.writeFieldBegin('op', TType.I32, 3)
+    proto.writeI32(1)
+    proto.writeFieldEnd()
+    if comment is not None:
+        proto.writeFieldBegin('comment', TType.STRING, 4)
+        proto.writeString(comment)
+        proto.writeFieldEnd()
+    proto.writeFieldStop()
+    proto.writeStructEnd()
+    proto.writeFieldEnd()
+    proto.writeFieldStop()
+    proto.writeStructEnd()
+    proto.writeMessageEnd()
+    return trans.getvalue()
+
+
+def containers(protocol, items=20):
+    """ a call with containers of everything, but for structs """
+    trans = TTransport.TMemoryBuffer()
+    proto = protocol(trans)
+    proto.writeMessageBegin('put', TMessageType.CALL, 1)
+    proto.writeStructBegin('args')
+
+    proto.writeFieldBegin('ids', TType.LIST, 1)
+    proto.writeListBegin(TType.I64, items)
+    for idx in range(items):
+        proto.writeI64(idx * 2 ** 33)
+    proto.writeListEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('weights', TType.MAP, 2)
+    proto.writeMapBegin(TType.I32, TType.DOUBLE, items)
+    for idx in range(items):
+        proto.writeI32(-idx)
+        proto.writeDouble(idx / 2.0)
+    proto.writeMapEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('blobs', TType.LIST, 3)
+    proto.writeListBegin(TType.STRING, items)
+    for idx in range(items):
+        proto.writeBinary(b'\xff' * idx)
+    proto.writeListEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('flags', TType.SET, 4)
+    proto.writeSetBegin(TType.BOOL, 2)
+    proto.writeBool(True)
+    proto.writeBool(False)
+    proto.writeSetEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('small', TType.MAP, 5)
+    proto.writeMapBegin(TType.I16, TType.BYTE, items)
+    for idx in range(items):
+        proto.writeI16(idx)
+        proto.writeByte(idx)
+    proto.writeMapEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('nested', TType.LIST, 6)
+    proto.writeListBegin(TType.LIST, 2)
+    for _ in range(2):
+        proto.writeListBegin(TType.DOUBLE, items)
+        for idx in range(items):
+            proto.writeDouble(idx)
+        proto.writeListEnd()
+    proto.writeListEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldStop()
+    proto.writeStructEnd()
+    proto.writeMessageEnd()
+    return trans.getvalue()
+
+
+def read(decoder, read_values):
+    method = decoder.read_message_begin()
+    args = decoder.read_struct(read_values)
+    return method, args, decoder.position
+
+
+class DecodersTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_decoder_for(self):
+        self.assertIsInstance(
+            decoder_for(TBinaryProtocol, b'', *LIMITS), BinaryDecoder)
+        self.assertIsInstance(
+            decoder_for(TCompactProtocol, b'', *LIMITS), CompactDecoder)
+
+    def _test_matches_protocol(self, protocol, data):
+        for read_values in (False, True):
+            expected = read(
+                ProtocolDecoder(protocol, data, *LIMITS), read_values)
+            method, args, length = read(
+                decoder_for(protocol, memoryview(data), *LIMITS), read_values)
+
+            self.assertEqual(expected[0], method)
+            self.assertEqual(str(expected[1]), str(args))
+            self.assertEqual(len(expected[1]), len(args))
+            self.assertEqual(len(data), length)
+            self.assertEqual(expected[2], length)
+
+    def test_binary_matches_protocol(self):
+        self._test_matches_protocol(TBinaryProtocol, message(TBinaryProtocol))
+
+    def test_compact_matches_protocol(self):
+        self._test_matches_protocol(TCompactProtocol, message(TCompactProtocol))
+
+    def test_binary_containers(self):
+        self._test_matches_protocol(TBinaryProtocol, containers(TBinaryProtocol))
+        self._test_truncated(TBinaryProtocol, containers(TBinaryProtocol, 5))
+
+    def test_compact_containers(self):
+        self._test_matches_protocol(TCompactProtocol, containers(TCompactProtocol))
+        self._test_truncated(TCompactProtocol, containers(TCompactProtocol, 5))
+
+    def _test_truncated(self, protocol, data):
+        data = memoryview(data)
+
+        for end in range(len(data)):
+            for read_values in (False, True):
+                decoder = decoder_for(protocol, data[:end], *LIMITS)
+                with self.assertRaises(EOFError):
+                    read(decoder, read_values)
+
+    def test_binary_truncated(self):
+        self._test_truncated(TBinaryProtocol, message(TBinaryProtocol))
+
+    def test_compact_truncated(self):
+        self._test_truncated(TCompactProtocol, message(TCompactProtocol))
+
+    def test_compact_varints(self):
+        trans = TTransport.TMemoryBuffer()
+        proto = TCompactProtocol(trans)
+        proto.writeMessageBegin('sum', TMessageType.CALL, 1000)
+        proto.writeStructBegin('args')
+        proto.writeFieldBegin('done', TType.BOOL, 1)
+        proto.writeBool(True)
+        proto.writeFieldEnd()
+        proto.writeFieldBegin('values', TType.LIST, 300)
+        proto.writeListBegin(TType.I64, 20)
+        for value in range(-10, 10):
+            proto.writeI64(value * 2 ** 40)
+        proto.writeListEnd()
+        proto.writeFieldEnd()
+        proto.writeFieldStop()
+        proto.writeStructEnd()
+        proto.writeMessageEnd()
+        data = trans.getvalue()
+
+        decoder = CompactDecoder(data, *LIMITS)
+        self.assertEqual(('sum', TMessageType.CALL, 1000), decoder.read_message_begin())
+        args = decoder.read_struct(read_values=True)
+        self.assertEqual(len(data), decoder.position)
+
+        done, values = args.fields
+        self.assertEqual((1, None), (done.field_id, done.value))
+        self.assertEqual(300, values.field_id)
+        self.assertEqual([value * 2 ** 40 for value in range(-10, 10)], values.value)
+
+    def test_limits(self):
+        data = message(TBinaryProtocol, items=10)
+        decoder = BinaryDecoder(data, 1000, 1000, 5, 1000)
+        decoder.read_message_begin()
+        with self.assertRaises(ObjectTooBig):
+            decoder.read_struct()
+
+    def test_old_style_message(self):
+        trans = TTransport.TMemoryBuffer()
+        proto = TBinaryProtocol(trans, strictWrite=False)
+        proto.writeMessageBegin('ping', TMessageType.CALL, 7)
+        proto.writeStructBegin('args')
+        proto.writeFieldStop()
+        proto.writeStructEnd()
+        proto.writeMessageEnd()
+        data = trans.getvalue()
+
+        msg, msglen = ThriftMessage.read(data, protocol=TBinaryProtocol)
+        self.assertEqual('ping', msg.method)
+        self.assertEqual('call', msg.type)
+        self.assertEqual(7, msg.seqid)
+        self.assertEqual(len(data), msglen)
+
+    def test_binary_string_skipped(self):
+        trans = TTransport.TMemoryBuffer()
+        proto = TBinaryProtocol(trans)
+        proto.writeMessageBegin('upload', TMessageType.CALL, 1)
+        proto.writeStructBegin('args')
+        proto.writeFieldBegin('blob', TType.STRING, 1)
+        proto.writeBinary(b'\xff\xfe\x00')
+        proto.writeFieldEnd()
+        proto.writeFieldStop()
+        proto.writeStructEnd()
+        proto.writeMessageEnd()
+        data = trans.getvalue()
+
+        msg, msglen = ThriftMessage.read(data, read_values=False)
+        self.assertEqual(None, msg.args.fields[0].value)
+        self.assertEqual(len(data), msglen)
+
+        # strings that aren't utf-8 are read as empty
+        msg, _ = ThriftMessage.read(data, read_values=True)
+        self.assertEqual('', msg.args.fields[0].value)
+
+    def _test_read_spec(self, protocol):
+        idl = parse_idl_file(get_thrift_path('tutorial'))
+        data = calculate(protocol)
+
+        expected, length = ThriftMessage.read(data, read_values=True)
+        msg, msglen = ThriftMessage.read(data, read_values=True, idl=idl)
+        self.assertEqual(expected.args, msg.args)
+        self.assertEqual(len(data), msglen)
+        self.assertEqual(length, msglen)
+
+        decoder = decoder_for(protocol, data, *LIMITS)
+        decoder.read_message_begin()
+        self.assertEqual(expected.args, decoder.read_spec(idl.thrift_spec('calculate', 'call')))
+        self.assertEqual(len(data), decoder.position)
+
+        # it's up to read_struct() to tell it's truncated
+        with self.assertRaises(EOFError):
+            ThriftMessage.read(data[:-1], read_values=True, idl=idl)
+
+        # what follows isn't copied, and a big struct takes a few chunks
+        spec = idl.thrift_spec('calculate', 'call')
+        for comment in (None, 'x' * 5 * _FAST_DECODE_CHUNK):
+            data = calculate(protocol, comment)
+            expected, _ = ThriftMessage.read(data, read_values=True)
+            decoder = decoder_for(protocol, memoryview(data * 3), *LIMITS)
+            decoder.read_message_begin()
+            self.assertEqual(expected.args, decoder.read_spec(spec))
+            self.assertEqual(len(data), decoder.position)
+
+            decoder = decoder_for(protocol, memoryview(data[:-2]), *LIMITS)
+            decoder.read_message_begin()
+            self.assertIsNone(decoder.read_spec(spec))
+
+    def test_binary_read_spec(self):
+        self._test_read_spec(TBinaryProtocol)
+
+    def test_compact_read_spec(self):
+        self._test_read_spec(TCompactProtocol)
+
+    def _test_lazy(self, protocol):
+        for data in (message(protocol), containers(protocol)):
+            for read_values in (False, True):
+                expected, length = ThriftMessage.read(data, read_values=read_values)
+                msg, msglen = ThriftMessage.read(
+                    data, read_values=read_values, lazy=True)
+                self.assertEqual(length, msglen)
+
+                args = msg.args
+                self.assertIsInstance(args, LazyThriftStruct)
+                self.assertEqual(len(expected.args), len(args))
+                self.assertEqual(expected.args.bytes_length, args.bytes_length)
+                self.assertIsNone(args._fields)  # nothing decoded yet
+
+                # workers send them over as they are
+                args = pickle.loads(pickle.dumps(args))
+                self.assertEqual(expected.args, args)
+                self.assertEqual(expected.args.as_dict, args.as_dict)
+                self.assertTrue(expected.args.is_isomorphic_to(args))
+                self.assertTrue(args.is_isomorphic_to(expected.args))
+
+    def test_binary_lazy(self):
+        self._test_lazy(TBinaryProtocol)
+
+    def test_compact_lazy(self):
+        self._test_lazy(TCompactProtocol)
+
+    def test_lazy_skips_nested(self):
+        built = []
+
+        class CountingStruct(ThriftStruct):
+            def __init__(self, *args, **kwargs):
+                built.append(self)
+                super(CountingStruct, self).__init__(*args, **kwargs)
+
+        decoders.ThriftStruct = CountingStruct
+        try:
+            for protocol in (TBinaryProtocol, TCompactProtocol):
+                for read_values in (False, True):
+                    msg, _ = ThriftMessage.read(
+                        message(protocol), read_values=read_values, lazy=True)
+                    self.assertIsInstance(msg.args, LazyThriftStruct)
+                    self.assertEqual([], built)
+        finally:
+            decoders.ThriftStruct = ThriftStruct
+
+        # and the nested struct is still there, once asked for
+        self.assertIsInstance(msg.args[3].value, LazyThriftStruct)
+
+    def test_lazy_nested(self):
+        msg, _ = ThriftMessage.read(
+            message(TBinaryProtocol), read_values=True, lazy=True)
+        nested = msg.args[3].value
+        self.assertIsInstance(nested, LazyThriftStruct)
+        self.assertIsNone(nested._fields)
+        self.assertEqual(None, nested[0].value)  # doubles aren't read
+        self.assertEqual(1, nested[0].field_id)
@@ -1,6 +1,7 @@
 import unittest
 
 import ptsd.ast
+from thrift.Thrift import TType
 from thrift_tools import idl
 
 from .util import get_thrift_path
@@ -130,3 +131,36 @@ class IdlTestCase(unittest.TestCase):
                 idl.Function(name="zip", arguments=[], type=idl.Void(), throws=[]),
             ],
         )
+
+    def test_thrift_spec(self):
+        parsed = idl.parse_idl_file(get_thrift_path("tutorial"))
+
+        cls, spec = parsed.thrift_spec("calculate", "call")
+        self.assertIs(idl.SpecStruct, cls)
+        self.assertEqual(None, spec[0])
+        self.assertEqual((1, TType.I32, "logid", None, None), spec[1])
+
+        tag, ttype, name, (struct_cls, work_spec), _ = spec[2]
+        self.assertEqual((2, TType.STRUCT, "w"), (tag, ttype, name))
+        self.assertIs(idl.SpecStruct, struct_cls)
+        self.assertEqual(
+            (
+                None,
+                (1, TType.I32, "num1", None, None),
+                (2, TType.I32, "num2", None, None),
+                (3, TType.I32, "op", None, None),
+                (4, TType.STRING, "comment", "UTF8", None),
+            ),
+            work_spec,
+        )
+
+        # the return value is field 0, the exceptions follow
+        _, spec = parsed.thrift_spec("calculate", "reply")
+        self.assertEqual((0, TType.I32, "success", None, None), spec[0])
+        self.assertEqual(("ouch", TType.STRUCT), (spec[1][2], spec[1][1]))
+
+        _, spec = parsed.thrift_spec("ping", "reply")
+        self.assertEqual((None,), spec)
+
+        self.assertIsNone(parsed.thrift_spec("calculate", "exception"))
+        self.assertIsNone(parsed.thrift_spec("unknown", "call"))
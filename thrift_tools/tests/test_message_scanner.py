@@ -0,0 +1,111 @@
+import unittest
+
+from thrift.Thrift import TMessageType, TType
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+from thrift.transport import TTransport
+
+from thrift_tools.message_scanner import MessageScanner
+from thrift_tools.thrift_message import ThriftMessage
+
+
+def message(protocol, items=10):
+    """ a call with a bit of everything """
+    trans = TTransport.TMemoryBuffer()
+    proto = protocol(trans)
+    proto.writeMessageBegin('search', TMessageType.CALL, 42)
+    proto.writeStructBegin('args')
+
+    proto.writeFieldBegin('flag', TType.BOOL, 1)
+    proto.writeBool(True)
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('query', TType.STRING, 2)
+    proto.writeString('foo' * 10)
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('ids', TType.MAP, 20)
+    proto.writeMapBegin(TType.STRING, TType.LIST, items)
+    for idx in range(items):
+        proto.writeString('key%d' % idx)
+        proto.writeListBegin(TType.I64, idx)
+        for value in range(idx):
+            proto.writeI64(value * 1000)
+        proto.writeListEnd()
+    proto.writeMapEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldBegin('nested', TType.STRUCT, 21)
+    proto.writeStructBegin('nested')
+    proto.writeFieldBegin('score', TType.DOUBLE, 1)
+    proto.writeDouble(0.5)
+    proto.writeFieldEnd()
+    proto.writeFieldStop()
+    proto.writeStructEnd()
+    proto.writeFieldEnd()
+
+    proto.writeFieldStop()
+    proto.writeStructEnd()
+    proto.writeMessageEnd()
+    return trans.getvalue()
+
+
+class MessageScannerTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _test_protocol(self, protocol):
+        data = message(protocol)
+        _, msglen = ThriftMessage.read(data, protocol=protocol)
+        self.assertEqual(msglen, len(data))
+
+        # all at once
+        self.assertEqual(MessageScanner(protocol).scan(data + b'extra'), len(data))
+
+        # a byte at a time
+        scanner = MessageScanner(protocol)
+        for end in range(1, len(data)):
+            self.assertIsNone(scanner.scan(data[:end]))
+        self.assertEqual(scanner.scan(data), len(data))
+
+    def test_binary(self):
+        self._test_protocol(TBinaryProtocol)
+
+    def test_compact(self):
+        self._test_protocol(TCompactProtocol)
+
+    def test_discard(self):
+        for protocol in (TBinaryProtocol, TCompactProtocol):
+            data = message(protocol, items=50)
+
+            # only what wasn't scanned yet is kept around
+            scanner = MessageScanner(protocol)
+            start = 0
+            for end in range(7, len(data), 7):
+                self.assertIsNone(scanner.scan(data[start:end]))
+                start += scanner.position
+                scanner.discard(scanner.position)
+            self.assertEqual(scanner.discarded, start)
+            self.assertEqual(scanner.scan(data[start:]), len(data))
+
+    def test_errors(self):
+        data = message(TBinaryProtocol)
+
+        # bad version
+        with self.assertRaises(MessageScanner.Error):
+            MessageScanner(TBinaryProtocol).scan(b'\x80\x02' + data[2:])
+
+        # bad field type
+        scanner = MessageScanner(TBinaryProtocol)
+        header_len = 4 + 4 + len('search') + 4
+        self.assertIsNone(scanner.scan(data[:header_len]))
+        with self.assertRaises(MessageScanner.Error):
+            scanner.scan(data[:header_len] + b'\x42')
+
+    def test_finagle_without_header(self):
+        data = message(TBinaryProtocol)
+        scanner = MessageScanner(TBinaryProtocol, finagle_thrift=True)
+        self.assertEqual(scanner.scan(data), len(data))
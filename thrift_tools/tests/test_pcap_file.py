@@ -0,0 +1,62 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from thrift_tools.pcap_file import LINKTYPE_ETHERNET, PcapFile
+
+from .util import get_log_path, get_pcap_path
+
+
+def to_pcapng(records, tsresol=6):
+    """ writes (timestamp, linktype, frame) records as a pcapng capture """
+    def block(btype, body):
+        body += b'\x00' * (-len(body) % 4)
+        length = len(body) + 12
+        return struct.pack('<II', btype, length) + body + struct.pack('<I', length)
+
+    shb = block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1))
+    options = struct.pack('<HHB3x', 9, 1, tsresol) + struct.pack('<HH', 0, 0)
+    idb = block(1, struct.pack('<HHI', LINKTYPE_ETHERNET, 0, 0xffff) + options)
+
+    epbs = []
+    for timestamp, _, frame in records:
+        ticks = int(timestamp * 10 ** tsresol)
+        epbs.append(block(6, struct.pack(
+            '<IIIII', 0, ticks >> 32, ticks & 0xffffffff, len(frame), len(frame)) + frame))
+
+    return shb + idb + b''.join(epbs)
+
+
+class PcapFileTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_read_pcap(self):
+        records = list(PcapFile(get_pcap_path('calc-service-binary')))
+
+        self.assertEqual(len(records), 18)
+        self.assertTrue(all(linktype == LINKTYPE_ETHERNET for _, linktype, _ in records))
+
+        # timestamps are exact, so deltas between them are too
+        self.assertEqual(str(records[1][0] - records[0][0]), '0.000013')
+
+    def test_read_pcapng(self):
+        records = list(PcapFile(get_pcap_path('calc-service-binary')))
+
+        fd, path = tempfile.mkstemp(suffix='.pcapng')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(to_pcapng(records, tsresol=9))
+            ng_records = list(PcapFile(path))
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(ng_records, records)
+
+    def test_not_a_pcap_file(self):
+        with self.assertRaises(PcapFile.Error):
+            PcapFile(get_log_path('messages'))
@@ -0,0 +1,290 @@
+from collections import deque
+
+import struct
+import unittest
+
+import dpkt
+
+from thrift_tools.batch_queue import BatchQueue
+from thrift_tools.sniffer import (
+    PACKET_OUTGOING, TP_STATUS_KERNEL, TP_STATUS_USER, Dispatcher,
+    RingCapture, Sniffer, Stream)
+from thrift_tools.stream_handler import StreamHandler
+from thrift_tools.timing_wheel import TimingWheel
+from thrift_tools.util import TcpPacket
+
+
+def segment(seq, data, flags=dpkt.tcp.TH_ACK):
+    return dpkt.tcp.TCP(sport=51112, dport=9090, seq=seq, flags=flags, data=data)
+
+
+def packet(seq, data, flags=dpkt.tcp.TH_ACK):
+    return TcpPacket(
+        b'\x7f\x00\x00\x01', b'\x7f\x00\x00\x01', 51112, 9090, seq, flags, data)
+
+
+class StreamTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _stream(self, **kwargs):
+        return Stream('127.0.0.1:51112', '127.0.0.1:9090', **kwargs)
+
+    def test_in_order(self):
+        stream = self._stream()
+        self.assertFalse(stream.push(0, segment(99, b'', flags=dpkt.tcp.TH_SYN)))
+        self.assertTrue(stream.push(0, segment(100, b'abc')))
+        self.assertTrue(stream.push(0, segment(103, b'def')))
+
+        self.assertEqual(stream.pop_data(1024)[0], b'abcdef')
+        self.assertEqual(stream.gaps, 0)
+
+    def test_pop_data(self):
+        stream = self._stream()
+        stream.push(1.0, segment(100, b'abc'))
+        stream.push(2.0, segment(103, b'def'))
+        stream.push(3.0, segment(106, b'ghi'))
+
+        # whole segments are popped, so we might get more than we asked for
+        self.assertEqual(stream.pop_data(4), (b'abcdef', 1.0, 2.0))
+        self.assertEqual(stream.remaining, 3)
+        self.assertEqual(stream.pop_data(4), (b'ghi', 3.0, 3.0))
+        self.assertEqual(stream.pop_data(4), (b'', 0, 0))
+        self.assertEqual(stream.length, 9)
+
+    def test_out_of_order(self):
+        stream = self._stream()
+        stream.push(0, segment(100, b'abc'))
+        self.assertFalse(stream.push(0, segment(106, b'ghi')))
+        self.assertTrue(stream.push(0, segment(103, b'def')))
+
+        self.assertEqual(stream.pop_data(1024)[0], b'abcdefghi')
+        self.assertEqual(stream.out_of_order, 1)
+        self.assertEqual(stream.gaps, 0)
+
+    def test_retransmission(self):
+        stream = self._stream()
+        stream.push(0, segment(100, b'abc'))
+        self.assertFalse(stream.push(0, segment(100, b'abc')))
+        # partially overlapping
+        self.assertTrue(stream.push(0, segment(101, b'bcdef')))
+
+        self.assertEqual(stream.pop_data(1024)[0], b'abcdef')
+        self.assertEqual(stream.retransmitted, 2)
+
+    def test_wraparound(self):
+        stream = self._stream()
+        stream.push(0, segment(0xfffffffe, b'ab'))
+        self.assertFalse(stream.push(0, segment(2, b'ef')))
+        self.assertTrue(stream.push(0, segment(0, b'cd')))
+
+        self.assertEqual(stream.pop_data(1024)[0], b'abcdef')
+        self.assertEqual(stream.gaps, 0)
+
+    def test_gap_by_size(self):
+        stream = self._stream(max_reorder_bytes=4)
+        stream.push(0, segment(100, b'abc'))
+        self.assertFalse(stream.push(0, segment(106, b'gh')))
+        self.assertTrue(stream.push(0, segment(108, b'ijk')))
+
+        self.assertEqual(stream.pop_data(1024)[0], b'abcghijk')
+        self.assertEqual(stream.gaps, 1)
+        self.assertEqual(stream.skipped, 3)
+
+    def test_gap_by_time(self):
+        stream = self._stream(max_reorder_delay=1.0)
+        stream.push(1.0, segment(100, b'abc'))
+        self.assertFalse(stream.push(1.5, segment(106, b'gh')))
+        self.assertTrue(stream.push(3.0, segment(108, b'ij')))
+
+        self.assertEqual(stream.pop_data(1024)[0], b'abcghij')
+        self.assertEqual(stream.gaps, 1)
+
+    def test_fin(self):
+        stream = self._stream()
+        stream.push(0, segment(100, b'abc'))
+        # the FIN arrives before the last segment
+        stream.push(0, segment(106, b'', flags=dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK))
+        self.assertFalse(stream.closed)
+        stream.push(0, segment(103, b'def'))
+
+        self.assertTrue(stream.closed)
+        self.assertEqual(stream.pop_data(1024)[0], b'abcdef')
+
+
+class ClosingHandler(object):
+    def __init__(self):
+        self.closed = []
+        self.streams = []
+
+    def __call__(self, stream):
+        pass
+
+    def close_stream(self, stream):
+        self.closed.append(stream.remaining)
+        self.streams.append(stream)
+
+
+class DispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_rst(self):
+        dispatcher = Dispatcher(None, start=False)
+        handler = ClosingHandler()
+        dispatcher.add_handler(handler)
+
+        dispatcher.dispatch(1.0, packet(100, b'abc'))
+        self.assertEqual(dispatcher.active_streams, 1)
+        dispatcher.dispatch(2.0, packet(103, b'', flags=dpkt.tcp.TH_RST))
+
+        self.assertEqual(dispatcher.active_streams, 0)
+        self.assertEqual(dispatcher.closed_streams, 1)
+        self.assertEqual(handler.closed, [3])
+
+        # trailing ACKs don't bring the stream back
+        dispatcher.dispatch(2.5, packet(103, b''))
+        self.assertEqual(dispatcher.active_streams, 0)
+
+    def test_endpoints(self):
+        dispatcher = Dispatcher(None, start=False)
+        handler = ClosingHandler()
+        dispatcher.add_handler(handler)
+
+        tcp_p = packet(100, b'abc')._replace(
+            src=b'\x0a\x00\x00\x01', dst=b'\x0a\x00\x00\x02')
+        dispatcher.dispatch(1.0, tcp_p)
+        dispatcher.close_streams()
+
+        stream = handler.streams[0]
+        self.assertEqual(stream.src, '10.0.0.1:51112')
+        self.assertEqual(stream.dst, '10.0.0.2:9090')
+
+    def test_idle_eviction(self):
+        dispatcher = Dispatcher(None, start=False, idle_timeout=10)
+        handler = ClosingHandler()
+        dispatcher.add_handler(handler)
+
+        dispatcher.dispatch(1.0, packet(100, b'abc'))
+        dispatcher.dispatch(8.0, packet(103, b'def'))
+        dispatcher.expire(15.0)
+        self.assertEqual(dispatcher.active_streams, 1)
+
+        dispatcher.expire(20.0)
+        self.assertEqual(dispatcher.active_streams, 0)
+        self.assertEqual(dispatcher.evicted_streams, 1)
+        self.assertEqual(handler.closed, [6])
+
+    def test_quarantine(self):
+        dispatcher = Dispatcher(None, start=False, quarantine_timeout=60)
+        handler = StreamHandler(deque(), quarantine_after=10)
+        dispatcher.add_handler(handler)
+
+        dispatcher.dispatch(1.0, packet(100, b'GET / '))
+        self.assertEqual(dispatcher.ignored_streams, 0)
+        dispatcher.dispatch(2.0, packet(106, b'HTTP/1.1'))
+        self.assertEqual(dispatcher.ignored_streams, 1)
+        self.assertEqual(dispatcher.active_streams, 0)
+        self.assertEqual(handler.active_streams, 0)
+
+        # dropped before they get to a stream
+        dispatcher.dispatch(3.0, packet(114, b'\r\n'))
+        self.assertEqual(dispatcher.ignored_packets, 1)
+        self.assertEqual(dispatcher.active_streams, 0)
+
+        dispatcher.expire(70.0)
+        self.assertEqual(dispatcher.ignored_streams, 0)
+        dispatcher.dispatch(71.0, packet(116, b'\r\n'))
+        self.assertEqual(dispatcher.active_streams, 1)
+
+    def test_quarantine_until_fin(self):
+        dispatcher = Dispatcher(None, start=False)
+        dispatcher.add_handler(StreamHandler(deque(), quarantine_after=1))
+
+        dispatcher.dispatch(1.0, packet(100, b'abc'))
+        dispatcher.dispatch(2.0, packet(103, b'', dpkt.tcp.TH_FIN))
+        self.assertEqual(dispatcher.ignored_streams, 0)
+        self.assertEqual(dispatcher.ignored_packets, 1)
+
+    def test_dispatch_errors(self):
+        queue = BatchQueue()
+        dispatcher = Dispatcher(queue)
+        queue.extend([(1.0, object()), (2.0, packet(100, b'abc')), (3.0, object())])
+
+        # counted, instead of taking the dispatcher down
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(dispatcher.errors, 2)
+        dispatcher.stop(wait_for_stopped=True)
+
+    def test_timing_wheel(self):
+        wheel = TimingWheel(tick=1.0, slots=4)
+        wheel.advance(0)
+        wheel.schedule('a', 2)
+        wheel.schedule('b', 9)  # more than a turn away
+
+        self.assertEqual(wheel.advance(3), ['a'])
+        self.assertEqual(wheel.advance(8), [])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(9), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+
+class RingCaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _capture(self, frames, block_size=4096):
+        """ a RingCapture over a single block with the given frames """
+        capture = RingCapture.__new__(RingCapture)
+        capture._ring = bytearray(block_size)
+        capture._block_size = block_size
+        capture._block_nr = 1
+        capture._block = 0
+        capture._lo_ifindex = 1
+
+        first = 48
+        struct.pack_into('=III', capture._ring, 8,
+                         TP_STATUS_USER, len(frames), first)
+        pkt = first
+        for sec, ifindex, pkttype, frame in frames:
+            mac = 80
+            next_offset = mac + len(frame) + 16 - len(frame) % 16
+            struct.pack_into('=IIIIIIH', capture._ring, pkt, next_offset, sec,
+                             0, len(frame), len(frame), 0, mac)
+            struct.pack_into('=4xi2xB', capture._ring, pkt + 48,
+                             ifindex, pkttype)
+            capture._ring[pkt + mac:pkt + mac + len(frame)] = frame
+            pkt += next_offset
+
+        return capture
+
+    def test_read_block(self):
+        capture = self._capture([
+            (1, 1, 0, b'in on lo'),
+            (2, 1, PACKET_OUTGOING, b'out on lo'),
+            (3, 2, PACKET_OUTGOING, b'out on eth'),
+        ])
+
+        # what's sent on the loopback is also received, so it's skipped
+        self.assertEqual(
+            [(ts, bytes(frame)) for ts, frame in capture.read_block()],
+            [(1, b'in on lo'), (3, b'out on eth')])
+
+        # and the block went back to the kernel
+        status, = struct.unpack_from('=I', capture._ring, 8)
+        self.assertEqual(status, TP_STATUS_KERNEL)
+
+    def test_ring_options(self):
+        for block_size, blocks in ((1000, 16), (0, 16), (1 << 18, 0)):
+            with self.assertRaises(ValueError):
+                Sniffer('lo', 9090, ring_block_size=block_size,
+                        ring_blocks=blocks)
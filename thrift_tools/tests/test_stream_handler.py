@@ -0,0 +1,277 @@
+from collections import deque
+
+import struct
+import unittest
+
+import dpkt
+
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+
+from thrift_tools.sniffer import Sniffer, Stream
+from thrift_tools.stream_handler import StreamContext, StreamHandler
+from thrift_tools.thrift_message import ThriftMessage
+
+from .test_message_scanner import message
+from .util import get_pcap_path
+
+
+PING = ThriftMessage.ping()  # framed
+
+
+class StreamHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.seq = 100
+        self.stream = Stream('127.0.0.1:51112', '127.0.0.1:9090')
+        self.queue = deque()
+
+    def tearDown(self):
+        pass
+
+    def push(self, handler, data, timestamp=0, handle=True):
+        tcp_p = dpkt.tcp.TCP(seq=self.seq, flags=dpkt.tcp.TH_ACK, data=data)
+        self.seq += len(data)
+        self.stream.push(timestamp, tcp_p)
+        if handle:
+            handler(self.stream)
+
+    def test_framed(self):
+        handler = StreamHandler(self.queue, framed=True)
+
+        # a few frames in a single segment
+        self.push(handler, PING * 3)
+        self.assertEqual(len(self.queue), 3)
+
+        # and a frame split across segments
+        self.push(handler, PING[:6])
+        self.assertEqual(len(self.queue), 3)
+        self.push(handler, PING[6:])
+        self.assertEqual(len(self.queue), 4)
+        self.assertEqual(self.queue[-1][3].method, 'ping')
+
+    def test_framed_pipelined(self):
+        handler = StreamHandler(self.queue, framed=True)
+        data = PING * 200
+        for idx in range(0, len(data), 100):
+            self.push(handler, data[idx:idx + 100])
+
+        self.assertEqual(len(self.queue), 200)
+        self.assertEqual(len(handler._contexts_by_streams[self.stream]), 0)
+
+    def test_drains_all_messages(self):
+        handler = StreamHandler(self.queue)
+
+        # several messages, with the last one split across segments
+        ping = PING[4:]
+        self.push(handler, ping * 3 + ping[:5], timestamp=1.0, handle=False)
+        self.push(handler, ping[5:] + ping, timestamp=2.0, handle=False)
+        handler(self.stream)
+
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual([ts for ts, _, _, _ in self.queue], [1.0, 1.0, 1.0, 2.0, 2.0])
+        self.assertEqual(self.stream.remaining, 0)
+
+    def test_split_message(self):
+        handler = StreamHandler(self.queue, read_values=True)
+        data = message(TBinaryProtocol, items=100)
+        for idx in range(0, len(data), 100):
+            self.push(handler, data[idx:idx + 100])
+            if idx + 100 < len(data):
+                self.assertIsNotNone(handler._contexts_by_streams[self.stream].scanner)
+
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue[0][3].method, 'search')
+        self.assertEqual(len(handler._contexts_by_streams[self.stream]), 0)
+
+    def test_stream_context(self):
+        context = StreamContext()
+        context.append(b'abcd', 1.0)
+        context.consume(3)
+        context.append(memoryview(b'ef'), 2.0)
+
+        self.assertEqual(len(context), 3)
+        self.assertEqual(context.view().tobytes(), b'def')
+        self.assertEqual(context.timestamp, 2.0)
+
+        context.clear()
+        self.assertEqual(context.view().tobytes(), b'')
+
+    def test_framed_resync(self):
+        handler = StreamHandler(self.queue, framed=True)
+
+        # garbage before the frame (i.e.: joined mid-stream)
+        self.push(handler, b'\x00\x00\x00\x0a\xff\xff' + PING)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue[0][3].method, 'ping')
+
+    def test_framed_bogus_partial_frame(self):
+        handler = StreamHandler(
+            self.queue, framed=True, max_message_size=200000)
+
+        # what's left of a frame, read as an old-style message, asks for a
+        # 16MB method name: that's not a frame to wait on
+        self.push(handler, PING + struct.pack('!i', 102784) +
+                  b'\x01\x00\x01\x00' + b'\xff' * 8 + PING * 3)
+        self.assertEqual(len(self.queue), 4)
+
+    def test_framed_bad_frame(self):
+        handler = StreamHandler(self.queue, framed=True)
+
+        # right after a good one, a frame that can't be read is skipped as
+        # a whole instead of looking for messages inside it
+        bad = b'\xff' * 4 + PING
+        self.push(handler, PING + struct.pack('!i', len(bad)) + bad + PING)
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(handler.skipped_bytes, len(bad) + 4)
+
+    def test_learns_stream(self):
+        handler = StreamHandler(self.queue)
+
+        # the first message tells us the stream is framed binary
+        self.push(handler, PING)
+        context = handler._contexts_by_streams[self.stream]
+        self.assertEqual(context.protocol, TBinaryProtocol)
+        self.assertTrue(context.framed)
+        self.assertFalse(context.finagle_header)
+
+        # so the rest are read as frames
+        self.push(handler, PING * 2 + PING[:6])
+        self.push(handler, PING[6:])
+        self.assertEqual(len(self.queue), 4)
+        self.assertEqual(len(context), 0)
+
+    def test_forgets_stream(self):
+        handler = StreamHandler(self.queue)
+        self.push(handler, PING[4:])
+        context = handler._contexts_by_streams[self.stream]
+        self.assertEqual(context.protocol, TBinaryProtocol)
+
+        # it's only detected again after failing to read it as binary
+        compact = ThriftMessage.ping(TCompactProtocol)[4:]
+        self.push(handler, compact * 2)
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(context.protocol, TCompactProtocol)
+        self.assertEqual(context.failures, 0)
+
+    def test_trust_boundaries(self):
+        handler = StreamHandler(self.queue, trust_boundaries=True)
+        ping = PING[4:]
+
+        # garbage before the first message isn't counted as skipped
+        self.push(handler, b'\xff' * 3 + ping * 2)
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(handler.skipped_bytes, 0)
+
+        # but after it, it means we lost track of the stream
+        self.push(handler, ping[:5] + ping * 2)
+        self.assertEqual(len(self.queue), 4)
+        self.assertEqual(handler.skipped_bytes, 5)
+        self.assertEqual(handler.resyncs, 1)
+
+        # a message split across segments is waited on
+        self.push(handler, ping[:6])
+        self.push(handler, ping[6:])
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual(handler.resyncs, 1)
+
+    def test_trust_boundaries_short_tail(self):
+        handler = StreamHandler(self.queue, trust_boundaries=True)
+        ping = PING[4:]
+
+        # a tail shorter than any message is waited on
+        self.push(handler, ping + ping[:2])
+        self.assertEqual(len(self.queue), 1)
+        self.push(handler, ping[2:])
+        self.assertEqual(len(self.queue), 2)
+
+        # and so it is once nothing is known about the stream anymore
+        handler._contexts_by_streams[self.stream].forget()
+        self.push(handler, ping[:2])
+        self.assertEqual(len(self.queue), 2)
+        self.push(handler, ping[2:])
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(handler.resyncs, 0)
+
+    def test_framed_finagle(self):
+        handler = StreamHandler(
+            self.queue, finagle_thrift=True, framed=True, read_values=True)
+
+        sniffer = Sniffer(None, 9090, handler, offline=get_pcap_path('finagle-thrift'))
+        sniffer.join()
+
+        self.assertEqual(len(self.queue), 22)
+        _, _, _, msg = self.queue[2]
+        self.assertEqual(msg.method, 'search')
+        self.assertEqual(len(msg.header), 4)
+
+    def test_header_only(self):
+        for framed in (False, True):
+            queue = deque()
+            handler = StreamHandler(
+                queue, finagle_thrift=True, framed=framed, header_only=True)
+
+            sniffer = Sniffer(None, 9090, handler, offline=get_pcap_path('finagle-thrift'))
+            sniffer.join()
+
+            self.assertEqual(len(queue), 22)
+            _, _, _, msg = queue[2]
+            self.assertEqual(msg.method, 'search')
+            self.assertEqual(len(msg.header), 4)
+            self.assertEqual(len(msg.args), 0)
+
+    def test_oversized_message(self):
+        handler = StreamHandler(self.queue, max_message_size=500)
+        ping = PING[4:]
+        big = message(TBinaryProtocol, items=50)
+
+        self.push(handler, ping)
+        for idx in range(0, len(big), 100):
+            self.push(handler, big[idx:idx + 100])
+            context = handler._contexts_by_streams[self.stream]
+            self.assertTrue(len(context) < 600)
+        self.push(handler, ping)
+
+        self.assertEqual([msg.method for _, _, _, msg in self.queue],
+                         ['ping', 'search', 'ping'])
+        self.assertEqual(len(self.queue[1][3]), len(big))
+        self.assertEqual(handler.oversized_msgs, 1)
+        self.assertTrue(handler.oversized_bytes > len(big) - 600)
+
+    def test_oversized_frame(self):
+        handler = StreamHandler(self.queue, max_message_size=500, framed=True)
+        big = message(TBinaryProtocol, items=50)
+        data = struct.pack('!i', len(big)) + big + PING
+
+        for idx in range(0, len(data), 700):
+            self.push(handler, data[idx:idx + 700])
+
+        self.assertEqual([msg.method for _, _, _, msg in self.queue],
+                         ['search', 'ping'])
+        self.assertEqual(len(self.queue[0][3]), len(big))
+        self.assertEqual(handler.oversized_bytes, len(big) + 4)
+        self.assertEqual(len(handler._contexts_by_streams[self.stream]), 0)
+
+    def test_oversized_frame_garbage(self):
+        handler = StreamHandler(self.queue, max_message_size=500, framed=True)
+
+        # what looks like the size of a frame that's too big is followed by
+        # something that isn't a message, it's skipped instead of waited on
+        garbage = struct.pack('!i', 1000) + b'\xff' * 12
+        self.push(handler, garbage + PING * 3)
+
+        self.assertEqual([msg.method for _, _, _, msg in self.queue],
+                         ['ping'] * 3)
+        self.assertEqual(handler.oversized_msgs, 0)
+
+    def test_oversized_dropped(self):
+        handler = StreamHandler(
+            self.queue, max_message_size=500, max_skipped_size=0)
+        ping = PING[4:]
+        big = message(TBinaryProtocol, items=50)
+
+        self.push(handler, ping)
+        for idx in range(0, len(big), 100):
+            self.push(handler, big[idx:idx + 100])
+
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(handler.oversized_msgs, 0)
@@ -1,7 +1,14 @@
 import unittest
 
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+from thrift.transport import TTransport
+
+from thrift_tools.decoders import decoder_for
 from thrift_tools.thrift_struct import ThriftField, ThriftStruct
 
+from .test_decoders import LIMITS, containers
+
 
 class ThriftStructTestCase(unittest.TestCase):
     """ Unit tests for ThriftStruct"""
@@ -31,6 +38,29 @@ class ThriftStructTestCase(unittest.TestCase):
         self.assertTrue(struct_1.is_isomorphic_to(struct_2))
         self.assertFalse(struct_1.is_isomorphic_to(struct_3))
 
+    def test_read_skips(self):
+        for protocol in (TBinaryProtocol, TCompactProtocol):
+            data = containers(protocol, items=20)
+            trans = TTransport.TMemoryBuffer(data)
+            reads = []
+            read_all = trans.readAll
+            trans.readAll = lambda sz: reads.append(sz) or read_all(sz)
+
+            proto = protocol(trans)
+            proto.readMessageBegin()
+            struct = ThriftStruct.read(proto, *LIMITS, read_values=False)
+
+            decoder = decoder_for(protocol, data, *LIMITS)
+            decoder.read_message_begin()
+            self.assertEqual(decoder.read_struct(), struct)
+            self.assertEqual(len(data), trans._buffer.tell())
+
+            # in the binary protocol, fixed width containers go in one read
+            if protocol is TBinaryProtocol:
+                self.assertIn(20 * 8, reads)  # list<i64>
+                self.assertIn(20 * (4 + 8), reads)  # map<i32, double>
+                self.assertIn(20 * (2 + 1), reads)  # map<i16, byte>
+
 
 class ThriftFieldTestCase(ThriftStructTestCase):
     """ Unit tests for ThriftField"""
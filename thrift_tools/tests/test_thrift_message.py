@@ -0,0 +1,72 @@
+import unittest
+
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+from thrift.protocol.TJSONProtocol import TJSONProtocol
+
+from thrift_tools.thrift_message import ThriftMessage
+
+from .test_message_scanner import message
+
+
+NOISE = b'\x00\x01\x80\x82\x00\x00\x00[1,' * 100
+
+
+class ThriftMessageTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _candidates(self, protocol, **kwargs):
+        data = NOISE + ThriftMessage.ping(protocol or TBinaryProtocol)[4:]
+        return data, list(ThriftMessage.candidates(data, protocol=protocol, **kwargs))
+
+    def test_candidates_binary(self):
+        data, candidates = self._candidates(TBinaryProtocol)
+        # the strict start, and the name length right after it
+        self.assertEqual(candidates, [len(NOISE), len(NOISE) + 4])
+
+    def test_candidates_compact(self):
+        data, candidates = self._candidates(TCompactProtocol)
+        self.assertEqual(candidates, [len(NOISE)])
+
+    def test_candidates_json(self):
+        data, candidates = self._candidates(TJSONProtocol)
+        self.assertEqual(candidates, [len(NOISE)])
+
+    def test_candidates_any_protocol(self):
+        data, candidates = self._candidates(None)
+        self.assertEqual(candidates[0], len(NOISE))
+
+        msg, _ = ThriftMessage.read(memoryview(data)[candidates[0]:])
+        self.assertEqual(msg.method, 'ping')
+
+    def test_candidates_finagle(self):
+        data, candidates = self._candidates(None, finagle_thrift=True)
+        self.assertEqual(candidates, list(range(len(data))))
+
+    def test_read_header(self):
+        for protocol in (TBinaryProtocol, TCompactProtocol, TJSONProtocol):
+            data = message(protocol, items=20)
+            full, msglen = ThriftMessage.read(data, protocol=protocol)
+
+            msg, length = ThriftMessage.read_header(
+                memoryview(data + b'\x00' * 10))
+            self.assertEqual(length, msglen)
+            self.assertEqual(
+                (msg.method, msg.type, msg.seqid),
+                (full.method, full.type, full.seqid))
+            if protocol is not TJSONProtocol:
+                self.assertEqual(len(msg.args), 0)
+
+    def test_read_header_framed(self):
+        data = ThriftMessage.ping()
+        msg, length = ThriftMessage.read_header(data[4:], length=len(data) - 4)
+        self.assertEqual(msg.method, 'ping')
+        self.assertEqual(length, len(data) - 4)
+
+    def test_read_header_incomplete(self):
+        data = message(TBinaryProtocol)
+        self.assertRaises(EOFError, ThriftMessage.read_header, data[:-1])
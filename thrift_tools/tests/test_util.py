@@ -0,0 +1,108 @@
+import socket
+import struct
+import unittest
+
+import dpkt
+
+from thrift_tools.pcap_file import (
+    LINKTYPE_ETHERNET,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_LINUX_SLL2,
+    LINKTYPE_NULL,
+    LINKTYPE_RAW,
+)
+from thrift_tools.util import decode_frame
+
+
+SRC = socket.inet_pton(socket.AF_INET, '10.0.0.1')
+DST = socket.inet_pton(socket.AF_INET, '10.0.0.2')
+SRC6 = socket.inet_pton(socket.AF_INET6, 'fe80::1')
+DST6 = socket.inet_pton(socket.AF_INET6, 'fe80::2')
+
+
+def tcp(data=b'payload'):
+    return dpkt.tcp.TCP(
+        sport=51112, dport=9090, seq=1234, flags=dpkt.tcp.TH_ACK, data=data)
+
+
+def ip4(data=b'payload', **kwargs):
+    ip_p = dpkt.ip.IP(src=SRC, dst=DST, p=dpkt.ip.IP_PROTO_TCP, data=tcp(data), **kwargs)
+    ip_p.len = len(bytes(ip_p))
+    return ip_p
+
+
+def ip6(data=b'payload'):
+    tcp_p = bytes(tcp(data))
+    header = struct.pack('!IHBB', 6 << 28, len(tcp_p), dpkt.ip.IP_PROTO_TCP, 64)
+    return header + SRC6 + DST6 + tcp_p
+
+
+def ethernet(ip_p, ethertype=dpkt.ethernet.ETH_TYPE_IP, vlans=0):
+    header = b'\x00' * 12
+    for _ in range(vlans):
+        header += struct.pack('!HH', 0x8100, 42)
+    return header + struct.pack('!H', ethertype) + bytes(ip_p)
+
+
+class DecodeFrameTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _check(self, packet, src=SRC, dst=DST, data=b'payload'):
+        self.assertIsNotNone(packet)
+        self.assertEqual(packet.src, src)
+        self.assertEqual(packet.dst, dst)
+        self.assertEqual((packet.sport, packet.dport), (51112, 9090))
+        self.assertEqual(packet.seq, 1234)
+        self.assertEqual(packet.flags, dpkt.tcp.TH_ACK)
+        self.assertEqual(bytes(packet.data), data)
+
+    def test_ethernet(self):
+        self._check(decode_frame(ethernet(ip4())))
+
+    def test_ethernet_padding(self):
+        # short frames get padded up to 60 bytes, which isn't payload
+        frame = ethernet(ip4(b'x')) + b'\x00' * 5
+        self._check(decode_frame(frame), data=b'x')
+
+    def test_vlan(self):
+        self._check(decode_frame(ethernet(ip4(), vlans=2)))
+
+    def test_ip6(self):
+        frame = ethernet(ip6(), dpkt.ethernet.ETH_TYPE_IP6)
+        self._check(decode_frame(frame), SRC6, DST6)
+
+    def test_linux_sll(self):
+        frame = b'\x00' * 14 + struct.pack('!H', 0x0800) + bytes(ip4())
+        self._check(decode_frame(frame, LINKTYPE_LINUX_SLL))
+
+    def test_linux_sll2(self):
+        frame = struct.pack('!H', 0x86dd) + b'\x00' * 18 + bytes(ip6())
+        self._check(decode_frame(frame, LINKTYPE_LINUX_SLL2), SRC6, DST6)
+
+    def test_null(self):
+        frame = struct.pack('<I', 2) + bytes(ip4())
+        self._check(decode_frame(frame, LINKTYPE_NULL))
+
+    def test_raw(self):
+        self._check(decode_frame(bytes(ip6()), LINKTYPE_RAW), SRC6, DST6)
+
+    def test_fragment(self):
+        # more fragments set, handed over to dpkt
+        frame = ethernet(ip4(off=dpkt.ip.IP_MF))
+        self._check(decode_frame(frame))
+
+    def test_not_tcp(self):
+        udp_p = dpkt.ip.IP(src=SRC, dst=DST, p=dpkt.ip.IP_PROTO_UDP,
+                           data=dpkt.udp.UDP(data=b'payload'))
+        self.assertIsNone(decode_frame(ethernet(udp_p)))
+        self.assertIsNone(decode_frame(ethernet(ip4(), ethertype=0x0806)))
+        self.assertIsNone(decode_frame(b'\x00' * 20))
+
+    def test_truncated(self):
+        for linktype in (LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL,
+                         LINKTYPE_LINUX_SLL2, LINKTYPE_NULL, LINKTYPE_RAW):
+            self.assertIsNone(decode_frame(b'', linktype))
@@ -9,10 +9,8 @@ try:
 except ImportError:
     HAS_MMAP = False
 
-from thrift.transport import TTransport
-
+from .decoders import decoder_for
 from .thrift_message import ThriftMessage
-from .thrift_struct import ThriftStruct
 
 
 class ThriftFile(object):
@@ -90,7 +88,9 @@ class ThriftMessageFile(ThriftFile):
         self._finagle_thrift = finagle_thrift
 
     def _read_next(self, start, end):
-        for idx in range(start, end):
+        candidates = ThriftMessage.candidates(
+            self._data, start, end, finagle_thrift=self._finagle_thrift)
+        for idx in candidates:
             try:
                 msg, _ = ThriftMessage.read(self._data_slice(idx),
                                             finagle_thrift=self._finagle_thrift,
@@ -129,15 +129,14 @@ class ThriftStructFile(ThriftFile):
     def _read_next(self, start, end):
         for idx in range(start, end):
             try:
-                trans = TTransport.TMemoryBuffer(self._data_slice(idx))
-                proto = self._protocol(trans)
-                tstruct = ThriftStruct.read(
-                    proto,
+                decoder = decoder_for(
+                    self._protocol,
+                    self._data_slice(idx),
                     max_fields=ThriftStructFile.MAX_FIELDS,
                     max_list_size=ThriftStructFile.MAX_LIST_SIZE,
                     max_map_size=ThriftStructFile.MAX_MAP_SIZE,
-                    max_set_size=ThriftStructFile.MAX_SET_SIZE,
-                    read_values=self._read_values)
+                    max_set_size=ThriftStructFile.MAX_SET_SIZE)
+                tstruct = decoder.read_struct(self._read_values)
                 skipped = idx - start
                 return (tstruct, None) if skipped == 0 else (tstruct, (start, skipped))
             except Exception as ex:
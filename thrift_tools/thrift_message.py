@@ -1,7 +1,11 @@
 """ helpers for deserializing Thrift messages """
 
-from struct import unpack
+from struct import pack, unpack
 
+import re
+
+from .decoders import decoder_for
+from .message_scanner import MessageScanner
 from .thrift_struct import ThriftStruct
 from .util import to_bytes
 
@@ -74,6 +78,27 @@ class ThriftMessage(object):
     # For Compact, the empty ping() gets through in 8 bytes
     MIN_MESSAGE_SIZE = 8
 
+    # what the start of a message looks like: the method name's length has
+    # to be plausible, followed by something that could be its first char
+    _NAME = (b'[\x01-' + re.escape(pack('!B', MAX_METHOD_LENGTH)) + b']'
+             b'[\x21-\x7e]')
+    # strict (version & message type) or old style (name right away)
+    _BINARY_START = b'(?:\x80\x01\x00[\x01-\x04])?\x00\x00\x00' + _NAME
+    # protocol id, version & message type, the seqid (varint), the name
+    _COMPACT_START = b'\x82[\x21\x41\x61\x81][\x80-\xff]{0,4}[\x00-\x7f]' + _NAME
+    _JSON_START = b'\\[1,"[\x21-\x7e]'
+
+    # enough bytes to tell whether a message might start somewhere
+    MAX_START_LENGTH = 16
+
+    _START_PATTERNS = {
+        TBinaryProtocol: re.compile(b'(?=' + _BINARY_START + b')'),
+        TCompactProtocol: re.compile(b'(?=' + _COMPACT_START + b')'),
+        TJSONProtocol: re.compile(b'(?=' + _JSON_START + b')'),
+        None: re.compile(b'(?=' + b'|'.join(
+            (_BINARY_START, _COMPACT_START, _JSON_START)) + b')'),
+    }
+
     # some sane defaults to keep memory usage tight
     MAX_FIELDS = 1000
     MAX_LIST_SIZE = 1000000
@@ -89,8 +114,81 @@ class ThriftMessage(object):
              max_list_size=MAX_LIST_SIZE,
              max_map_size=MAX_MAP_SIZE,
              max_set_size=MAX_SET_SIZE,
-             read_values=False):
-        """ tries to deserialize a message, might fail if data is missing """
+             read_values=False,
+             idl=None,
+             lazy=False):
+        """
+        tries to deserialize a message, might fail if data is missing
+
+        When reading values, the args of the methods idl (an Idl, from
+        parse_idl_file()) knows are decoded by thrift's C extension. With
+        lazy, binary & compact args are a LazyThriftStruct instead: they
+        are only decoded if & when they are looked at.
+        """
+        limits = (max_fields, max_list_size, max_map_size, max_set_size)
+        decoder, header, method, mtype, seqid = cls._read_envelope(
+            data, protocol, fallback_protocol, finagle_thrift, limits,
+            read_values)
+
+        args = None
+        if idl is not None and read_values and not lazy:
+            spec = idl.thrift_spec(method, mtype)
+            if spec is not None:
+                args = decoder.read_spec(spec)
+        if args is None:
+            args = decoder.read_struct(read_values, lazy=lazy)
+
+        decoder.read_message_end()
+
+        msglen = decoder.position
+
+        return cls(method, mtype, seqid, args, header, msglen), msglen
+
+    @classmethod
+    def read_header(cls, data,
+                    protocol=None,
+                    fallback_protocol=TBinaryProtocol,
+                    finagle_thrift=False,
+                    length=None,
+                    max_fields=MAX_FIELDS,
+                    max_list_size=MAX_LIST_SIZE,
+                    max_map_size=MAX_MAP_SIZE,
+                    max_set_size=MAX_SET_SIZE):
+        """
+        Like read(), but only the method, type & seqid (and finagle-thrift's
+        header) are deserialized, the args are left empty. The message's
+        length is the given one (i.e.: its frame's), otherwise the args are
+        only walked through by a MessageScanner to find where it ends.
+        """
+        if len(data) < cls.MIN_MESSAGE_SIZE:
+            raise ValueError('not enough data: %d' % len(data))
+
+        if protocol is None:
+            protocol = cls.detect_protocol(data, fallback_protocol)
+
+        if length is None:
+            if not MessageScanner.supports(protocol):
+                # i.e.: JSON, there's no way around reading it
+                return cls.read(
+                    data, protocol, fallback_protocol, finagle_thrift,
+                    max_fields, max_list_size, max_map_size, max_set_size)
+
+            length = MessageScanner(protocol, finagle_thrift).scan(data)
+            if length is None:
+                raise EOFError('incomplete message')
+
+        # finagle-thrift's header is small, so it's read with its values
+        limits = (max_fields, max_list_size, max_map_size, max_set_size)
+        _, header, method, mtype, seqid = cls._read_envelope(
+            data[:length], protocol, fallback_protocol, finagle_thrift, limits,
+            read_values=True)
+
+        return cls(method, mtype, seqid, ThriftStruct([]), header, length), length
+
+    @classmethod
+    def _read_envelope(cls, data, protocol, fallback_protocol, finagle_thrift,
+                       limits, read_values):
+        """ reads up to the args, returns (decoder, header, method, type, seqid) """
 
         # do we have enough data?
         if len(data) < cls.MIN_MESSAGE_SIZE:
@@ -98,8 +196,7 @@ class ThriftMessage(object):
 
         if protocol is None:
             protocol = cls.detect_protocol(data, fallback_protocol)
-        trans = TTransport.TMemoryBuffer(data)
-        proto = protocol(trans)
+        decoder = decoder_for(protocol, data, *limits)
 
         # finagle-thrift prepends a RequestHeader
         #
@@ -107,20 +204,13 @@ class ThriftMessage(object):
         header = None
         if finagle_thrift:
             try:
-                header = ThriftStruct.read(
-                    proto,
-                    max_fields,
-                    max_list_size,
-                    max_map_size,
-                    max_set_size,
-                    read_values)
+                header = decoder.read_struct(read_values)
             except Exception as ex:
                 # reset stream, maybe it's not finagle-thrift
-                trans = TTransport.TMemoryBuffer(data)
-                proto = protocol(trans)
+                decoder.reset()
 
         # unpack the message
-        method, mtype, seqid = proto.readMessageBegin()
+        method, mtype, seqid = decoder.read_message_begin()
         mtype = cls.message_type_to_str(mtype)
 
         if len(method) == 0 or method.isspace() or method.startswith(' '):
@@ -135,21 +225,37 @@ class ThriftMessage(object):
         if any(ord(char) not in valid for char in method):
             raise ValueError('invalid method name' % method)
 
-        args = ThriftStruct.read(
-            proto,
-            max_fields,
-            max_list_size,
-            max_map_size,
-            max_set_size,
-            read_values)
-
-        proto.readMessageEnd()
+        return decoder, header, method, mtype, seqid
 
-        # Note: this is a bit fragile, the right thing would be to count bytes
-        # as we read them (i.e.: when calling readI32, etc).
-        msglen = trans._buffer.tell()
-
-        return cls(method, mtype, seqid, args, header, msglen), msglen
+    @classmethod
+    def candidates(cls, data, start=0, end=None, protocol=None,
+                   finagle_thrift=False):
+        """
+        Yields the offsets, within data[start:end], at which a message might
+        start so read() is only tried there instead of at every byte.
+
+        finagle-thrift (which prepends a header) and protocols we don't know
+        the look of get every offset.
+        """
+        if end is None:
+            end = len(data)
+
+        pattern = None
+        if not finagle_thrift:
+            pattern = cls._START_PATTERNS.get(protocol)
+            if pattern is None:
+                # i.e.: the accelerated versions
+                for proto_class in (TBinaryProtocol, TCompactProtocol, TJSONProtocol):
+                    if issubclass(protocol, proto_class):
+                        pattern = cls._START_PATTERNS[proto_class]
+
+        if pattern is None:
+            for idx in range(start, end):
+                yield idx
+            return
+
+        for match in pattern.finditer(data, start, end):
+            yield match.start()
 
     @classmethod
     def ping(cls, protocol=TBinaryProtocol):
@@ -203,7 +309,7 @@ class ThriftMessage(object):
     @classmethod
     def is_json_protocol(cls, data):
         # FIXME: more elaborate parsing would make this more robust
-        return data.tobytes().startswith(b'[1')
+        return bytes(data[:2]) == b'[1'
 
     @staticmethod
     def message_type_to_str(mtype):
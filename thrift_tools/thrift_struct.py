@@ -2,6 +2,19 @@
 
 from six.moves import range as xrange
 from thrift.Thrift import TType
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.protocol.TCompactProtocol import TCompactProtocol
+
+
+# what the fixed width types take in the binary protocol
+_BINARY_WIDTHS = {
+    TType.BOOL: 1,
+    TType.BYTE: 1,
+    TType.I16: 2,
+    TType.I32: 4,
+    TType.I64: 8,
+    TType.DOUBLE: 8,
+}
 
 
 class Error(Exception):
@@ -38,7 +51,7 @@ class ThriftStruct(object):
         Returns true if all fields of other struct are isomorphic to this
         struct's fields
         """
-        return (isinstance(other, self.__class__)
+        return (isinstance(other, ThriftStruct)
                 and
                 len(self.fields) == len(other.fields)
                 and
@@ -47,17 +60,17 @@ class ThriftStruct(object):
 
     def __eq__(self, other):
         """ we ignore the length, it might not be set """
-        return isinstance(other, self.__class__) and self.fields == other.fields
+        return isinstance(other, ThriftStruct) and self.fields == other.fields
 
     def __len__(self):
         """ number of fields, NOT number of bytes """
         return len(self._fields)
 
     def __getitem__(self, key):
-        return self._fields[key]
+        return self.fields[key]
 
     def __iter__(self):
-        return iter(self._fields)
+        return iter(self.fields)
 
     def __repr__(self):
         return "fields=%s" % self.fields
@@ -131,9 +144,8 @@ class ThriftStruct(object):
         #
         # Touching a line here should warrant writing another test case :-)
         #
-        # FIXME: the way bytes are skipped is very lame, we should calculate
-        #        the total number of bytes that are to be skipped, and have
-        #        the transport seek() to that point.
+        # Skipping goes through skip(), which takes fixed width items in one
+        # go when it can tell how many bytes they are.
 
         if ftype == TType.STRUCT:
             value = cls.read(
@@ -148,12 +160,12 @@ class ThriftStruct(object):
             if read_values:
                 value = proto.readI32()
             else:
-                proto.skip(ftype)
+                cls.skip(proto, ftype)
         elif ftype == TType.I64:
             if read_values:
                 value = proto.readI64()
             else:
-                proto.skip(ftype)
+                cls.skip(proto, ftype)
         elif ftype == TType.STRING:
             if read_values:
                 try:
@@ -161,7 +173,7 @@ class ThriftStruct(object):
                 except UnicodeDecodeError:
                     value = ''
             else:
-                proto.skip(ftype)
+                cls.skip(proto, ftype)
         elif ftype == TType.LIST:
             (etype, size) = proto.readListBegin()
             if size > max_list_size:
@@ -170,8 +182,7 @@ class ThriftStruct(object):
             if read_values:
                 value = [_read(etype) for _ in xrange(size)]
             else:
-                for _ in xrange(size):
-                    proto.skip(etype)
+                cls.skip(proto, etype, size)
             proto.readListEnd()
         elif ftype == TType.MAP:
             (ktype, vtype, size) = proto.readMapBegin()
@@ -184,9 +195,7 @@ class ThriftStruct(object):
                     v = _read(vtype)
                     value[k] = v
             else:
-                for _ in xrange(size):
-                    proto.skip(ktype)
-                    proto.skip(vtype)
+                cls._skip_pairs(proto, ktype, vtype, size)
             proto.readMapEnd()
         elif ftype == TType.SET:
             (etype, size) = proto.readSetBegin()
@@ -197,15 +206,69 @@ class ThriftStruct(object):
                 for _ in xrange(size):
                     value.add(_read(etype))
             else:
-                for _ in xrange(size):
-                    proto.skip(etype)
+                cls.skip(proto, etype, size)
             proto.readSetEnd()
         else:
             # for now, we ignore all other values
-            proto.skip(ftype)
+            cls.skip(proto, ftype)
 
         return value
 
+    @classmethod
+    def skip(cls, proto, ttype, count=1):
+        """
+        Like proto.skip(), for count values of ttype. In the binary protocol
+        the fixed width ones are skipped in one go, and strings are never
+        decoded (but in JSON, where they can't be told from base64).
+        """
+        binary = isinstance(proto, TBinaryProtocol)
+        if binary and ttype in _BINARY_WIDTHS:
+            proto.trans.readAll(count * _BINARY_WIDTHS[ttype])
+        elif ttype == TType.STRING and (binary or isinstance(proto, TCompactProtocol)):
+            for _ in xrange(count):
+                proto.readBinary()
+        elif ttype == TType.STRUCT:
+            for _ in xrange(count):
+                proto.readStructBegin()
+                while True:
+                    _, ftype, _ = proto.readFieldBegin()
+                    if ftype == TType.STOP:
+                        break
+                    cls.skip(proto, ftype)
+                    proto.readFieldEnd()
+                proto.readStructEnd()
+        elif ttype == TType.MAP:
+            for _ in xrange(count):
+                ktype, vtype, size = proto.readMapBegin()
+                cls._skip_pairs(proto, ktype, vtype, size)
+                proto.readMapEnd()
+        elif ttype == TType.LIST:
+            for _ in xrange(count):
+                etype, size = proto.readListBegin()
+                cls.skip(proto, etype, size)
+                proto.readListEnd()
+        elif ttype == TType.SET:
+            for _ in xrange(count):
+                etype, size = proto.readSetBegin()
+                cls.skip(proto, etype, size)
+                proto.readSetEnd()
+        else:
+            for _ in xrange(count):
+                proto.skip(ttype)
+
+    @classmethod
+    def _skip_pairs(cls, proto, ktype, vtype, count):
+        """ the items of a map """
+        if (isinstance(proto, TBinaryProtocol) and ktype in _BINARY_WIDTHS
+                and vtype in _BINARY_WIDTHS):
+            width = _BINARY_WIDTHS[ktype] + _BINARY_WIDTHS[vtype]
+            proto.trans.readAll(count * width)
+            return
+
+        for _ in xrange(count):
+            cls.skip(proto, ktype)
+            cls.skip(proto, vtype)
+
     @staticmethod
     def field_type_to_str(ftype):
         if ftype == TType.STOP:
@@ -0,0 +1,64 @@
+""" A timing wheel, to expire lots of items without scanning all of them """
+
+
+class TimingWheel(object):
+    """
+    Items are bucketed by their deadline (with tick secs granularity) in a
+    ring of slots, so advancing the clock only looks at the slots that went
+    by. Deadlines further away than a full turn of the wheel just stay in
+    their slot until their turn comes.
+
+    The clock is whatever the caller says it is (i.e.: packet timestamps),
+    so this works the same for live & offline captures.
+
+    Ex:
+    >> wheel = TimingWheel(tick=1.0)
+    >> wheel.schedule(stream, timestamp + 60)
+    >> for stream in wheel.advance(timestamp):
+        ...
+    """
+
+    def __init__(self, tick=1.0, slots=256):
+        self._tick = float(tick)
+        self._slots = [[] for _ in range(slots)]
+        self._now = None  # in ticks
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def schedule(self, item, deadline):
+        tick = int(deadline // self._tick)
+        if self._now is not None and tick <= self._now:
+            tick = self._now + 1
+        self._slots[tick % len(self._slots)].append((tick, item))
+        self._size += 1
+
+    def advance(self, now):
+        """ moves the clock to now, returns the items that are due """
+        target = int(now // self._tick)
+        if self._now is None:
+            self._now = target
+            return []
+
+        if target <= self._now:
+            return []
+
+        nslots = len(self._slots)
+        expired = []
+        for tick in range(self._now + 1, min(target, self._now + nslots) + 1):
+            idx = tick % nslots
+            slot = self._slots[idx]
+            if not slot:
+                continue
+            pending = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    pending.append(entry)
+            self._slots[idx] = pending
+
+        self._now = target
+        self._size -= len(expired)
+        return expired
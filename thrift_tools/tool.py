@@ -10,8 +10,10 @@ from thrift.protocol.TBinaryProtocol import TBinaryProtocol
 from thrift.protocol.TCompactProtocol import TCompactProtocol
 from thrift.protocol.TJSONProtocol import TJSONProtocol
 
+from .batch_queue import BLOCK, DROP_OLDEST, QUEUE_POLICIES
 from .message_sniffer import MessageSnifferOptions, MessageSniffer
 from .printer import FormatOptions, LatencyPrinter, PairedPrinter, Printer
+from .sniffer import CAPTURE_BACKENDS, Dispatcher, RingCapture
 
 
 VALID_PROTOCOLS = 'auto, binary, compact or json'
@@ -29,8 +31,24 @@ def get_flags():  # pragma: no cover
     p.add_argument('--max-queued', type=int, default=20*1024,
                    metavar='<maxqueued>',
                    help='Max number of queued messages')
+    p.add_argument('--queue-policy', type=str, default=DROP_OLDEST,
+                   choices=QUEUE_POLICIES,
+                   help='What to do with new messages when --max-queued '
+                   'is reached')
+    p.add_argument('--max-queued-packets', type=int, default=100*1000,
+                   metavar='<maxpackets>',
+                   help='Max number of queued IP packets (0 for unbounded)')
+    p.add_argument('--packet-queue-policy', type=str, default=BLOCK,
+                   choices=QUEUE_POLICIES,
+                   help='What to do with new packets when '
+                   '--max-queued-packets is reached')
     p.add_argument('--max-message-size', type=int, default=10*1024,
                    help='Max bytes size for a Thrift message')
+    p.add_argument('--max-skipped-size', type=int, default=64*1024*1024,
+                   metavar='<bytes>',
+                   help='Messages bigger than --max-message-size (up to this '
+                   'size) are only read up to their seqid and the rest is '
+                   'skipped, 0 to drop them')
     p.add_argument('--ip', type=str, nargs='+',
                    help='Only show messages from/to this IP(s)')
     p.add_argument('--finagle-thrift', default=False, action='store_true',
@@ -42,9 +60,38 @@ def get_flags():  # pragma: no cover
                    help='Display debugging messages')
     p.add_argument('--framed', default=False, action='store_true',
                    help='Framed Thrift transport')
+    p.add_argument('--trust-boundaries', default=False, action='store_true',
+                   help='Once a message was read from a connection, only '
+                   'look for the next one where it ended (unless that fails)')
+    p.add_argument('--quarantine-after', type=int, default=None,
+                   metavar='<bytes>',
+                   help='Ignore connections that go this many bytes without '
+                   'a Thrift message (4 * --max-message-size if not '
+                   'given, 0 to never ignore them)')
+    p.add_argument('--quarantine-timeout', type=float,
+                   default=Dispatcher.QUARANTINE_TIMEOUT, metavar='<secs>',
+                   help='For how long ignored connections are ignored')
     p.add_argument('--protocol', type=str, default='auto',
                    help='Use a specific protocol. Options: %s' %
                    VALID_PROTOCOLS)
+    p.add_argument('--workers', type=int, default=0, metavar='<workers>',
+                   help='Number of processes to reassemble & decode streams '
+                   'in (0 means do it all in this process)')
+    p.add_argument('--lazy', default=False, action='store_true',
+                   help='Only decode the args of a message once they are '
+                   'looked at (i.e.: not for the ones that are filtered out)')
+    p.add_argument('--capture-backend', type=str, default='auto',
+                   choices=CAPTURE_BACKENDS,
+                   help='How to sniff live traffic: a TPACKET_V3 ring (Linux '
+                   'only), scapy or auto (the ring if available)')
+    p.add_argument('--ring-block-size', type=int,
+                   default=RingCapture.BLOCK_SIZE, metavar='<bytes>',
+                   help='Size of each block of the TPACKET_V3 ring (a multiple '
+                   'of the page size, and big enough for the largest packet)')
+    p.add_argument('--ring-blocks', type=int, default=RingCapture.BLOCK_NR,
+                   metavar='<blocks>',
+                   help='Number of blocks in the TPACKET_V3 ring, which stays '
+                   'in memory while sniffing')
 
     cmds = p.add_subparsers(dest='cmd')
 
@@ -131,8 +178,20 @@ def main():
         read_values=read_values,
         max_queued=flags.max_queued,
         max_message_size=flags.max_message_size,
+        max_skipped_size=flags.max_skipped_size,
         debug=flags.debug,
         framed=flags.framed,
+        capture_backend=flags.capture_backend,
+        ring_block_size=flags.ring_block_size,
+        ring_blocks=flags.ring_blocks,
+        workers=flags.workers,
+        max_queued_packets=flags.max_queued_packets,
+        packet_queue_policy=flags.packet_queue_policy,
+        queue_policy=flags.queue_policy,
+        trust_boundaries=flags.trust_boundaries,
+        quarantine_after=flags.quarantine_after,
+        quarantine_timeout=flags.quarantine_timeout,
+        lazy=flags.lazy,
         )
     message_sniffer = MessageSniffer(options, printer)
 
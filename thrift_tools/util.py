@@ -22,46 +22,182 @@ This comes from:
 
 https://github.com/twitter/zktraffic/blob/master/zktraffic/base/network.py
 
-with a few corner cases handled (i.e.: header.unpack() might raise an exception)
+with the link, IP & TCP headers decoded straight from the frame's bytes
 """
 
+from collections import namedtuple
+
 import socket
+import struct
 
 import dpkt
 
+from .pcap_file import (
+    LINKTYPE_ETHERNET,
+    LINKTYPE_IPV4,
+    LINKTYPE_IPV6,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_LINUX_SLL2,
+    LINKTYPE_LOOP,
+    LINKTYPE_NULL,
+    LINKTYPE_RAW,
+)
+
+
+# What the Dispatcher (and Stream) need out of a TCP segment. The addresses
+# are packed (4 or 16 bytes) and data is usually a memoryview of the frame.
+TcpPacket = namedtuple('TcpPacket', [
+    'src',
+    'dst',
+    'sport',
+    'dport',
+    'seq',
+    'flags',
+    'data',
+])
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+ETH_TYPE_8021Q = 0x8100
+ETH_TYPE_8021AD = 0x88a8
+IP_PROTO_TCP = 6
+
+# address families of BSD loopback headers (IPv6's differs between OSes)
+_AF_INET = 2
+_AF_INET6 = (10, 24, 28, 30)
+
+# IPv6 extension headers, left to dpkt
+_IP6_EXTENSION_HEADERS = frozenset((0, 43, 44, 50, 51, 60, 135, 139, 140))
+
+_ubyte = struct.Struct('!B')
+_ushort = struct.Struct('!H')
+_family_le = struct.Struct('<I')
+_family_be = struct.Struct('>I')
+# version/ihl, total length, flags/fragment offset, protocol, src, dst
+_ip4 = struct.Struct('!BxHxxHxB2x4s4s')
+# payload length, next header, src, dst
+_ip6 = struct.Struct('!4xHBx16s16s')
+# sport, dport, seq, data offset, flags
+_tcp = struct.Struct('!HHI4xBB')
+
+
+def decode_frame(frame, linktype=LINKTYPE_ETHERNET):
+    """
+    Decodes the link, IP & TCP headers of a frame straight from its bytes,
+    returns a TcpPacket or None if it isn't (or can't be decoded as) TCP.
+
+    The usual cases (Ethernet w/ or w/o VLAN tags, Linux cooked captures,
+    loopback and raw IP; plain IPv4 & IPv6) are handled with precompiled
+    structs, anything unusual (i.e.: IP fragments, IPv6 extension headers,
+    other ethertypes) is handed over to dpkt.
+    """
+    try:
+        return _decode_frame(frame, linktype)
+    except struct.error:
+        return None  # truncated
+
+
+def _decode_frame(frame, linktype):
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype, = _ushort.unpack_from(frame, 12)
+        offset = 14
+        while ethertype == ETH_TYPE_8021Q or ethertype == ETH_TYPE_8021AD:
+            ethertype, = _ushort.unpack_from(frame, offset + 2)
+            offset += 4
+        if ethertype != ETH_TYPE_IP and ethertype != ETH_TYPE_IP6:
+            return _decode_dpkt(dpkt.ethernet.Ethernet, frame)
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype, = _ushort.unpack_from(frame, 14)
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype, = _ushort.unpack_from(frame, 0)
+        offset = 20
+    elif linktype == LINKTYPE_NULL or linktype == LINKTYPE_LOOP:
+        # NULL is in the byte order of the host that did the capture
+        family, = _family_be.unpack_from(frame, 0)
+        if family > 0xffff and linktype == LINKTYPE_NULL:
+            family, = _family_le.unpack_from(frame, 0)
+        ethertype = ETH_TYPE_IP if family == _AF_INET else (
+            ETH_TYPE_IP6 if family in _AF_INET6 else None)
+        offset = 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        version, = _ubyte.unpack_from(frame, 0)
+        ethertype = ETH_TYPE_IP6 if version >> 4 == 6 else ETH_TYPE_IP
+        offset = 0
+    else:
+        return None
+
+    if ethertype == ETH_TYPE_IP:
+        return _decode_ip4(frame, offset)
+    elif ethertype == ETH_TYPE_IP6:
+        return _decode_ip6(frame, offset)
+
+    return None
+
+
+def _decode_ip4(frame, offset):
+    vihl, total_len, frag, proto, src, dst = _ip4.unpack_from(frame, offset)
+    if vihl >> 4 != 4 or proto != IP_PROTO_TCP:
+        return None
+
+    if frag & 0x3fff:  # more fragments or a fragment offset
+        return _decode_dpkt(dpkt.ip.IP, frame[offset:])
 
-_loopback = dpkt.loopback.Loopback()
-_ethernet = dpkt.ethernet.Ethernet()
+    # the total length is 0 for TSO'd packets captured on their way out
+    end = offset + total_len if total_len else len(frame)
+    return _decode_tcp(frame, offset + (vihl & 0xf) * 4, end, src, dst)
 
 
-def get_ip_packet(data, client_port, server_port, is_loopback=False):
-    """ if client_port is 0 any client_port is good """
-    header = _loopback if is_loopback else _ethernet
+def _decode_ip6(frame, offset):
+    payload_len, next_header, src, dst = _ip6.unpack_from(frame, offset)
+    if next_header != IP_PROTO_TCP:
+        if next_header in _IP6_EXTENSION_HEADERS:
+            return _decode_dpkt(dpkt.ip6.IP6, frame[offset:])
+        return None
 
+    end = offset + 40 + payload_len if payload_len else len(frame)
+    return _decode_tcp(frame, offset + 40, end, src, dst)
+
+
+def _decode_tcp(frame, offset, end, src, dst):
+    sport, dport, seq, data_offset, flags = _tcp.unpack_from(frame, offset)
+    start = offset + (data_offset >> 4) * 4
+    data = memoryview(frame)[start:min(end, len(frame))]
+    return TcpPacket(src, dst, sport, dport, seq, flags, data)
+
+
+def _decode_dpkt(header_class, data):
+    """ the slow path """
     try:
-        header.unpack(data)
-    except Exception as ex:
-        raise ValueError('Bad header: %s' % ex)
+        ip_p = header_class(data)
+        if header_class is dpkt.ethernet.Ethernet:
+            ip_p = ip_p.data
+    except Exception:
+        return None
 
-    tcp_p = getattr(header.data, 'data', None)
+    tcp_p = getattr(ip_p, 'data', None)
     if type(tcp_p) != dpkt.tcp.TCP:
-        raise ValueError('Not a TCP packet')
-
-    if tcp_p.dport == server_port:
-        if client_port != 0 and tcp_p.sport != client_port:
-            raise ValueError('Request from different client')
-    elif tcp_p.sport == server_port:
-        if client_port != 0 and tcp_p.dport != client_port:
-            raise ValueError('Reply for different client')
-    else:
-        raise ValueError('Packet not for/from client/server')
+        return None
+
+    return TcpPacket(
+        ip_p.src, ip_p.dst, tcp_p.sport, tcp_p.dport, tcp_p.seq, tcp_p.flags,
+        tcp_p.data)
+
 
-    return header.data
+def pack_ip(ip):
+    """ the packed form of an IPv4 or IPv6 address, as found in packets """
+    for af_type in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(af_type, ip)
+        except (socket.error, ValueError):
+            pass
+    raise ValueError('Bad IP address: %s' % ip)
 
 
-def get_ip(ip_packet, packed_addr):
-    af_type = socket.AF_INET if type(ip_packet) == dpkt.ip.IP else socket.AF_INET6
-    return socket.inet_ntop(af_type, packed_addr)
+def format_addr(packed_addr, port):
+    """ ip:port from the packed (4 or 16 bytes) address """
+    af_type = socket.AF_INET if len(packed_addr) == 4 else socket.AF_INET6
+    return '%s:%s' % (socket.inet_ntop(af_type, packed_addr), port)
 
 
 def to_bytes(value):